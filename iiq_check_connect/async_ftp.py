@@ -0,0 +1,451 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""asyncio FTP/FTPS transport, the alternative to the ftplib based FTPSession.
+
+Runs several transfers concurrently on one event loop. Every command waits at most
+timeout seconds for its response, and writes to the data connection wait while
+the server does not keep up (backpressure), instead of blocking the worker.
+Like FTPSession, every command is recorded with response and latency in an FTPLog.
+
+FTPS needs Python 3.11 (StreamWriter.start_tls), which IiQCheckSettings.validate
+checks when the transport is selected. The data connections do not reuse
+the TLS session of the control connection, servers which require that (e.g. vsftpd
+with require_ssl_reuse) have to use the ftplib transport.
+"""
+
+import asyncio
+import datetime
+import io
+import os
+import re
+import ssl
+import time
+from ftplib import error_perm, error_proto, error_reply, error_temp
+
+from iiq_check_connect.content_hash import format_checksum, get_checksum_filename, parse_checksum
+from iiq_check_connect.ftp_log import FTPLog
+from iiq_check_connect.ftp_session import UPLOAD_BLOCKSIZE
+from iiq_check_connect.metrics import ExportMetrics
+
+# Seconds to wait for a response, a connection or the progress of a transfer
+COMMAND_TIMEOUT = 30
+
+# Bytes queued on the data connection before writing waits for the server to catch up
+DATA_WRITE_BUFFER = 256 * 1024
+
+# Transfers running at the same time in upload_to_destinations
+MAX_CONCURRENT_TRANSFERS = 4
+
+PASV_PATTERN = re.compile(r"(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)")
+
+# StreamWriter.start_tls, which FTPS needs, was added in Python 3.11
+FTPS_SUPPORTED = hasattr(asyncio.StreamWriter, "start_tls")
+
+
+def create_ssl_context():
+    # Same as ftplib.FTP_TLS, which does not verify the server certificate
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class AsyncFTPSession:
+    """An authenticated FTP/FTPS session in the upload directory, with the interface of FTPSession as coroutines.
+
+    Usage:
+        async with AsyncFTPSession(server, user, password, path) as session:
+            await session.upload("file.xlsx", f)
+    """
+
+    def __init__(self, server, user, password, path, port=21, use_secure_ftp=False, ftp_log=None, metrics=None, timeout=COMMAND_TIMEOUT):
+        self.server = server
+        self.user = user
+        self.password = password
+        self.path = path
+        self.port = port or 21
+        self.use_secure_ftp = use_secure_ftp
+        self.ftp_log = ftp_log if ftp_log is not None else FTPLog()
+        self.metrics = metrics or ExportMetrics()
+        self.timeout = timeout
+        self.ssl_context = None
+        self.reader = None
+        self.writer = None
+
+    @classmethod
+    def from_settings(cls, settings, ftp_log=None, metrics=None):
+        return cls(
+            server=settings.ftp_server,
+            user=settings.ftp_user,
+            password=settings.get_password("ftp_password"),
+            path=settings.ftp_path,
+            port=settings.ftp_port,
+            use_secure_ftp=settings.use_secure_ftp,
+            ftp_log=ftp_log,
+            metrics=metrics,
+        )
+
+    @classmethod
+    def from_destination(cls, destination, ftp_log=None, metrics=None):
+        """Create a session for a destination of ftp_upload.get_destinations."""
+        return cls(
+            server=destination.server,
+            user=destination.user,
+            password=destination.password,
+            path=destination.path,
+            port=destination.port,
+            use_secure_ftp=destination.use_secure_ftp,
+            ftp_log=ftp_log,
+            metrics=metrics,
+        )
+
+    async def _read_response(self):
+        line = await self.reader.readline()
+        if not line:
+            raise EOFError("Connection closed by the FTP server")
+        response = line.decode("utf-8", "replace").rstrip("\r\n")
+
+        # Multi line response: "213-..." up to the line starting with "213 "
+        if response[3:4] == "-":
+            code = response[:3]
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    raise EOFError("Connection closed by the FTP server")
+                line = line.decode("utf-8", "replace").rstrip("\r\n")
+                response += "\n" + line
+                if line[:3] == code and line[3:4] != "-":
+                    break
+        return response
+
+    async def get_response(self):
+        """Wait for the next response, raise the ftplib errors for 4xx and 5xx like ftplib does."""
+        response = await asyncio.wait_for(self._read_response(), self.timeout)
+        if response[:1] in ("1", "2", "3"):
+            return response
+        if response[:1] == "4":
+            raise error_temp(response)
+        if response[:1] == "5":
+            raise error_perm(response)
+        raise error_proto(response)
+
+    async def sendcmd(self, cmd):
+        """Send cmd and return the response, the command is recorded with response and latency in ftp_log."""
+        start = time.perf_counter()
+        try:
+            self.writer.write(f"{cmd}\r\n".encode("utf-8"))
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+            response = await self.get_response()
+        except Exception as e:
+            self.ftp_log.command(cmd, e, time.perf_counter() - start)
+            raise
+        self.ftp_log.command(cmd, response, time.perf_counter() - start)
+        return response
+
+    async def voidcmd(self, cmd):
+        """Send cmd and expect a 2xx response."""
+        response = await self.sendcmd(cmd)
+        if not response.startswith("2"):
+            raise error_reply(response)
+        return response
+
+    async def _start_tls(self, writer):
+        await asyncio.wait_for(writer.start_tls(self.ssl_context, server_hostname=self.server), self.timeout)
+
+    async def connect(self):
+        with self.metrics.stage("ftp_connect"):
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.server, self.port), self.timeout
+            )
+            await self.get_response()
+        self.ftp_log.append(f"Connected to FTP server {self.server} on port {self.port}.")
+
+        with self.metrics.stage("ftp_login"):
+            if self.use_secure_ftp:
+                self.ssl_context = create_ssl_context()
+                await self.voidcmd("AUTH TLS")
+                await self._start_tls(self.writer)
+
+            response = await self.sendcmd(f"USER {self.user}")
+            if response.startswith("3"):
+                response = await self.sendcmd(f"PASS {self.password}")
+            if not response.startswith("2"):
+                raise error_reply(response)
+            self.ftp_log.append(f"Logged in as {self.user}.")
+
+            if self.use_secure_ftp:
+                await self.voidcmd("PBSZ 0")
+                await self.voidcmd("PROT P")  # Switch to secure data connection
+                self.ftp_log.append("Switched to secure data connection.")
+
+            await self.voidcmd(f"CWD {self.path}")
+            self.ftp_log.append(f"Changed directory to {self.path}.")
+
+    async def ensure_connected(self):
+        if self.writer is None or self.writer.is_closing():
+            await self.connect()
+
+    async def _open_data_connection(self, cmd, rest=None):
+        """Open a passive data connection and send cmd, returns its (reader, writer)."""
+        response = await self.sendcmd("PASV")
+        match = PASV_PATTERN.search(response)
+        if not match:
+            raise error_proto(response)
+        numbers = [int(n) for n in match.groups()]
+        # Like ftplib, connect to the host of the control connection, not to the address in the response
+        host = self.writer.get_extra_info("peername")[0]
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, numbers[4] << 8 | numbers[5]), self.timeout
+        )
+
+        try:
+            if rest is not None:
+                response = await self.sendcmd(f"REST {rest}")
+                if not response.startswith("3"):
+                    raise error_reply(response)
+            response = await self.sendcmd(cmd)
+            if not response.startswith("1"):
+                raise error_reply(response)
+            if self.use_secure_ftp:
+                await self._start_tls(writer)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _close_data_connection(self, writer):
+        writer.close()
+        try:
+            await asyncio.wait_for(writer.wait_closed(), self.timeout)
+        except (ConnectionError, ssl.SSLError):
+            # Some servers close the data connection without a TLS shutdown
+            pass
+
+    async def _finish_transfer(self, cmd, start):
+        """Wait for the response after a transfer (226), recorded as the completion of cmd."""
+        try:
+            response = await self.get_response()
+        except Exception as e:
+            self.ftp_log.command(f"{cmd} (completion)", e, time.perf_counter() - start)
+            raise
+        self.ftp_log.command(f"{cmd} (completion)", response, time.perf_counter() - start)
+        if not response.startswith("2"):
+            raise error_reply(response)
+        return response
+
+    async def retrieve(self, filename):
+        """Return the content of a (small) file on the server."""
+        await self.voidcmd("TYPE I")
+        start = time.perf_counter()
+        reader, writer = await self._open_data_connection(f"RETR {filename}")
+        try:
+            data = await asyncio.wait_for(reader.read(), self.timeout)
+        finally:
+            await self._close_data_connection(writer)
+        await self._finish_transfer(f"RETR {filename}", start)
+        return data
+
+    async def store(self, filename, f, blocksize=UPLOAD_BLOCKSIZE, callback=None, rest=None):
+        """Send the file object f as filename, callback is called with every block sent."""
+        await self.voidcmd("TYPE I")
+        start = time.perf_counter()
+        reader, writer = await self._open_data_connection(f"STOR {filename}", rest)
+        try:
+            writer.transport.set_write_buffer_limits(high=DATA_WRITE_BUFFER)
+            while True:
+                # Reading from disk blocks, it runs in a thread so the other transfers continue meanwhile
+                block = await asyncio.to_thread(f.read, blocksize)
+                if not block:
+                    break
+                writer.write(block)
+                # Waits while more than DATA_WRITE_BUFFER bytes are queued, i.e. the server reads slower than we send
+                await asyncio.wait_for(writer.drain(), self.timeout)
+                if callback:
+                    callback(block)
+        finally:
+            await self._close_data_connection(writer)
+        await self._finish_transfer(f"STOR {filename}", start)
+
+    async def remote_size(self, filename):
+        """Return the size of filename on the server, or None if it does not exist or SIZE is not supported."""
+        try:
+            # SIZE is only reliable in binary mode
+            await self.voidcmd("TYPE I")
+            response = await self.sendcmd(f"SIZE {filename}")
+        except (error_perm, error_reply):
+            return None
+        if response.startswith("213"):
+            return int(response[3:].strip())
+        return None
+
+    async def remote_mtime(self, filename):
+        """Return the modification time of filename on the server as aware UTC datetime,
+        or None if it does not exist or MDTM is not supported."""
+        try:
+            response = await self.sendcmd(f"MDTM {filename}")
+        except (error_perm, error_reply):
+            return None
+        # 213 YYYYMMDDHHMMSS[.sss], always in UTC
+        try:
+            mtime = datetime.datetime.strptime(response[4:18], "%Y%m%d%H%M%S")
+        except ValueError:
+            return None
+        return mtime.replace(tzinfo=datetime.timezone.utc)
+
+    async def remote_checksum(self, filename):
+        """Return the hash from the checksum file of filename on the server, or None if there is none."""
+        try:
+            data = await self.retrieve(get_checksum_filename(filename))
+        except (error_perm, error_reply):
+            return None
+        return parse_checksum(data.decode("utf-8", "replace"))
+
+    async def is_unchanged(self, filename, size, content_hash=None, modified_after=None):
+        """Check if the server already has this version of filename, see FTPSession.is_unchanged."""
+        await self.ensure_connected()
+        if await self.remote_size(filename) != size:
+            return False
+
+        if content_hash:
+            remote_hash = await self.remote_checksum(filename)
+            if remote_hash:
+                return remote_hash == content_hash
+
+        if modified_after:
+            mtime = await self.remote_mtime(filename)
+            return bool(mtime and mtime >= modified_after)
+
+        return False
+
+    async def upload_checksum(self, filename, content_hash):
+        """Upload the checksum file of filename, so the next run can compare the content."""
+        checksum_filename = get_checksum_filename(filename)
+        await self.store(checksum_filename, io.BytesIO(format_checksum(content_hash, filename).encode()))
+        self.ftp_log.append(f"Uploaded checksum file {checksum_filename}.")
+
+    async def upload_if_changed(self, filename, f, content_hash=None, modified_after=None, checksum_file=False, **kwargs):
+        """Upload f like upload, unless the server already has the same content.
+        Returns the result of upload, or None if the transfer was skipped."""
+        size = os.fstat(f.fileno()).st_size - f.tell()
+        if await self.is_unchanged(filename, size, content_hash, modified_after):
+            self.ftp_log.append(f"File {filename} on the server is unchanged ({size} bytes), upload skipped.")
+            return None
+
+        result = await self.upload(filename, f, **kwargs)
+        if checksum_file and content_hash:
+            await self.upload_checksum(filename, content_hash)
+        return result
+
+    async def upload(self, filename, f, blocksize=UPLOAD_BLOCKSIZE, callback=None, resume=False):
+        """Upload the file object f as filename, see FTPSession.upload.
+
+        Returns a tuple of the number of bytes sent and the duration of the transfer in seconds.
+        """
+        await self.ensure_connected()
+        start_position = f.tell()
+        rest = None
+
+        if resume:
+            local_size = os.fstat(f.fileno()).st_size - start_position
+            remote_size = await self.remote_size(filename)
+            if remote_size and remote_size < local_size:
+                rest = remote_size
+                f.seek(start_position + rest)
+                self.ftp_log.append(f"Resuming upload of {filename} at byte {rest} of {local_size}.")
+
+        with self.metrics.stage("ftp_transfer") as stage:
+            try:
+                await self.store(filename, f, blocksize=blocksize, callback=callback, rest=rest)
+            except (error_perm, error_reply) as e:
+                # Server does not support REST for STOR, send the whole file
+                if rest is None or not str(e).startswith(("500", "501", "502", "504")):
+                    raise
+                self.ftp_log.append(f"Resume not supported ({e}), uploading {filename} from the start.")
+                f.seek(start_position)
+                await self.store(filename, f, blocksize=blocksize, callback=callback)
+                rest = None
+            size = f.tell() - start_position - (rest or 0)
+            stage["byte_count"] = size
+        duration = stage["seconds"]
+
+        rate = size / duration / 1024 if duration else 0
+        self.ftp_log.append(f"Uploaded file {filename}: {size} bytes in {duration:.3f} s ({rate:.1f} KiB/s).")
+        return size, duration
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            await self.sendcmd("QUIT")
+            self.ftp_log.append("FTP session closed.")
+        except Exception:
+            pass
+        self.writer.close()
+        self.writer = None
+        self.reader = None
+
+    async def __aenter__(self):
+        await self.ensure_connected()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+
+def run_upload(session, filename, file_path, **kwargs):
+    """Connect, upload_if_changed and close session on a new event loop, for synchronous callers.
+    Returns the result of upload_if_changed."""
+    async def upload():
+        async with session:
+            with open(file_path, "rb") as f:
+                return await session.upload_if_changed(filename, f, **kwargs)
+
+    return asyncio.run(upload())
+
+
+async def upload_to_destination(destination, filename, file_path, resume=False, content_hash=None, modified_after=None):
+    """Upload one file to one destination, returns the result dict of ftp_upload.upload_to_destination."""
+    ftp_log = FTPLog()
+    metrics = ExportMetrics()
+    result = {"destination": destination.title, "log": ftp_log, "metrics": metrics}
+    session = AsyncFTPSession.from_destination(destination, ftp_log, metrics)
+    start = time.perf_counter()
+    try:
+        async with session:
+            with open(file_path, "rb") as f:
+                uploaded = await session.upload_if_changed(
+                    filename,
+                    f,
+                    content_hash=content_hash,
+                    modified_after=modified_after,
+                    checksum_file=destination.checksum_file,
+                    resume=resume,
+                )
+        if uploaded:
+            result["byte_count"], _ = uploaded
+            result["status"] = "uploaded"
+        else:
+            result["status"] = "unchanged"
+    except Exception as e:
+        ftp_log.append(f"FTP upload failed: {e}")
+        result["status"] = "failed"
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def upload_to_destinations(destinations, filename, file_path, max_concurrency=MAX_CONCURRENT_TRANSFERS, **kwargs):
+    """Upload one file to several destinations concurrently on one event loop.
+    Returns one result dict per destination, in the order of destinations."""
+    async def upload_all():
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def upload(destination):
+            async with semaphore:
+                return await upload_to_destination(destination, filename, file_path, **kwargs)
+
+        return await asyncio.gather(*(upload(destination) for destination in destinations))
+
+    return asyncio.run(upload_all())
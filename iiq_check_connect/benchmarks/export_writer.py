@@ -0,0 +1,72 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""Compare the pandas to_excel path with XLSXExportWriter.
+
+Run without a site:
+    python -m iiq_check_connect.benchmarks.export_writer [rows ...]
+
+or on a bench:
+    bench --site <site> execute iiq_check_connect.benchmarks.export_writer.run
+"""
+
+import io
+import json
+import sys
+import time
+import tracemalloc
+
+from iiq_check_connect.export_writer import EXPORT_COLUMNS, XLSXExportWriter
+
+DEFAULT_SCALES = [10_000, 100_000, 1_000_000]
+
+
+def synthetic_rows(count):
+    for i in range(count):
+        yield (f"Nachname {i}", "Herr" if i % 2 else "Frau", f"gast{i}@example.com", "de", "2024-07-15")
+
+
+def bench_pandas(count):
+    import pandas as pd
+
+    df = pd.DataFrame(list(synthetic_rows(count)), columns=EXPORT_COLUMNS)
+    output = io.BytesIO()
+    df.to_excel(output, index=False)
+    return output.getbuffer().nbytes
+
+
+def bench_writer(count):
+    with XLSXExportWriter() as writer:
+        writer.write_rows(synthetic_rows(count))
+        f = writer.close()
+        f.seek(0, io.SEEK_END)
+        size = f.tell()
+        f.close()
+    return size
+
+
+def measure(func, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = func(count)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": round(duration, 3), "peak_mb": round(peak / 1024 / 1024, 1), "file_bytes": size}
+
+
+def run(scales=None):
+    results = []
+    for count in scales or DEFAULT_SCALES:
+        count = int(count)
+        result = {"rows": count}
+        for label, func in (("pandas", bench_pandas), ("writer", bench_writer)):
+            result[label] = measure(func, count)
+            print(f"{count:>9} rows {label:<7} {result[label]}")
+        results.append(result)
+    print(json.dumps(results, indent=1))
+    return results
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:] or None)
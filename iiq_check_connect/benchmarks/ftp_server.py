@@ -0,0 +1,63 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""Local pyftpdlib server for the benchmarks and the upload tests."""
+
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+
+@contextmanager
+def local_ftp_server(latency=0, dtp_handler=None):
+    """Run a threaded pyftpdlib server on a free local port.
+
+    latency delays every response of the server by that many seconds, dtp_handler
+    replaces the pyftpdlib handler of the data connections. Yields a namespace with
+    port, user, password, directory (the root of the server) and peak_connections,
+    the highest number of control connections open at the same time.
+    """
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    ftp_server = SimpleNamespace(
+        port=None,
+        user="iiq",
+        password="bench",
+        directory=tempfile.mkdtemp(prefix="iiq-check-bench-"),
+        connections=0,
+        peak_connections=0,
+    )
+    lock = threading.Lock()
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(ftp_server.user, ftp_server.password, ftp_server.directory, perm="elradfmwMT")
+
+    class Handler(FTPHandler):
+        def on_connect(self):
+            with lock:
+                ftp_server.connections += 1
+                ftp_server.peak_connections = max(ftp_server.peak_connections, ftp_server.connections)
+
+        def on_disconnect(self):
+            with lock:
+                ftp_server.connections -= 1
+
+        def respond(self, resp, **kwargs):
+            if latency:
+                time.sleep(latency)
+            super().respond(resp, **kwargs)
+
+    Handler.authorizer = authorizer
+    if dtp_handler:
+        Handler.dtp_handler = dtp_handler
+    server = ThreadedFTPServer(("127.0.0.1", 0), Handler)
+    ftp_server.port = server.address[1]
+    thread = threading.Thread(target=server.serve_forever, kwargs={"handle_exit": False}, daemon=True)
+    thread.start()
+    try:
+        yield ftp_server
+    finally:
+        server.close_all()
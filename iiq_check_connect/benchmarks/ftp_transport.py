@@ -0,0 +1,117 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""Compare the throughput of the ftplib and the asyncio FTP transport.
+
+Uploads one file to several destinations (all on a local pyftpdlib server), with
+ftplib one after another, with ftplib in a thread pool (deliver_export) and with
+asyncio on one event loop. latency delays every server response, to see the
+effect of a slow server on the control connection.
+
+Run without a site:
+    python -m iiq_check_connect.benchmarks.ftp_transport [megabytes] [destinations] [latency seconds]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from iiq_check_connect.async_ftp import upload_to_destinations
+from iiq_check_connect.benchmarks.ftp_server import local_ftp_server
+from iiq_check_connect.ftp_session import FTPSession
+
+
+def get_destinations(ftp_server, count):
+    """One destination per sub directory, so the uploads do not write the same file."""
+    destinations = []
+    for i in range(count):
+        os.makedirs(os.path.join(ftp_server.directory, f"destination-{i}"), exist_ok=True)
+        destinations.append(SimpleNamespace(
+            title=f"destination-{i}",
+            server="127.0.0.1",
+            port=ftp_server.port,
+            path=f"/destination-{i}",
+            user=ftp_server.user,
+            password=ftp_server.password,
+            use_secure_ftp=False,
+            checksum_file=False,
+        ))
+    return destinations
+
+
+def upload_ftplib(destination, filename, file_path):
+    with FTPSession(
+        destination.server,
+        destination.user,
+        destination.password,
+        destination.path,
+        port=destination.port,
+    ) as session, open(file_path, "rb") as f:
+        session.upload(filename, f)
+
+
+def bench_ftplib_sequential(destinations, filename, file_path):
+    for destination in destinations:
+        upload_ftplib(destination, filename, file_path)
+
+
+def bench_ftplib_threads(destinations, filename, file_path):
+    with ThreadPoolExecutor(max_workers=len(destinations)) as executor:
+        list(executor.map(lambda d: upload_ftplib(d, filename, file_path), destinations))
+
+
+def bench_asyncio(destinations, filename, file_path):
+    results = upload_to_destinations(destinations, filename, file_path, max_concurrency=len(destinations))
+    failed = [r for r in results if r["status"] == "failed"]
+    assert not failed, failed
+
+
+TRANSPORTS = {
+    "ftplib": bench_ftplib_sequential,
+    "ftplib_threads": bench_ftplib_threads,
+    "asyncio": bench_asyncio,
+}
+
+
+def run(megabytes=20, destinations=4, latency=0.0):
+    results = []
+    with tempfile.NamedTemporaryFile(suffix=".xlsx") as export_file:
+        export_file.write(os.urandom(int(megabytes * 1024 * 1024)))
+        export_file.flush()
+        total_bytes = os.path.getsize(export_file.name) * destinations
+
+        with local_ftp_server(latency) as ftp_server:
+            targets = get_destinations(ftp_server, destinations)
+            for transport, bench in TRANSPORTS.items():
+                start = time.perf_counter()
+                bench(targets, "iiq-check-bench.xlsx", export_file.name)
+                seconds = time.perf_counter() - start
+                results.append({
+                    "transport": transport,
+                    "destinations": destinations,
+                    "latency": latency,
+                    "seconds": round(seconds, 3),
+                    "mib_per_second": round(total_bytes / seconds / 1024 / 1024, 1),
+                })
+                print(f"{transport:<16} {seconds:>8.3f} s  {total_bytes / seconds / 1024 / 1024:>8.1f} MiB/s")
+
+                # Otherwise the disk write back of this run slows down the next one
+                for destination in targets:
+                    os.remove(os.path.join(ftp_server.directory, destination.title, "iiq-check-bench.xlsx"))
+                os.sync()
+
+    print(json.dumps(results, indent=1))
+    return results
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    run(
+        megabytes=float(args[0]) if len(args) > 0 else 20,
+        destinations=int(args[1]) if len(args) > 1 else 4,
+        latency=float(args[2]) if len(args) > 2 else 0.0,
+    )
@@ -0,0 +1,82 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""Measure the import time of the app modules with python -X importtime.
+
+Every module is imported in a fresh interpreter, so the numbers include all of its
+dependencies. check fails if a module loads one of the heavy export dependencies,
+e.g. the scheduler gate, which runs every hour, must not import pandas.
+
+Run in the bench environment (frappe has to be importable, no site needed):
+    python -m iiq_check_connect.benchmarks.import_time [module ...]
+"""
+
+import json
+import subprocess
+import sys
+
+# Modules imported on every scheduler tick or by the whitelisted entry points
+DEFAULT_MODULES = [
+    "iiq_check_connect.scheduler",
+    "iiq_check_connect.tools",
+    "iiq_check_connect.jobs",
+    "iiq_check_connect.ftp_upload",
+    "iiq_check_connect.export_engine",
+]
+
+# Only imported when an export is actually written
+HEAVY_MODULES = ["pandas", "openpyxl", "pyarrow"]
+
+
+def measure_import(module):
+    """Import module in a new interpreter, returns (total microseconds, {imported module: cumulative microseconds})."""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imported = {}
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue
+        name = name.strip()
+        imported[name] = max(imported.get(name, 0), int(cumulative))
+    return imported.get(module, 0), imported
+
+
+def run(modules=None, top=10):
+    results = []
+    for module in modules or DEFAULT_MODULES:
+        total, imported = measure_import(module)
+        heavy = [name for name in HEAVY_MODULES if name in imported]
+        slowest = sorted(
+            ((name, us) for name, us in imported.items() if name != module and "." not in name),
+            key=lambda item: item[1],
+            reverse=True,
+        )[:top]
+        results.append({
+            "module": module,
+            "milliseconds": round(total / 1000, 1),
+            "heavy_imports": heavy,
+            "slowest_packages": [{"package": name, "milliseconds": round(us / 1000, 1)} for name, us in slowest],
+        })
+        print(f"{module:<40} {total / 1000:>8.1f} ms  heavy: {', '.join(heavy) or '-'}")
+    print(json.dumps(results, indent=1))
+    return results
+
+
+def check(modules=None):
+    """Raise an AssertionError if one of the modules imports a heavy dependency."""
+    for module in modules or DEFAULT_MODULES:
+        _, imported = measure_import(module)
+        heavy = [name for name in HEAVY_MODULES if name in imported]
+        assert not heavy, f"Importing {module} loads {', '.join(heavy)}, import them where they are used."
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:] or None)
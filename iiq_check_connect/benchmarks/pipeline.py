@@ -0,0 +1,347 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""Benchmark of the export pipeline on a synthetic Reservierung / Camping Kunde dataset.
+
+Seeds departures at several scales, runs prepare_export and uploads the file to a
+local pyftpdlib server, then records wall time, memory and the per-stage metrics as JSON.
+Every export runs in its own process, see run.
+The settings and all seeded rows are restored / removed afterwards.
+
+Only runs on sites with allow_tests enabled, use a throw-away site:
+    bench --site <test-site> execute iiq_check_connect.benchmarks.pipeline.run
+    bench --site <test-site> execute iiq_check_connect.benchmarks.pipeline.run --kwargs "{'scales': [1000], 'output': '/tmp/iiq.json'}"
+    bench --site <test-site> execute iiq_check_connect.benchmarks.pipeline.run --kwargs "{'scales': [100000], 'shard_workers': [1, 2, 4]}"
+"""
+
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+import frappe
+
+from iiq_check_connect.benchmarks.ftp_server import local_ftp_server
+from iiq_check_connect.ftp_session import FTPSession
+from iiq_check_connect.language_mapping import clear_language_mapping_cache
+from iiq_check_connect.metrics import ExportMetrics, get_peak_rss_mb
+from iiq_check_connect.export_engine import get_export_start_of_day, prepare_export
+
+DEFAULT_SCALES = [1_000, 50_000, 500_000]
+
+# Prefix of all seeded document names, used to clean up afterwards
+NAME_PREFIX = "IIQBENCH-"
+
+# Fixed seed, so every run works on the same dataset
+RANDOM_SEED = 4711
+
+# (value, weight) distributions of the synthetic data
+KATEGORIEN = [("Stellplatz", 55), ("Mietunterkunft", 25), ("Zeltplatz", 15), ("Dauercamper", 5)]
+KUNDENTYPEN = [("Privat", 85), ("Firma", 5), ("Gruppe", 7), ("Personal", 3)]
+LAENDER = [("DE", 58), ("NL", 16), ("CH", 8), ("AT", 7), ("DK", 4), ("BE", 3), ("FR", 2), ("PL", 1), ("", 1)]
+ANREDEN = [("Herr", 48), ("Frau", 47), ("Familie", 5)]
+
+# Filters and language mapping configured during the benchmark
+BENCHMARK_KATEGORIEN = ["Stellplatz", "Mietunterkunft", "Zeltplatz"]
+BENCHMARK_KUNDENTYPEN = ["Privat", "Gruppe"]
+BENCHMARK_LANGUAGES = {"DE": "de", "AT": "de", "CH": "de", "NL": "nl", "BE": "nl", "DK": "da", "FR": "fr"}
+
+# Share of customers without an email address and of guests with a second reservation
+EMPTY_EMAIL_RATIO = 0.03
+REPEAT_GUEST_RATIO = 0.05
+
+# Departures on the days around the exported one, relative to the exported departures
+NEIGHBOUR_DAY_RATIO = 0.2
+
+# Minimal tables, created only if the site has no Reservierung / Camping Kunde doctype
+MINIMAL_TABLES = {
+    "Reservierung": """
+        CREATE TABLE IF NOT EXISTS `tabReservierung` (
+            name varchar(140) PRIMARY KEY, creation datetime(6), modified datetime(6),
+            abreise datetime(6), kategorie varchar(140), kundennummer varchar(140),
+            KEY iiq_check_abreise_kategorie_kundennummer (abreise, kategorie, kundennummer)
+        )""",
+    "Camping Kunde": """
+        CREATE TABLE IF NOT EXISTS `tabCamping Kunde` (
+            name varchar(140) PRIMARY KEY, creation datetime(6), modified datetime(6),
+            nachname varchar(140), anrede varchar(140), email varchar(140),
+            land varchar(140), kundentyp varchar(140),
+            KEY iiq_check_kundentyp (kundentyp)
+        )""",
+}
+
+
+def weighted(rng, distribution):
+    values, weights = zip(*distribution)
+    return rng.choices(values, weights)[0]
+
+
+def ensure_tables():
+    """Create minimal tables for missing doctypes, returns the tables to drop afterwards."""
+    created = []
+    for doctype, ddl in MINIMAL_TABLES.items():
+        if not frappe.db.table_exists(doctype):
+            frappe.db.sql_ddl(ddl)
+            created.append(doctype)
+    return created
+
+
+def seed_dataset(departures, departure_day, chunk_size=10_000):
+    """Insert departures reservations leaving on departure_day, plus some on the neighbouring days."""
+    rng = random.Random(RANDOM_SEED + departures)
+    now = datetime.datetime.now()
+    neighbour_departures = int(departures * NEIGHBOUR_DAY_RATIO)
+    total = departures + neighbour_departures
+
+    customers = []
+    reservations = []
+    for i in range(total):
+        customer = f"{NAME_PREFIX}K-{i:07d}"
+        email = "" if rng.random() < EMPTY_EMAIL_RATIO else f"gast{i}@example.com"
+        customers.append((customer, now, now, f"Nachname {i}", weighted(rng, ANREDEN), email,
+                          weighted(rng, LAENDER), weighted(rng, KUNDENTYPEN)))
+
+        if i < departures:
+            abreise = departure_day + datetime.timedelta(hours=rng.randint(6, 13), minutes=rng.randint(0, 59))
+        else:
+            abreise = departure_day + datetime.timedelta(days=rng.choice([-1, 1]), hours=10)
+
+        # Some guests leave with a second unit on the same day
+        if i and rng.random() < REPEAT_GUEST_RATIO:
+            customer = customers[rng.randrange(i)][0]
+        reservations.append((f"{NAME_PREFIX}R-{i:07d}", now, now, abreise, weighted(rng, KATEGORIEN), customer))
+
+    frappe.db.bulk_insert(
+        "Camping Kunde",
+        ["name", "creation", "modified", "nachname", "anrede", "email", "land", "kundentyp"],
+        customers,
+        chunk_size=chunk_size,
+    )
+    frappe.db.bulk_insert(
+        "Reservierung",
+        ["name", "creation", "modified", "abreise", "kategorie", "kundennummer"],
+        reservations,
+        chunk_size=chunk_size,
+    )
+    frappe.db.commit()
+
+
+def clear_dataset():
+    frappe.db.sql("DELETE FROM `tabReservierung` WHERE name LIKE %s", f"{NAME_PREFIX}%")
+    frappe.db.sql("DELETE FROM `tabCamping Kunde` WHERE name LIKE %s", f"{NAME_PREFIX}%")
+    frappe.db.commit()
+
+
+def delete_export(departure_date):
+    for name in frappe.get_all("iiQ-Check Export", filters={"departure_date": departure_date}, pluck="name"):
+        frappe.delete_doc("iiQ-Check Export", name, force=True, ignore_permissions=True)
+    frappe.db.commit()
+
+
+@contextmanager
+def benchmark_settings():
+    """Configure filters and language mapping for the synthetic data, restore the settings afterwards."""
+    settings = frappe.get_single("iiQ-Check Settings")
+    original = settings.as_dict(no_default_fields=True)
+
+    settings.export_days_after_departure = 1
+    settings.default_language = "en"
+    settings.set("einheit_kategorie", [{"einheit_kategorie": k} for k in BENCHMARK_KATEGORIEN])
+    settings.set("kundentyp", [{"kundentyp": k} for k in BENCHMARK_KUNDENTYPEN])
+    settings.set("language_mapping", [
+        {"country_code": code, "language_string": language} for code, language in BENCHMARK_LANGUAGES.items()
+    ])
+    # The linked Einheit Kategorie / Kundentyp records may not exist on a test site
+    settings.flags.ignore_links = True
+    settings.flags.ignore_mandatory = True
+    settings.save(ignore_permissions=True)
+    frappe.db.commit()
+
+    try:
+        yield settings
+    finally:
+        settings = frappe.get_single("iiQ-Check Settings")
+        for table in ("einheit_kategorie", "kundentyp", "language_mapping"):
+            settings.set(table, [
+                {k: v for k, v in row.items() if k not in ("name", "parent", "parentfield", "parenttype", "doctype")}
+                for row in original.get(table) or []
+            ])
+        for field in ("export_days_after_departure", "default_language", "shard_export_by", "shard_workers"):
+            settings.set(field, original.get(field))
+        settings.flags.ignore_links = True
+        settings.flags.ignore_mandatory = True
+        settings.save(ignore_permissions=True)
+        frappe.db.commit()
+        clear_language_mapping_cache()
+
+
+def bench_prepare_export(streaming, trace_memory=False):
+    """Run prepare_export once, returns the name of the export and its measurements.
+
+    With trace_memory, only the peak of the Python allocations is measured, tracing
+    slows down the export, so the time is taken from a run without it.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    export_name = prepare_export(interactive=True, streaming=streaming)
+    seconds = time.perf_counter() - start
+    frappe.db.commit()
+
+    if trace_memory:
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return export_name, {"traced_peak_mb": round(traced_peak / 1024 / 1024, 1)}
+
+    export_doc = frappe.get_doc("iiQ-Check Export", export_name)
+    return export_name, {
+        "seconds": round(seconds, 3),
+        "peak_rss_mb": round(get_peak_rss_mb(), 1),
+        "recipients": export_doc.number_of_recipients,
+        "stages": [
+            {"stage": m.stage, "seconds": m.seconds, "row_count": m.row_count, "byte_count": m.byte_count}
+            for m in export_doc.metrics
+        ],
+    }
+
+
+def bench_prepare_export_in_worker(site, sites_path, streaming, trace_memory=False):
+    """Entry point of the benchmark subprocess, connects to the site and runs bench_prepare_export."""
+    frappe.init(site=site, sites_path=sites_path)
+    frappe.connect()
+    try:
+        return bench_prepare_export(streaming, trace_memory)
+    finally:
+        frappe.destroy()
+
+
+def run_in_subprocess(streaming, trace_memory=False):
+    """Run bench_prepare_export in a fresh process.
+
+    ru_maxrss is the peak of the whole process, in a shared process every run would
+    report at least the peak of the runs before it.
+    """
+    # spawn: a forked process would share the database connection of this one
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        future = executor.submit(
+            bench_prepare_export_in_worker, frappe.local.site, frappe.local.sites_path, streaming, trace_memory
+        )
+        return future.result()
+
+
+def measure_prepare_export(streaming, departure_date, trace_memory=True):
+    """Time prepare_export in one fresh process and, with trace_memory, trace its allocations in another.
+    Returns the name of the timed export and the measurements."""
+    if trace_memory:
+        delete_export(departure_date)
+        _, traced = run_in_subprocess(streaming, trace_memory=True)
+    delete_export(departure_date)
+    export_name, prepare = run_in_subprocess(streaming)
+    if trace_memory:
+        prepare.update(traced)
+    return export_name, prepare
+
+
+def bench_upload(export_name, ftp_server):
+    export_doc = frappe.get_doc("iiQ-Check Export", export_name)
+    file_doc = frappe.get_doc("File", {"file_url": export_doc.xlsx_file})
+    metrics = ExportMetrics()
+
+    start = time.perf_counter()
+    with FTPSession("127.0.0.1", ftp_server.user, ftp_server.password, "/", port=ftp_server.port, metrics=metrics) as session:
+        with open(file_doc.get_full_path(), "rb") as f:
+            size, _ = session.upload(file_doc.file_name, f)
+    seconds = time.perf_counter() - start
+
+    return {
+        "seconds": round(seconds, 3),
+        "bytes": size,
+        "stages": [{"stage": s["stage"], "seconds": s["seconds"]} for s in metrics.stages],
+    }
+
+
+def bench_sharded_export(settings, shard_workers, departure_date, trace_memory=True):
+    """Run prepare_export sharded by category with shard_workers worker processes."""
+    settings.shard_export_by = "category"
+    settings.shard_workers = shard_workers
+    settings.flags.ignore_links = True
+    settings.flags.ignore_mandatory = True
+    settings.save(ignore_permissions=True)
+    frappe.db.commit()
+    try:
+        _, prepare = measure_prepare_export(1, departure_date, trace_memory)
+    finally:
+        settings.shard_export_by = ""
+        settings.save(ignore_permissions=True)
+        frappe.db.commit()
+    return prepare
+
+
+def run(scales=None, streaming=None, output=None, upload=True, shard_workers=None, trace_memory=True):
+    """shard_workers is a list of worker counts, the sharded export is benchmarked with each of them.
+
+    Every export runs in a fresh process, so time and peak RSS of one run do not depend
+    on the runs before it. With trace_memory, every export is run a second time with
+    tracemalloc, for the peak of the Python allocations (traced_peak_mb).
+    """
+    if not frappe.conf.allow_tests:
+        frappe.throw("The benchmark seeds and deletes data, enable allow_tests for this (test) site first.")
+
+    if streaming is None:
+        streaming_modes = [0, 1]
+    else:
+        streaming_modes = [frappe.utils.cint(streaming)]
+
+    created_tables = ensure_tables()
+    results = []
+
+    try:
+        with benchmark_settings() as settings, ExitStack() as stack:
+            departure_day = get_export_start_of_day(settings)
+            ftp_server = stack.enter_context(local_ftp_server()) if upload else None
+
+            for scale in scales or DEFAULT_SCALES:
+                scale = int(scale)
+                clear_dataset()
+                seed_dataset(scale, departure_day)
+
+                for mode in streaming_modes:
+                    export_name, prepare = measure_prepare_export(mode, departure_day.date(), trace_memory)
+                    result = {"departures": scale, "streaming": mode, "prepare_export": prepare}
+                    if ftp_server:
+                        result["upload"] = bench_upload(export_name, ftp_server)
+                    delete_export(departure_day.date())
+
+                    print(f"{scale:>8} departures streaming={mode}: prepare {prepare['seconds']} s, "
+                          f"{prepare['recipients']} recipients, peak RSS {prepare['peak_rss_mb']} MB")
+                    results.append(result)
+
+                for workers in shard_workers or []:
+                    prepare = bench_sharded_export(settings, int(workers), departure_day.date(), trace_memory)
+                    delete_export(departure_day.date())
+
+                    print(f"{scale:>8} departures sharded, {workers} workers: prepare {prepare['seconds']} s, "
+                          f"{prepare['recipients']} recipients")
+                    results.append({"departures": scale, "shard_workers": int(workers), "prepare_export": prepare})
+    finally:
+        clear_dataset()
+        for doctype in created_tables:
+            frappe.db.sql_ddl(f"DROP TABLE IF EXISTS `tab{doctype}`")
+
+    report = {
+        "created_on": datetime.datetime.now().isoformat(timespec="seconds"),
+        "site": frappe.local.site,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Benchmark results written to {os.path.abspath(output)}")
+    else:
+        print(json.dumps(report, indent=1))
+    return report
@@ -0,0 +1,58 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import hashlib
+
+# Suffix of the checksum file uploaded next to an export, in the format of sha256sum
+CHECKSUM_SUFFIX = ".sha256"
+
+# Read size when hashing a file on disk
+HASH_BLOCKSIZE = 1024 * 1024
+
+
+def hash_content(content):
+    """Return the SHA-256 hex digest of the given bytes."""
+    return hashlib.sha256(content).hexdigest()
+
+
+def hash_file(file_path):
+    """Return the SHA-256 hex digest of a file, read block by block."""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCKSIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def copy_and_hash(source, target, blocksize=HASH_BLOCKSIZE):
+    """Copy the file object source into target block by block.
+
+    Returns the number of bytes copied, the SHA-256 hex digest (as hash_content) and
+    the MD5 hex digest, which frappe records as content_hash of a File.
+    """
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    size = 0
+    for block in iter(lambda: source.read(blocksize), b""):
+        target.write(block)
+        sha256.update(block)
+        md5.update(block)
+        size += len(block)
+    return size, sha256.hexdigest(), md5.hexdigest()
+
+
+def get_checksum_filename(filename):
+    return f"{filename}{CHECKSUM_SUFFIX}"
+
+
+def format_checksum(content_hash, filename):
+    """Return the checksum file content for filename, e.g. "<hash>  iiq-check-export-2024-07-15.xlsx"."""
+    return f"{content_hash}  {filename}\n"
+
+
+def parse_checksum(text):
+    """Return the hash of a checksum file written by format_checksum or sha256sum, or None."""
+    parts = (text or "").split()
+    if not parts or len(parts[0]) != 64:
+        return None
+    return parts[0].lower()
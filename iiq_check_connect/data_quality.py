@@ -0,0 +1,87 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import re
+
+# Pragmatic address check: no spaces, one @, a dotted domain with a top level domain of
+# at least two letters and no empty parts around the dots
+EMAIL_PATTERN = (
+    r"(?!\.)(?!.*\.\.)[a-z0-9.!#$%&'*+/=?^_`{|}~-]+(?<!\.)"
+    r"@(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}"
+)
+EMAIL_REGEX = re.compile(EMAIL_PATTERN)
+
+
+def normalize_email(email):
+    """Return the email address stripped and in lower case, "" for None."""
+    return (email or "").strip().lower()
+
+
+class RecipientCleaner:
+    """Drops rows with invalid email addresses and merges rows of the same recipient.
+
+    Recipients are identified by the normalized email address, so a guest leaving
+    with several reservations on the same day gets a single row. Of several rows of
+    a recipient, the first one in the order of the export query is kept, also over
+    several calls of the same cleaner. clean_frame cleans a whole DataFrame, clean_email
+    and is_duplicate are used when rows are streamed, both follow this rule.
+    The counts of dropped and merged rows are collected for the export statistics.
+    """
+
+    def __init__(self):
+        self.invalid_emails = 0
+        self.merged_duplicates = 0
+        self._seen = set()
+
+    def clean_frame(self, df):
+        """Clean the DataFrame of export rows.
+
+        Returns a tuple of the cleaned DataFrame (in the original order, emails normalized)
+        and the DataFrame of all rows with a valid email, including the merged ones.
+        """
+        if df.empty:
+            return df, df
+
+        email = df["email"].fillna("").astype(str).str.strip().str.lower()
+        valid = email.str.fullmatch(EMAIL_PATTERN)
+        self.invalid_emails += int((~valid).sum())
+
+        valid_rows = df[valid].assign(email=email[valid])
+
+        # Like is_duplicate, the first row of every recipient is kept
+        duplicated = valid_rows["email"].isin(self._seen) | valid_rows["email"].duplicated()
+        self.merged_duplicates += int(duplicated.sum())
+
+        cleaned = valid_rows[~duplicated]
+        self._seen.update(cleaned["email"])
+        return cleaned, valid_rows
+
+    def clean_email(self, email):
+        """Return the normalized email, or None if it is invalid (counted as dropped)."""
+        email = normalize_email(email)
+        if not EMAIL_REGEX.fullmatch(email):
+            self.invalid_emails += 1
+            return None
+        return email
+
+    def add_exported(self, emails):
+        """Mark normalized emails as kept before, e.g. by an earlier export of the same day.
+
+        Later rows with one of them count as merged duplicates.
+        """
+        self._seen.update(emails)
+
+    def is_duplicate(self, email):
+        """Check if a row with this normalized email was already kept (counted as merged)."""
+        if email in self._seen:
+            self.merged_duplicates += 1
+            return True
+        self._seen.add(email)
+        return False
+
+    def statistics(self):
+        """Return the counts as lines for the export statistics."""
+        return (
+            f"Invalid Emails Dropped: {self.invalid_emails}\n"
+            f"Duplicate Recipients Merged: {self.merged_duplicates}\n"
+        )
@@ -0,0 +1,222 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""Denormalized snapshot of the export candidates, one row per Reservierung.
+
+The export query joins Reservierung and Camping Kunde at export time. With
+use_departure_snapshot (iiQ-Check Settings) it reads iiQ-Check Departure Snapshot
+instead, a flat table with the customer columns, indexed by departure date.
+
+The doc_events in hooks.py keep the snapshot up to date when a reservation or a
+customer is saved, renamed or deleted. Changes which bypass the document hooks
+(e.g. imports writing with SQL) are found by check_snapshot and repaired by
+rebuild_snapshot.
+"""
+
+import datetime
+
+import frappe
+from frappe.query_builder import DocType
+
+from iiq_check_connect.progress import publish_progress
+
+SNAPSHOT_DOCTYPE = "iiQ-Check Departure Snapshot"
+
+# Columns of Camping Kunde copied into the snapshot
+CUSTOMER_FIELDS = ["nachname", "anrede", "email", "land", "kundentyp"]
+
+# Columns compared by check_snapshot
+COMPARED_FIELDS = ["kundennummer", "abreise", "kategorie"] + CUSTOMER_FIELDS
+
+SNAPSHOT_COLUMNS = [
+    "name", "creation", "modified", "owner", "modified_by", "departure_date",
+    "kundennummer", "abreise", "kategorie", "nachname", "anrede", "email", "land", "kundentyp",
+]
+
+# Reservations read per query by rebuild_snapshot
+REBUILD_CHUNK_SIZE = 10_000
+
+# Days before and after today, which check_snapshot compares by default
+CHECK_DAYS = 14
+
+# Reservation names listed per kind of difference in the result of check_snapshot
+MAX_REPORTED = 100
+
+
+def get_snapshot_row(reservation, customer, now=None):
+    """Return the values of the snapshot row (in the order of SNAPSHOT_COLUMNS) of a reservation."""
+    now = now or frappe.utils.now_datetime()
+    # The latest change of reservation or customer, so modified_since of incremental exports works on the snapshot
+    modified = max(frappe.utils.get_datetime(m) for m in (reservation.modified, customer.modified) if m)
+    abreise = frappe.utils.get_datetime(reservation.abreise)
+    return (
+        reservation.name, now, modified, frappe.session.user, frappe.session.user, abreise.date(),
+        reservation.kundennummer, abreise, reservation.kategorie,
+        customer.nachname, customer.anrede, customer.email, customer.land, customer.kundentyp,
+    )
+
+
+def write_snapshot_rows(rows):
+    if rows:
+        frappe.db.bulk_insert(SNAPSHOT_DOCTYPE, SNAPSHOT_COLUMNS, rows)
+
+
+def get_reservation_query():
+    """Reservations joined with their customer, with the columns of get_snapshot_row."""
+    Reservierung = DocType("Reservierung")
+    CampingKunde = DocType("Camping Kunde")
+    return (
+        frappe.qb.from_(Reservierung)
+        .inner_join(CampingKunde)
+        .on(Reservierung.kundennummer == CampingKunde.name)
+        .select(
+            Reservierung.name,
+            Reservierung.modified,
+            Reservierung.kundennummer,
+            Reservierung.abreise,
+            Reservierung.kategorie,
+            CampingKunde.modified.as_("customer_modified"),
+            *[CampingKunde[field] for field in CUSTOMER_FIELDS],
+        )
+        .where(Reservierung.abreise.isnotnull())
+    )
+
+
+def get_rows_of_query(query, now=None):
+    return [
+        get_snapshot_row(row, frappe._dict(row, modified=row.customer_modified), now)
+        for row in query.run(as_dict=1)
+    ]
+
+
+def update_reservation(doc, method=None):
+    """doc_event of Reservierung (on_update): write the snapshot row of the reservation."""
+    frappe.db.delete(SNAPSHOT_DOCTYPE, {"name": doc.name})
+    if not doc.abreise or not doc.kundennummer:
+        return
+
+    customer = frappe.db.get_value("Camping Kunde", doc.kundennummer, ["modified"] + CUSTOMER_FIELDS, as_dict=1)
+    # Like the inner join of the export query, reservations without customer are left out
+    if customer:
+        write_snapshot_rows([get_snapshot_row(doc, customer)])
+
+
+def delete_reservation(doc, method=None):
+    """doc_event of Reservierung (on_trash)."""
+    frappe.db.delete(SNAPSHOT_DOCTYPE, {"name": doc.name})
+
+
+def rename_reservation(doc, method=None, old=None, new=None, merge=False):
+    """doc_event of Reservierung (after_rename)."""
+    frappe.db.delete(SNAPSHOT_DOCTYPE, {"name": old})
+    update_reservation(doc)
+
+
+def refresh_customer(customer_name):
+    """Rewrite the snapshot rows of all reservations of a customer."""
+    frappe.db.delete(SNAPSHOT_DOCTYPE, {"kundennummer": customer_name})
+    Reservierung = DocType("Reservierung")
+    write_snapshot_rows(get_rows_of_query(get_reservation_query().where(Reservierung.kundennummer == customer_name)))
+
+
+def update_customer(doc, method=None):
+    """doc_event of Camping Kunde (on_update): update the rows of its reservations,
+    if one of the copied columns changed (or the customer is new)."""
+    if any(doc.has_value_changed(field) for field in CUSTOMER_FIELDS):
+        refresh_customer(doc.name)
+
+
+def delete_customer(doc, method=None):
+    """doc_event of Camping Kunde (on_trash)."""
+    frappe.db.delete(SNAPSHOT_DOCTYPE, {"kundennummer": doc.name})
+
+
+def rename_customer(doc, method=None, old=None, new=None, merge=False):
+    """doc_event of Camping Kunde (after_rename), the links in Reservierung are already renamed."""
+    frappe.db.delete(SNAPSHOT_DOCTYPE, {"kundennummer": old})
+    refresh_customer(new)
+
+
+def rebuild_snapshot(from_date=None):
+    """Rebuild the snapshot from the live join, for all departures or for those from from_date on.
+
+    Runs in one transaction, so exports reading the snapshot meanwhile see the old rows.
+    Returns the number of written rows.
+    """
+    if from_date:
+        from_date = frappe.utils.getdate(from_date)
+        frappe.db.delete(SNAPSHOT_DOCTYPE, {"departure_date": [">=", from_date]})
+    else:
+        frappe.db.delete(SNAPSHOT_DOCTYPE)
+
+    Reservierung = DocType("Reservierung")
+    now = frappe.utils.now_datetime()
+    last_name = ""
+    number_of_rows = 0
+    while True:
+        # Keyset pagination over the reservation name, every chunk is a short indexed query
+        query = (
+            get_reservation_query()
+            .where(Reservierung.name > last_name)
+            .orderby(Reservierung.name)
+            .limit(REBUILD_CHUNK_SIZE)
+        )
+        if from_date:
+            query = query.where(Reservierung.abreise >= from_date)
+        rows = get_rows_of_query(query, now)
+        if not rows:
+            break
+        # A reservation moved into the range without the hook still has its row with the old departure date
+        frappe.db.delete(SNAPSHOT_DOCTYPE, {"name": ("in", [row[0] for row in rows])})
+        write_snapshot_rows(rows)
+        number_of_rows += len(rows)
+        last_name = rows[-1][0]
+        publish_progress("rows_written", rows=number_of_rows)
+
+    print(f"Departure snapshot rebuilt with {number_of_rows} reservations.")
+    return number_of_rows
+
+
+def check_snapshot(from_date=None, to_date=None):
+    """Compare the snapshot with the live join for the departures from from_date to to_date (inclusive).
+
+    Defaults to CHECK_DAYS before and after today. Returns a dict with the number of
+    checked reservations and the names of the reservations missing in the snapshot,
+    only in the snapshot and with different values (at most MAX_REPORTED each).
+    """
+    today = frappe.utils.getdate()
+    from_date = frappe.utils.getdate(from_date) if from_date else today - datetime.timedelta(days=CHECK_DAYS)
+    to_date = frappe.utils.getdate(to_date) if to_date else today + datetime.timedelta(days=CHECK_DAYS)
+    start = datetime.datetime.combine(from_date, datetime.time.min)
+    end = datetime.datetime.combine(to_date + datetime.timedelta(1), datetime.time.min)
+
+    Reservierung = DocType("Reservierung")
+    live_query = get_reservation_query().where(Reservierung.abreise >= start).where(Reservierung.abreise < end)
+    live = {row.name: tuple(row[field] for field in COMPARED_FIELDS) for row in live_query.run(as_dict=1)}
+
+    snapshot = {
+        row.name: tuple(row[field] for field in COMPARED_FIELDS)
+        for row in frappe.get_all(
+            SNAPSHOT_DOCTYPE,
+            filters={"departure_date": ["between", [from_date, to_date]]},
+            fields=["name"] + COMPARED_FIELDS,
+        )
+    }
+
+    missing = sorted(set(live) - set(snapshot))
+    unexpected = sorted(set(snapshot) - set(live))
+    differing = sorted(name for name in set(live) & set(snapshot) if live[name] != snapshot[name])
+    result = {
+        "from_date": str(from_date),
+        "to_date": str(to_date),
+        "checked": len(live),
+        "consistent": not (missing or unexpected or differing),
+        "missing": missing[:MAX_REPORTED],
+        "unexpected": unexpected[:MAX_REPORTED],
+        "differing": differing[:MAX_REPORTED],
+    }
+    print(
+        f"Departure snapshot {from_date} to {to_date}: {len(live)} reservations, {len(missing)} missing, "
+        f"{len(unexpected)} unexpected, {len(differing)} differing."
+    )
+    return result
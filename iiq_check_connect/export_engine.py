@@ -0,0 +1,748 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""Export engine: runs the export query and writes and attaches the export files.
+
+pandas is only imported by the non-streaming prepare_export, openpyxl and pyarrow
+only by the writers that need them, so importing this module stays cheap.
+
+The writers spool the export file to a temporary file, write_private_file copies
+it into the private files of the site block by block and hashes it on the way, so
+no step after the query holds a whole export file in memory.
+"""
+
+import datetime
+import itertools
+import os
+import frappe
+from frappe.core.api.file import create_new_folder
+from frappe import _
+from iiq_check_connect.content_hash import copy_and_hash
+from iiq_check_connect.data_quality import RecipientCleaner, normalize_email
+from iiq_check_connect.export_writer import EXPORT_COLUMNS, get_export_writer
+from iiq_check_connect.export_query import get_export_query
+from iiq_check_connect.language_mapping import get_language_mapper
+from iiq_check_connect.progress import publish_progress
+from iiq_check_connect.metrics import ExportMetrics
+from iiq_check_connect.export_tracking import get_exported_hashes, record_exported_rows, row_hash
+
+EXPORT_FOLDER = "Home/iiq-check"
+
+# Naming series of iiQ-Check Export, see autoname in its doctype
+EXPORT_NAMING_SERIES = "IIQEXP-.#####"
+
+# Sites whose export folder is known to exist, checked once per process
+_export_folder_sites = set()
+
+# Number of rows fetched from the unbuffered cursor per chunk in streaming mode
+EXPORT_CHUNK_SIZE = 5000
+
+def convert_frappe_dict_to_dict(data):
+    return [dict(item) if isinstance(item, frappe._dict) else item for item in data]
+
+def iter_export_rows(query, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the rows of the export query (a frappe.qb query) in lists of at most chunk_size rows.
+
+    Uses an unbuffered (server side) cursor, so only the current chunk is held in memory.
+    No other query may run on the connection until the generator is exhausted.
+    """
+    with frappe.db.unbuffered_cursor():
+        rows = query.run(as_dict=1, as_iterator=True)
+        rows_fetched = 0
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            rows_fetched += len(chunk)
+            publish_progress("rows_fetched", rows=rows_fetched)
+            yield chunk
+        publish_progress("rows_fetched", force=True, rows=rows_fetched)
+
+def check_filter_settings(settings, interactive=False):
+    """Return False (or throw, if interactive) when no export filter is configured."""
+    if not settings.einheit_kategorie:
+        message = _("No Eingeheit-Kategorie for export selected.")
+        print(message)
+        if interactive: frappe.throw(message)
+        return False
+
+    if not settings.kundentyp:
+        message = _("No Kundentyp selected for export.")
+        print(message)
+        if interactive: frappe.throw(message)
+        return False
+
+    return True
+
+def get_recipient_cleaner(settings):
+    """Return a new RecipientCleaner, or None if cleaning the recipients is disabled."""
+    if settings.clean_recipients:
+        return RecipientCleaner()
+
+def append_export_rows(writer, rows, map_language, departure_at, skip_hashes, hashes, cleaner=None):
+    """Append the rows of the export query to writer, see write_streaming_export.
+
+    Rows whose reservation hash is in skip_hashes are left out, the hashes of all
+    other rows with a valid email are added to hashes.
+    """
+    for row in rows:
+        email = row["email"]
+        if cleaner:
+            email = cleaner.clean_email(email)
+            if not email:
+                continue
+        h = row_hash(row["kundennummer"], row["abreise"])
+        if h in skip_hashes:
+            continue
+        hashes.add(h)
+        if cleaner and cleaner.is_duplicate(email):
+            continue
+        writer.append((
+            row["name"],
+            row["salutation"],
+            email,
+            map_language(row["language"]),
+            departure_at,
+        ))
+
+def write_frame_export(df, export_format=None):
+    """Write the export columns of a DataFrame with the writer of export_format (XLSX by default).
+
+    Every format, XLSX included, goes through the export writers, not through pandas.
+    Returns the file object holding the export.
+    """
+    # Missing values are written as empty cells, as DataFrame.to_excel did
+    columns = df[EXPORT_COLUMNS].astype(object)
+    columns = columns.where(columns.notna(), None)
+    with get_export_writer(export_format)() as writer:
+        writer.write_rows(columns.itertuples(index=False, name=None))
+        return writer.close()
+
+def write_streaming_export(query, map_language, departure_at, chunk_size=EXPORT_CHUNK_SIZE, skip_hashes=None, export_format=None, cleaner=None):
+    """Stream the export query chunk by chunk into the writer of export_format (XLSX by default).
+
+    Reservations whose hash is in skip_hashes are left out. With a RecipientCleaner, rows
+    with invalid emails are dropped and only the first row of every recipient is written.
+    Returns a tuple of the file object holding the workbook, the number of rows written
+    and the set of hashes of the exported reservations (including the merged ones).
+    """
+    skip_hashes = skip_hashes or set()
+    hashes = set()
+    with get_export_writer(export_format)() as writer:
+        for chunk in iter_export_rows(query, chunk_size):
+            append_export_rows(writer, chunk, map_language, departure_at, skip_hashes, hashes, cleaner)
+            publish_progress("rows_written", rows=writer.row_count)
+        publish_progress("rows_written", force=True, rows=writer.row_count)
+        return writer.close(), writer.row_count, hashes
+
+def get_export_filename(departure_date, export_format=None, suffix=""):
+    extension = get_export_writer(export_format).file_extension
+    return f"iiq-check-export-{departure_date}{suffix}.{extension}"
+
+
+def get_export_statistics(number_of_records, created_on, export_format=None, file_size=None, serialization_seconds=None, cleaner=None):
+    statistics = f"Total Records: {number_of_records}\n"
+    statistics += f"Export Date: {created_on.strftime('%Y-%m-%d %H:%M:%S')}\n"
+    statistics += f"Format: {get_export_writer(export_format).file_extension}\n"
+    if file_size is not None:
+        statistics += f"File Size: {file_size} bytes\n"
+    if serialization_seconds is not None:
+        statistics += f"Serialization Time: {serialization_seconds:.3f} s\n"
+    if cleaner:
+        statistics += cleaner.statistics()
+    return statistics
+
+def get_export_start_of_day(settings, current_date=None):
+    """Return the start of the departure day, which is exported on current_date."""
+    # Number of days you want to subtract
+    days_to_subtract = settings.export_days_after_departure
+    current_date = current_date or datetime.datetime.now()
+    return (current_date - datetime.timedelta(days=days_to_subtract)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+@frappe.whitelist()
+def prepare_export(interactive=False, streaming=None):
+    metrics = ExportMetrics()
+    with metrics.stage("settings_load"):
+        settings = frappe.get_single("iiQ-Check Settings")
+    if streaming is None:
+        streaming = settings.streaming_export
+    streaming = frappe.utils.cint(streaming)
+    export_format = settings.export_format or "xlsx"
+    cleaner = get_recipient_cleaner(settings)
+    if not interactive:
+        if not settings.enable_job:
+            message = _("iiQ-Check export is disabled, exiting.")
+            print(message)
+            if interactive: frappe.throw(message)
+            return
+    
+    if not check_filter_settings(settings, interactive):
+        return
+
+    # Current date and time
+    current_date = datetime.datetime.now()
+
+    # Calculated past date at the start of the day
+    start_of_day = get_export_start_of_day(settings, current_date)
+
+    # Imported here, retention imports this module
+    from iiq_check_connect.retention import get_archived_dates
+
+    # Check if an export for the same departure date already exists, or was already archived
+    existing_export = frappe.get_all("iiQ-Check Export", filters={"departure_date": start_of_day.date()}, fields=["name"])
+    if existing_export or get_archived_dates(start_of_day.date(), start_of_day.date()):
+        message = _(f"An export for the departure date {start_of_day.date()} already exists. Aborting the operation.")
+        print(message)
+        if interactive: frappe.throw(message)
+        return
+
+    # End of that day
+    end_of_day = start_of_day + datetime.timedelta(1)
+
+    if settings.shard_export_by:
+        # Imported here, export_shards imports this module
+        from iiq_check_connect.export_shards import prepare_sharded_export
+        return prepare_sharded_export(settings, start_of_day, end_of_day, current_date, interactive, metrics)
+
+    query = get_export_query(settings, start_of_day, end_of_day)
+
+    # Mapping of country codes to the language strings, with fallback to the default language
+    map_language = get_language_mapper(settings)
+
+    if streaming:
+        # Rows are fetched and written chunk by chunk, the full result set is never held in memory,
+        # so SQL, language mapping and serialization are timed as one stage
+        with metrics.stage("streaming_export") as stage:
+            output, number_of_records, hashes = write_streaming_export(
+                query, map_language, start_of_day.strftime('%Y-%m-%d'), export_format=export_format, cleaner=cleaner
+            )
+            stage["row_count"] = number_of_records
+        serialization_seconds = stage["seconds"]
+    else:
+        with metrics.stage("sql") as stage:
+            data = query.run(as_dict=1)
+            stage["row_count"] = len(data)
+        publish_progress("rows_fetched", force=True, rows=len(data))
+
+        # pandas is only needed here, importing it costs more than the rest of the app
+        import pandas as pd
+
+        # Convert frappe._dict to regular dict
+        with metrics.stage("row_conversion", row_count=len(data)):
+            data = convert_frappe_dict_to_dict(data)
+            df = pd.DataFrame(data)
+
+        # Drop invalid emails and merge the rows of the same recipient, before any further work is done on them
+        exported_rows = df
+        if cleaner:
+            with metrics.stage("data_quality", row_count=len(df)) as stage:
+                df, exported_rows = cleaner.clean_frame(df)
+                stage["row_count"] = len(df)
+        hashes = {row_hash(k, a) for k, a in zip(exported_rows.get("kundennummer", []), exported_rows.get("abreise", []))}
+        number_of_records = len(df)
+
+    # Check if data is not empty and is in the correct format
+    if not number_of_records:
+        message = _("No data returned from the query. Seems like there are no departures for the configured filter, or the import from Compusoft is not working correctly.")
+        print(message)
+        if interactive: frappe.throw(message)
+        return
+
+    # Debug print to inspect data format
+    message = f"Query returned {number_of_records} records."
+    print(message)
+    if interactive: frappe.msgprint(message)
+
+    try:
+        if not streaming:
+            with metrics.stage("language_mapping", row_count=number_of_records):
+                # Map the "language" column in one vectorized operation
+                df["language"] = map_language.map_series(df["language"])
+
+                # Add departure_at column using start_date_str
+                df["departure_at"] = start_of_day.strftime('%Y-%m-%d')
+
+            # Serialize the DataFrame in the configured format
+            with metrics.stage(f"{export_format}_serialization", row_count=number_of_records) as stage:
+                output = write_frame_export(df, export_format)
+            serialization_seconds = stage["seconds"]
+            publish_progress("rows_written", force=True, rows=number_of_records)
+
+        message = "Query executed successfully. Data saved to a spooled temporary file."
+        print(message)
+        if interactive: frappe.msgprint(message)
+
+        with output:
+            # Generate statistics
+            statistics = get_export_statistics(number_of_records, current_date, export_format, get_file_size(output), serialization_seconds, cleaner)
+
+            # Create the "iiQ-Check Export" document with the file already attached, in a single insert
+            filename = get_export_filename(start_of_day.date(), export_format)
+            export_name = create_export_document(
+                start_of_day.date(),
+                output,
+                number_of_records,
+                current_date,
+                export_format,
+                filename=filename,
+                statistics=statistics,
+                metrics=metrics,
+            )
+        record_exported_rows(export_name, start_of_day.date(), hashes)
+        message = f"File {filename} attached to iiQ-Check Export document {export_name} in folder {EXPORT_FOLDER}"
+        print(message)
+        if interactive: frappe.msgprint(message)
+
+        # Link to the new export document
+        export_link = frappe.utils.get_url_to_form("iiQ-Check Export", export_name)
+        message = f"Export completed successfully. You can access the export document <a href='{export_link}'>here</a>."
+        print(message)
+        if interactive: frappe.msgprint(message)
+        return export_name
+
+    except Exception as e:
+        # create_export_document deletes the File again if the insert fails, the export can simply be run again
+        message = f"Error converting data to DataFrame, saving to Excel, or attaching file: {e}"
+        print(message)
+        if interactive: frappe.throw(message)
+        raise e
+
+
+def get_missing_dates(from_date, to_date, existing_dates):
+    """Return the dates from from_date to to_date (inclusive), which are not in existing_dates."""
+    number_of_days = (to_date - from_date).days + 1
+    all_dates = [from_date + datetime.timedelta(days=i) for i in range(number_of_days)]
+    return [d for d in all_dates if d not in existing_dates]
+
+
+def split_export_rows(chunks, wanted_dates, export_writer, map_language, new_cleaner):
+    """Split the rows of a range export query up by departure date, in one pass.
+
+    Every date in wanted_dates with at least one valid row gets its own writer
+    (an instance of export_writer), cleaner (from new_cleaner, which may return None)
+    and set of reservation hashes; rows of other dates are ignored.
+    Returns the three dicts writers, cleaners and hashes, keyed by departure date.
+    """
+    writers = {}
+    cleaners = {}
+    hashes = {}
+    try:
+        for chunk in chunks:
+            for row in chunk:
+                departure_date = row["departure_date"]
+                if departure_date not in wanted_dates:
+                    continue
+                email = row["email"]
+                if departure_date not in cleaners:
+                    cleaners[departure_date] = new_cleaner()
+                cleaner = cleaners[departure_date]
+                if cleaner:
+                    email = cleaner.clean_email(email)
+                    if not email:
+                        continue
+                writer = writers.get(departure_date)
+                if writer is None:
+                    writer = writers[departure_date] = export_writer()
+                    hashes[departure_date] = set()
+                hashes[departure_date].add(row_hash(row["kundennummer"], row["abreise"]))
+                if cleaner and cleaner.is_duplicate(email):
+                    continue
+                writer.append((
+                    row["name"],
+                    row["salutation"],
+                    email,
+                    map_language(row["language"]),
+                    departure_date.strftime('%Y-%m-%d'),
+                ))
+    except Exception:
+        for writer in writers.values():
+            writer.discard()
+        raise
+    return writers, cleaners, hashes
+
+
+@frappe.whitelist()
+def backfill_export(from_date, to_date, interactive=False):
+    """Create the missing exports for all departure dates from from_date to to_date (inclusive).
+
+    All missing days are fetched with a single range query, the rows are split up
+    by departure date in one pass and written into one file per day.
+    Returns the names of the created iiQ-Check Export documents.
+    """
+    settings = frappe.get_single("iiQ-Check Settings")
+    if not check_filter_settings(settings, interactive):
+        return []
+
+    from_date = frappe.utils.getdate(from_date)
+    to_date = frappe.utils.getdate(to_date)
+    if from_date > to_date:
+        frappe.throw(_("The start date of the backfill must not be after its end date."))
+
+    # Find all dates in the range, which do not have an export yet
+    existing_dates = set(frappe.get_all(
+        "iiQ-Check Export",
+        filters={"departure_date": ["between", [from_date, to_date]]},
+        pluck="departure_date"
+    ))
+    # Archived exports were deleted, their dates must not be exported and uploaded again
+    from iiq_check_connect.retention import get_archived_dates
+    existing_dates |= get_archived_dates(from_date, to_date)
+    missing_dates = get_missing_dates(from_date, to_date, existing_dates)
+
+    if not missing_dates:
+        message = _(f"Exports for all departure dates from {from_date} to {to_date} already exist.")
+        print(message)
+        if interactive: frappe.msgprint(message)
+        return []
+
+    # One query over the span of the missing dates
+    start_of_range = datetime.datetime.combine(missing_dates[0], datetime.time.min)
+    end_of_range = datetime.datetime.combine(missing_dates[-1] + datetime.timedelta(1), datetime.time.min)
+    query = get_export_query(settings, start_of_range, end_of_range, with_departure_date=True)
+
+    map_language = get_language_mapper(settings)
+    export_writer = get_export_writer(settings.export_format)
+
+    writers, cleaners, hashes = split_export_rows(
+        iter_export_rows(query), set(missing_dates), export_writer, map_language,
+        lambda: get_recipient_cleaner(settings),
+    )
+
+    current_date = datetime.datetime.now()
+    exports = []
+    for departure_date in missing_dates:
+        writer = writers.get(departure_date)
+        if writer is None:
+            print(f"No departures for {departure_date}, skipping.")
+            continue
+
+        export_file = writer.close()
+        exports.append(frappe._dict(
+            departure_date=departure_date,
+            export_file=export_file,
+            number_of_records=writer.row_count,
+            statistics=get_export_statistics(
+                writer.row_count, current_date, settings.export_format, get_file_size(export_file), cleaner=cleaners[departure_date]
+            ),
+        ))
+
+    # All exports of the backfill are inserted with one bulk insert
+    try:
+        created_exports = create_export_documents(exports, current_date, settings.export_format)
+    finally:
+        for export in exports:
+            export.export_file.close()
+    for export_name, export in zip(created_exports, exports):
+        record_exported_rows(export_name, export.departure_date, hashes[export.departure_date])
+
+    message = f"Backfill created {len(created_exports)} exports for {len(missing_dates)} missing departure dates from {from_date} to {to_date}."
+    print(message)
+    if interactive: frappe.msgprint(message)
+    return created_exports
+
+
+@frappe.whitelist()
+def get_exported_emails(settings, start_of_day, end_of_day, exported_hashes):
+    """Return the normalized emails of the reservations of the day, whose hash is in exported_hashes."""
+    return {
+        normalize_email(row.email)
+        for row in get_export_query(settings, start_of_day, end_of_day).run(as_dict=1)
+        if row_hash(row.kundennummer, row.abreise) in exported_hashes
+    }
+
+
+def prepare_incremental_export(departure_date=None, interactive=False):
+    """Export the recipients of departure_date, which were not part of an earlier export.
+
+    Only reservations or customers modified since the last successful export of that
+    date are queried. Already exported reservations are skipped by their hash, so the
+    new iiQ-Check Export document only contains the delta. With clean_recipients, the
+    recipients of the earlier exports of the day are skipped as well. If there is no successful
+    export yet (e.g. the run was aborted), the whole day is exported.
+    Returns the name of the new export, or None if there is nothing new.
+    """
+    settings = frappe.get_single("iiQ-Check Settings")
+    if not check_filter_settings(settings, interactive):
+        return
+
+    current_date = datetime.datetime.now()
+    if departure_date:
+        start_of_day = datetime.datetime.combine(frappe.utils.getdate(departure_date), datetime.time.min)
+    else:
+        start_of_day = get_export_start_of_day(settings, current_date)
+    end_of_day = start_of_day + datetime.timedelta(1)
+
+    # The creation time of the last export is the watermark, everything changed later may be new
+    previous_exports = frappe.get_all(
+        "iiQ-Check Export",
+        filters={"departure_date": start_of_day.date(), "status": "exported"},
+        fields=["max(created_on) as watermark"],
+    )
+    watermark = previous_exports[0].watermark if previous_exports else None
+    exported_hashes = get_exported_hashes(start_of_day.date())
+
+    query = get_export_query(settings, start_of_day, end_of_day, modified_since=watermark)
+    cleaner = get_recipient_cleaner(settings)
+    if cleaner and exported_hashes:
+        # A guest with a new reservation was already sent today under the earlier one
+        cleaner.add_exported(get_exported_emails(settings, start_of_day, end_of_day, exported_hashes))
+    output, number_of_records, hashes = write_streaming_export(
+        query,
+        get_language_mapper(settings),
+        start_of_day.strftime('%Y-%m-%d'),
+        skip_hashes=exported_hashes,
+        export_format=settings.export_format,
+        cleaner=cleaner,
+    )
+
+    if not number_of_records:
+        output.close()
+        message = _(f"No new recipients for the departure date {start_of_day.date()} since {watermark}.")
+        print(message)
+        if interactive: frappe.msgprint(message)
+        return
+
+    with output:
+        export_name = create_export_document(
+            start_of_day.date(),
+            output,
+            number_of_records,
+            current_date,
+            settings.export_format,
+            filename=get_export_filename(start_of_day.date(), settings.export_format, f"-delta-{current_date.strftime('%H%M%S')}") if watermark else None,
+            statistics=get_export_statistics(number_of_records, current_date, settings.export_format, get_file_size(output), cleaner=cleaner),
+            is_delta=1 if watermark else 0,
+            delta_since=watermark,
+        )
+    record_exported_rows(export_name, start_of_day.date(), hashes)
+
+    message = f"Incremental export {export_name} created with {number_of_records} new recipients."
+    print(message)
+    if interactive: frappe.msgprint(message)
+    return export_name
+
+
+def ensure_export_folder():
+    """Create the "iiq-check" folder if it does not exist yet.
+
+    The lookup is done once per site and process, later calls return right away.
+    """
+    site = frappe.local.site
+    if site in _export_folder_sites:
+        return
+
+    if frappe.db.exists("File", {"file_name": "iiq-check", "folder": "Home"}):
+        _export_folder_sites.add(site)
+        return
+
+    create_new_folder("iiq-check", "Home")
+    print(f"Folder '{EXPORT_FOLDER}' created.")
+    # Only remember the folder once it is committed, a rollback would remove it again
+    frappe.db.after_commit.add(lambda: _export_folder_sites.add(site))
+
+
+def create_export_document(departure_date, export_file, number_of_records, created_on, export_format=None, filename=None, statistics=None, metrics=None, **fields):
+    """Create an iiQ-Check Export document and attach the file object export_file to it.
+
+    The name is taken from the naming series first, so the file can be attached before
+    the document is inserted with the file linked and its final status, in a single
+    insert without a second save. If the insert fails, the File is deleted again.
+    Stage metrics are added to the document, if given.
+    Additional fields of the export document can be passed as keyword arguments.
+    """
+    ensure_export_folder()
+
+    new_doc = frappe.get_doc({
+        "doctype": "iiQ-Check Export",
+        "created_on": created_on,
+        "departure_date": departure_date,
+        "number_of_recipients": number_of_records,
+        "status": "exported",
+        "statistics": statistics or get_export_statistics(number_of_records, created_on, export_format, get_file_size(export_file)),
+        **fields
+    })
+    new_doc.set_new_name()
+
+    stage_metrics = metrics or ExportMetrics()
+    with stage_metrics.stage("save_file") as stage:
+        file_doc = attach_export_file(new_doc, filename or get_export_filename(departure_date, export_format), export_file)
+        stage["byte_count"] = file_doc.file_size
+    new_doc.xlsx_file = file_doc.file_url
+
+    if metrics:
+        metrics.add_to(new_doc)
+    try:
+        new_doc.insert()
+    except Exception:
+        # Otherwise the commit of the caller (e.g. the hourly job) keeps a File without export
+        delete_export_files([file_doc.name])
+        raise
+    print(f"New iiQ-Check Export document created: {new_doc.name}")
+    return new_doc.name
+
+
+def delete_export_files(file_names):
+    """Delete the File documents (and their content) of an export document which was not inserted."""
+    for file_name in file_names:
+        frappe.delete_doc("File", file_name, ignore_permissions=True, force=True)
+
+
+def reserve_export_names(count):
+    """Take count names from the naming series of iiQ-Check Export with one update."""
+    prefix = EXPORT_NAMING_SERIES.split(".", 1)[0]
+    digits = EXPORT_NAMING_SERIES.count("#")
+
+    current = frappe.db.sql("SELECT `current` FROM `tabSeries` WHERE `name` = %s FOR UPDATE", prefix)
+    if current:
+        current = current[0][0] or 0
+        frappe.db.sql("UPDATE `tabSeries` SET `current` = `current` + %s WHERE `name` = %s", (count, prefix))
+    else:
+        current = 0
+        frappe.db.sql("INSERT INTO `tabSeries` (`name`, `current`) VALUES (%s, %s)", (prefix, count))
+
+    return [f"{prefix}{number:0{digits}d}" for number in range(current + 1, current + count + 1)]
+
+
+def create_export_documents(exports, created_on, export_format=None):
+    """Create many iiQ-Check Export documents with their files in one go, e.g. for a backfill.
+
+    exports is a list of dicts with departure_date, export_file (a file object) and number_of_records,
+    optionally filename and statistics. The files are written to disk one by one, the File and export
+    rows are then inserted with one bulk insert per table. This skips the controllers,
+    so it is only meant for freshly generated exports. If writing or inserting fails,
+    the files and rows written so far are removed before the error is raised.
+    Returns the names of the created exports, in the order of exports.
+    """
+    if not exports:
+        return []
+
+    ensure_export_folder()
+    export_names = reserve_export_names(len(exports))
+    now = frappe.utils.now_datetime()
+    user = frappe.session.user
+
+    file_rows = []
+    export_rows = []
+    written = []
+    try:
+        for export_name, export in zip(export_names, exports):
+            file_doc = write_private_file(
+                export["export_file"], export.get("filename") or get_export_filename(export["departure_date"], export_format)
+            )
+            file_rows.append((
+                frappe.generate_hash(length=10), now, now, user, user,
+                file_doc.file_name, file_doc.file_url, file_doc.file_size, file_doc.content_hash,
+                1, 0, EXPORT_FOLDER, "iiQ-Check Export", export_name, "xlsx_file",
+            ))
+            export_rows.append((
+                export_name, now, now, user, user,
+                created_on, export["departure_date"], export["number_of_records"], "exported",
+                export.get("statistics") or get_export_statistics(export["number_of_records"], created_on, export_format, file_doc.file_size),
+                file_doc.file_url, file_doc.sha256,
+            ))
+
+        frappe.db.bulk_insert(
+            "File",
+            ["name", "creation", "modified", "owner", "modified_by",
+             "file_name", "file_url", "file_size", "content_hash",
+             "is_private", "is_folder", "folder", "attached_to_doctype", "attached_to_name", "attached_to_field"],
+            file_rows,
+        )
+        frappe.db.bulk_insert(
+            "iiQ-Check Export",
+            ["name", "creation", "modified", "owner", "modified_by",
+             "created_on", "departure_date", "number_of_recipients", "status",
+             "statistics", "xlsx_file", "content_hash"],
+            export_rows,
+        )
+    except Exception:
+        # Without a rollback by the caller, the files and the rows inserted so far would stay behind
+        remove_private_files(written)
+        if file_rows:
+            frappe.db.delete("File", {"name": ("in", [row[0] for row in file_rows])})
+        frappe.db.delete("iiQ-Check Export", {"name": ("in", export_names)})
+        raise
+
+    print(f"{len(export_names)} iiQ-Check Export documents created: {', '.join(export_names)}")
+    return export_names
+
+
+def get_file_size(f):
+    """Return the size of the file object f, positioned at its start."""
+    size = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    return size
+
+
+def get_private_file_name(filename):
+    """Return filename, with a random suffix if a private file of that name exists already."""
+    if not os.path.exists(frappe.get_site_path("private", "files", filename)):
+        return filename
+    # Split at the first dot, to keep extensions like .csv.gz
+    stem, dot, extension = filename.partition(".")
+    return f"{stem}-{frappe.generate_hash(length=6)}{dot}{extension}"
+
+
+def remove_private_files(file_docs):
+    """Remove the files written by write_private_file."""
+    for file_doc in file_docs:
+        path = frappe.get_site_path("private", "files", file_doc.file_name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def write_private_file(export_file, filename):
+    """Copy the file object export_file into the private files of the site, block by block.
+
+    The content is hashed while it is copied, so an export is never held in memory
+    as a whole. Returns a dict with file_name, file_url, file_size, content_hash (MD5,
+    as recorded by File) and sha256 (the content hash of the export). The file is
+    removed again if the transaction is rolled back.
+    """
+    file_name = get_private_file_name(filename)
+    path = frappe.get_site_path("private", "files", file_name)
+    export_file.seek(0)
+    with open(path, "wb") as f:
+        file_size, sha256, md5 = copy_and_hash(export_file, f)
+
+    written = frappe._dict(
+        file_name=file_name,
+        file_url=f"/private/files/{file_name}",
+        file_size=file_size,
+        content_hash=md5,
+        sha256=sha256,
+    )
+    frappe.db.after_rollback.add(lambda: remove_private_files([written]))
+    return written
+
+
+def insert_export_file(export_name, export_file, filename):
+    """Write export_file with write_private_file and insert its File, attached to the iiQ-Check Export export_name.
+
+    The File is inserted without its controller, which would read the whole file
+    into memory to hash it again. Returns the File document, with sha256 set.
+    """
+    written = write_private_file(export_file, filename)
+    file_doc = frappe.get_doc({
+        "doctype": "File",
+        "file_name": written.file_name,
+        "file_url": written.file_url,
+        "file_size": written.file_size,
+        "content_hash": written.content_hash,
+        "is_private": 1,
+        "folder": EXPORT_FOLDER,
+        "attached_to_doctype": "iiQ-Check Export",
+        "attached_to_name": export_name,
+        "owner": frappe.session.user,
+    })
+    file_doc.name = frappe.generate_hash(length=10)
+    file_doc.db_insert()
+    file_doc.sha256 = written.sha256
+    return file_doc
+
+
+def attach_export_file(export_doc, filename, export_file):
+    """Attach the file object export_file to export_doc in the "iiq-check" folder and record its content hash."""
+    file_doc = insert_export_file(export_doc.name, export_file, filename)
+    export_doc.content_hash = file_doc.sha256
+    return file_doc
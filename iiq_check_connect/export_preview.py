@@ -0,0 +1,204 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""Dry run of the export, to check the filters and the language mapping of the iiQ-Check Settings.
+
+Only aggregates (COUNT / GROUP BY) and a small sample are queried. With clean_recipients,
+the cleaning of the export file is counted in SQL as well: an email is valid if its
+trimmed lower case form matches EMAIL_PATTERN (REGEXP), and recipients are the distinct
+valid emails per departure date. No file and no iiQ-Check Export document is written, so a preview never blocks the
+next real export.
+"""
+
+import datetime
+import time
+
+import frappe
+from frappe import _
+from frappe.query_builder.functions import Concat, Count, Lower, Trim
+
+from iiq_check_connect.data_quality import EMAIL_PATTERN
+from iiq_check_connect.export_engine import check_filter_settings, get_export_start_of_day, get_recipient_cleaner
+from iiq_check_connect.export_query import (
+    EXPORT_ROW_COLUMNS,
+    get_export_query,
+    get_export_source,
+    get_export_summary_query,
+)
+from iiq_check_connect.language_mapping import get_language_mapper
+
+# The preview returns personal data of the sample rows
+PREVIEW_ROLES = ("System Manager", "iiQ-Check Admin")
+
+SAMPLE_SIZE = 10
+MAX_SAMPLE_SIZE = 100
+
+
+def count_by(counts, key, row_count):
+    counts[key] = counts.get(key, 0) + row_count
+
+
+def sorted_counts(counts):
+    """Return the counts as dict, largest first."""
+    return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True))
+
+
+def get_sample_row(row, map_language):
+    return {
+        "name": row.name,
+        "salutation": row.salutation,
+        "email": row.email,
+        "language": map_language(row.language),
+        "departure": str(row.abreise),
+    }
+
+
+def get_summary(settings, start_of_range, end_of_range):
+    """Return the row counts per (kategorie, kundentyp, land) with one GROUP BY query."""
+    return [
+        (row.kategorie, row.kundentyp, row.land, row.row_count)
+        for row in get_export_summary_query(settings, start_of_range, end_of_range).run(as_dict=1)
+    ]
+
+
+def get_cleaned_source(settings, start_of_range, end_of_range):
+    """Return the query of the rows with a valid email, the normalized email and the recipient key.
+
+    The recipient key (departure date and normalized email) identifies a row of the
+    cleaned export, as every day is exported and deduplicated on its own.
+    """
+    query, fields = get_export_source(settings, start_of_range, end_of_range)
+    email = Lower(Trim(fields["email"]))
+    query = query.where(email.regexp(f"^(?:{EMAIL_PATTERN})$"))
+    return query, fields, email, Concat(fields["departure_date"], " ", email)
+
+
+def get_cleaned_summary(settings, start_of_range, end_of_range, map_language, sample_size):
+    """Return the row counts like get_summary, but of the rows left after the recipient cleaning.
+
+    Counted in SQL like get_summary, a recipient leaving with reservations of two
+    groups (e.g. two Einheit-Kategorien) on one day is counted in both groups, the
+    totals count it once. Returns the summary, a dict of the totals (total_rows,
+    distinct_emails, invalid_emails_dropped, duplicate_recipients_merged) and the sample.
+    """
+    query, fields = get_export_source(settings, start_of_range, end_of_range)
+    all_rows = query.select(Count("*").as_("row_count")).run(as_dict=1)[0].row_count
+
+    # The query builder copies the query on every call, valid_query is reused below
+    valid_query, fields, email, recipient = get_cleaned_source(settings, start_of_range, end_of_range)
+    valid = valid_query.select(
+        Count("*").as_("row_count"),
+        Count(email).distinct().as_("emails"),
+        Count(recipient).distinct().as_("recipients"),
+    ).run(as_dict=1)[0]
+
+    summary = [
+        (row.kategorie, row.kundentyp, row.land, row.row_count)
+        for row in valid_query.select(
+            fields["kategorie"].as_("kategorie"),
+            fields["kundentyp"].as_("kundentyp"),
+            fields["language"].as_("land"),
+            Count(recipient).distinct().as_("row_count"),
+        )
+        .groupby(fields["kategorie"], fields["kundentyp"], fields["language"])
+        .run(as_dict=1)
+    ]
+
+    totals = {
+        "total_rows": valid.recipients,
+        "distinct_emails": valid.emails,
+        "invalid_emails_dropped": all_rows - valid.row_count,
+        "duplicate_recipients_merged": valid.row_count - valid.recipients,
+    }
+
+    sample = []
+    if sample_size and valid.recipients:
+        sample_query = valid_query.select(
+            *(fields[column].as_(column) for column in EXPORT_ROW_COLUMNS),
+            fields["departure_date"].as_("departure_date"),
+        ).limit(sample_size)
+        cleaners = {}
+        for row in sample_query.run(as_dict=1):
+            cleaner = cleaners.setdefault(row.departure_date, get_recipient_cleaner(settings))
+            row.email = cleaner.clean_email(row.email)
+            if row.email and not cleaner.is_duplicate(row.email):
+                sample.append(get_sample_row(row, map_language))
+
+    return summary, totals, sample
+
+
+@frappe.whitelist()
+def preview_export(from_date=None, to_date=None, sample_size=SAMPLE_SIZE):
+    """Preview the export of the departures from from_date to to_date (inclusive).
+
+    from_date defaults to the departure date of the next export, to_date to from_date.
+    Returns the number of rows per kategorie, kundentyp and mapped language, how many
+    rows fall back to the default language (and their countries), the number of
+    distinct email addresses, the dates which already have an export and a sample of
+    at most sample_size rows as they would be written. With clean_recipients in the
+    settings, all of them are computed after the cleaning, like the export file.
+    """
+    frappe.only_for(PREVIEW_ROLES)
+    start = time.perf_counter()
+
+    settings = frappe.get_single("iiQ-Check Settings")
+    check_filter_settings(settings, interactive=True)
+
+    from_date = frappe.utils.getdate(from_date) if from_date else get_export_start_of_day(settings).date()
+    to_date = frappe.utils.getdate(to_date) if to_date else from_date
+    if from_date > to_date:
+        frappe.throw(_("The start date of the preview must not be after its end date."))
+    start_of_range = datetime.datetime.combine(from_date, datetime.time.min)
+    end_of_range = datetime.datetime.combine(to_date + datetime.timedelta(1), datetime.time.min)
+
+    map_language = get_language_mapper(settings)
+    sample_size = max(min(frappe.utils.cint(sample_size), MAX_SAMPLE_SIZE), 0)
+    totals = {}
+    if settings.clean_recipients:
+        summary, totals, sample = get_cleaned_summary(settings, start_of_range, end_of_range, map_language, sample_size)
+    else:
+        summary = get_summary(settings, start_of_range, end_of_range)
+        query, fields = get_export_source(settings, start_of_range, end_of_range)
+        totals["distinct_emails"] = query.select(Count(fields["email"]).distinct().as_("emails")).run(as_dict=1)[0].emails
+        sample = []
+        if sample_size and summary:
+            sample_query = get_export_query(settings, start_of_range, end_of_range).limit(sample_size)
+            sample = [get_sample_row(row, map_language) for row in sample_query.run(as_dict=1)]
+
+    per_category = {}
+    per_kundentyp = {}
+    per_language = {}
+    fallback_countries = {}
+    total_rows = 0
+    for kategorie, kundentyp, land, row_count in summary:
+        total_rows += row_count
+        count_by(per_category, kategorie, row_count)
+        count_by(per_kundentyp, kundentyp, row_count)
+        count_by(per_language, map_language(land), row_count)
+        if land not in map_language.mapping:
+            count_by(fallback_countries, land or "", row_count)
+
+    existing_exports = frappe.get_all(
+        "iiQ-Check Export",
+        filters={"departure_date": ["between", [from_date, to_date]]},
+        pluck="departure_date",
+        distinct=True,
+    )
+
+    return {
+        "from_date": str(from_date),
+        "to_date": str(to_date),
+        "total_rows": totals.get("total_rows", total_rows),
+        "distinct_emails": totals["distinct_emails"],
+        "invalid_emails_dropped": totals.get("invalid_emails_dropped", 0),
+        "duplicate_recipients_merged": totals.get("duplicate_recipients_merged", 0),
+        "per_category": sorted_counts(per_category),
+        "per_kundentyp": sorted_counts(per_kundentyp),
+        "per_language": sorted_counts(per_language),
+        "default_language": map_language.default_language,
+        "default_language_fallback": sum(fallback_countries.values()),
+        "fallback_countries": sorted_counts(fallback_countries),
+        "existing_exports": sorted(str(d) for d in existing_exports),
+        "sample": sample,
+        "milliseconds": round((time.perf_counter() - start) * 1000, 1),
+    }
@@ -0,0 +1,209 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import datetime
+
+import frappe
+from frappe.query_builder import DocType
+from frappe.query_builder.functions import Count, Date
+from pypika.terms import ValueWrapper
+
+from iiq_check_connect.departure_snapshot import SNAPSHOT_DOCTYPE
+
+# Indexes the export query relies on, as (doctype, fields, index_name)
+EXPORT_INDEXES = [
+    ("Reservierung", ["abreise", "kategorie", "kundennummer"], "iiq_check_abreise_kategorie_kundennummer"),
+    ("Camping Kunde", ["kundentyp"], "iiq_check_kundentyp"),
+]
+
+# Columns of every row of the export query
+EXPORT_ROW_COLUMNS = ["name", "salutation", "email", "language", "kundennummer", "abreise"]
+
+# Language shard of the countries without mapping, if there is no default language
+UNMAPPED_SHARD = "unmapped"
+
+# Condition of a shard which selects no rows
+NO_ROWS = ValueWrapper(1) == ValueWrapper(0)
+
+
+def get_filter_values(settings):
+    """Return the configured einheit_kategorie and kundentyp values as lists."""
+    einheit_kategorie_list = [ek.einheit_kategorie for ek in settings.einheit_kategorie]
+    kundentyp_list = [kt.kundentyp for kt in settings.kundentyp]
+    return einheit_kategorie_list, kundentyp_list
+
+
+def get_shard_condition(settings, fields, shard_by, shard):
+    """Return the condition selecting the rows of one shard of a sharded export, None for all rows.
+
+    shard_by "category" selects the rows of the einheit_kategorie shard, "language"
+    the rows whose country (land) is mapped to the language string shard, with the
+    mapping of LanguageMapper (the last row of a duplicated country code wins). The
+    shard of the default language, or UNMAPPED_SHARD without one, also holds all
+    countries without mapping, so every row belongs to exactly one language shard.
+    A shard without any country selects no rows.
+    """
+    if shard_by == "category":
+        return fields["kategorie"] == shard
+
+    language = fields["language"]
+    mapping = {m.country_code: m.language_string for m in settings.language_mapping}
+    countries = [country for country, mapped in mapping.items() if mapped == shard and country is not None]
+
+    conditions = []
+    if countries:
+        conditions.append(language.isin(countries))
+    if None in mapping and mapping[None] == shard:
+        # A mapping row without country code maps the customers without land
+        conditions.append(language.isnull())
+    if shard == (settings.default_language or UNMAPPED_SHARD):
+        if not mapping:
+            return None
+        mapped_countries = [country for country in mapping if country is not None]
+        if mapped_countries:
+            # NOT IN is NULL for a NULL land, those rows are added below
+            conditions.append(language.notin(mapped_countries))
+        if None not in mapping:
+            conditions.append(language.isnull())
+
+    if not conditions:
+        return NO_ROWS
+    condition = conditions[0]
+    for other in conditions[1:]:
+        condition = condition | other
+    return condition
+
+
+def get_export_source(settings, start_of_day, end_of_day, modified_since=None, shard_by=None, shard=None):
+    """Build the filtered rows of the export for all departures in [start_of_day, end_of_day).
+
+    Returns a frappe.qb query without selected columns and a dict of the fields
+    of a row (name, salutation, email, language, kundennummer, abreise,
+    departure_date, kategorie, kundentyp). The rows come from the join of
+    Reservierung and Camping Kunde, or with use_departure_snapshot in the
+    settings from the iiQ-Check Departure Snapshot. With shard_by, only the
+    rows of the given shard are selected, see get_shard_condition.
+    """
+    einheit_kategorie_list, kundentyp_list = get_filter_values(settings)
+
+    if settings.get("use_departure_snapshot"):
+        Snapshot = DocType(SNAPSHOT_DOCTYPE)
+        fields = {
+            "name": Snapshot.nachname,
+            "salutation": Snapshot.anrede,
+            "email": Snapshot.email,
+            "language": Snapshot.land,
+            "kundennummer": Snapshot.kundennummer,
+            "abreise": Snapshot.abreise,
+            "departure_date": Snapshot.departure_date,
+            "kategorie": Snapshot.kategorie,
+            "kundentyp": Snapshot.kundentyp,
+        }
+        # departure_date selects the days over its index, abreise the exact range below
+        first_date = start_of_day.date()
+        last_date = (end_of_day - datetime.timedelta(microseconds=1)).date()
+        query = frappe.qb.from_(Snapshot).where(Snapshot.departure_date.between(first_date, last_date))
+        # modified of a snapshot row is the latest change of the reservation or its customer
+        modified_fields = [Snapshot.modified]
+    else:
+        Reservierung = DocType("Reservierung")
+        CampingKunde = DocType("Camping Kunde")
+        fields = {
+            "name": CampingKunde.nachname,
+            "salutation": CampingKunde.anrede,
+            "email": CampingKunde.email,
+            "language": CampingKunde.land,
+            "kundennummer": Reservierung.kundennummer,
+            "abreise": Reservierung.abreise,
+            "departure_date": Date(Reservierung.abreise),
+            "kategorie": Reservierung.kategorie,
+            "kundentyp": CampingKunde.kundentyp,
+        }
+        query = (
+            frappe.qb.from_(Reservierung)
+            .inner_join(CampingKunde)
+            .on(Reservierung.kundennummer == CampingKunde.name)
+        )
+        modified_fields = [Reservierung.modified, CampingKunde.modified]
+
+    query = (
+        query.where(fields["abreise"] >= start_of_day)
+        .where(fields["abreise"] < end_of_day)
+        .where(fields["kategorie"].isin(einheit_kategorie_list))
+        .where(fields["kundentyp"].isin(kundentyp_list))
+        # email != '' also excludes NULL values
+        .where(fields["email"] != "")
+    )
+
+    if modified_since:
+        changed = modified_fields[0] > modified_since
+        for field in modified_fields[1:]:
+            changed = changed | (field > modified_since)
+        query = query.where(changed)
+
+    if shard_by:
+        condition = get_shard_condition(settings, fields, shard_by, shard)
+        if condition is not None:
+            query = query.where(condition)
+
+    return query, fields
+
+
+def get_export_query(settings, start_of_day, end_of_day, with_departure_date=False, modified_since=None, shard_by=None, shard=None):
+    """Build the export query for all departures in [start_of_day, end_of_day).
+
+    Returns a frappe.qb query, all filter values are passed as bound parameters
+    when it is run. Besides the sheet columns every row carries kundennummer and
+    abreise, which identify the exported reservation. With with_departure_date,
+    every row carries its departure date, so a query spanning several days can be
+    split up by date. With modified_since, only reservations or customers changed
+    after that point in time are returned. With shard_by, only the rows of one
+    shard are returned.
+    """
+    query, fields = get_export_source(settings, start_of_day, end_of_day, modified_since, shard_by, shard)
+    query = query.select(*(fields[column].as_(column) for column in EXPORT_ROW_COLUMNS))
+
+    if with_departure_date:
+        query = query.select(fields["departure_date"].as_("departure_date"))
+
+    return query
+
+
+def get_export_summary_query(settings, start_of_day, end_of_day):
+    """Build a query counting the export rows per kategorie, kundentyp and country (land)."""
+    query, fields = get_export_source(settings, start_of_day, end_of_day)
+    return (
+        query.select(
+            fields["kategorie"].as_("kategorie"),
+            fields["kundentyp"].as_("kundentyp"),
+            fields["language"].as_("land"),
+            Count("*").as_("row_count"),
+        )
+        .groupby(fields["kategorie"], fields["kundentyp"], fields["language"])
+    )
+
+
+def ensure_export_indexes():
+    """Create the indexes used by the export query, existing indexes are left untouched."""
+    for doctype, fields, index_name in EXPORT_INDEXES:
+        if not frappe.db.table_exists(doctype):
+            print(f"Table for {doctype} does not exist, skipping index {index_name}.")
+            continue
+        frappe.db.add_index(doctype, fields, index_name=index_name)
+
+
+def explain_export_query(settings, start_of_day, end_of_day):
+    """Return the EXPLAIN rows of the export query for the given day range."""
+    query = get_export_query(settings, start_of_day, end_of_day)
+    return frappe.db.sql(f"EXPLAIN {query.get_sql()}", as_dict=1)
+
+
+def get_export_query_indexes(settings, start_of_day, end_of_day):
+    """Return {table: {"key": ..., "possible_keys": [...]}} from the EXPLAIN of the export query."""
+    indexes = {}
+    for row in explain_export_query(settings, start_of_day, end_of_day):
+        indexes[row.get("table")] = {
+            "key": row.get("key"),
+            "possible_keys": [k for k in (row.get("possible_keys") or "").split(",") if k],
+        }
+    return indexes
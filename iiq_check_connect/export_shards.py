@@ -0,0 +1,223 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""Sharded exports: one file per Einheit-Kategorie or per language, written in parallel.
+
+With shard_export_by in the iiQ-Check Settings, prepare_export hands over to
+prepare_sharded_export. Every shard is queried and serialized by its own worker
+process with its own database connection, so the wall time scales with the number
+of cores instead of the number of rows. All shard files are attached to one
+iiQ-Check Export document, with the number of recipients per shard.
+
+Duplicate recipients are merged within a shard (with clean_recipients), but not
+across shards: a guest with reservations in two categories gets a row in both
+category shards, so the receiver has to deduplicate the shards of an export if it
+needs one row per guest. Language shards never overlap: every country belongs to
+the shard of its mapped language, the countries without mapping to the shard of
+the default language (or to the "unmapped" shard, if there is none).
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import frappe
+from frappe import _
+
+from iiq_check_connect.export_engine import (
+    delete_export_files,
+    ensure_export_folder,
+    get_export_filename,
+    get_export_statistics,
+    get_recipient_cleaner,
+    insert_export_file,
+    write_streaming_export,
+)
+from iiq_check_connect.export_query import UNMAPPED_SHARD, get_export_query
+from iiq_check_connect.export_tracking import record_exported_rows
+from iiq_check_connect.language_mapping import get_language_mapper
+from iiq_check_connect.metrics import ExportMetrics
+
+
+def get_shards(settings, shard_by):
+    """Return the shards of the export: the configured categories or the language strings."""
+    if shard_by == "category":
+        shards = [ek.einheit_kategorie for ek in settings.einheit_kategorie]
+    else:
+        shards = [m.language_string for m in settings.language_mapping]
+        # The countries without mapping need a shard too, see get_shard_condition
+        shards.append(settings.default_language or UNMAPPED_SHARD)
+    # Unique, in the order of the settings
+    return list(dict.fromkeys(shards))
+
+
+def get_shard_filename(departure_date, export_format, number, shard):
+    """Return the file name of the shard with the (1 based) position number in the shards.
+
+    scrub maps different shards to the same string (e.g. "A-B" and "A B"), the
+    number keeps the file names unique.
+    """
+    return get_export_filename(departure_date, export_format, suffix=f"-{number:02d}-{frappe.scrub(shard)}")
+
+
+def get_shard_workers(settings, number_of_shards):
+    workers = frappe.utils.cint(settings.shard_workers) or os.cpu_count() or 1
+    return max(1, min(workers, number_of_shards))
+
+
+def write_shard(settings, shard_by, shard, start_of_day, end_of_day, directory):
+    """Query and write the rows of one shard into a file in directory.
+
+    Returns a dict with shard, path (None if the shard is empty), number_of_records,
+    the hashes of the exported reservations, statistics and seconds.
+    """
+    start = time.perf_counter()
+    export_format = settings.export_format or "xlsx"
+    cleaner = get_recipient_cleaner(settings)
+    query = get_export_query(settings, start_of_day, end_of_day, shard_by=shard_by, shard=shard)
+    output, number_of_records, hashes = write_streaming_export(
+        query,
+        get_language_mapper(settings),
+        start_of_day.strftime('%Y-%m-%d'),
+        export_format=export_format,
+        cleaner=cleaner,
+    )
+
+    path = None
+    with output:
+        if number_of_records:
+            fd, path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(output, f)
+
+    return {
+        "shard": shard,
+        "path": path,
+        "number_of_records": number_of_records,
+        "hashes": hashes,
+        "statistics": cleaner.statistics() if cleaner else "",
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def write_shard_in_worker(site, sites_path, shard_by, shard, start_of_day, end_of_day, directory):
+    """Entry point of the worker processes, connects to the site and runs write_shard."""
+    frappe.init(site=site, sites_path=sites_path)
+    frappe.connect()
+    try:
+        settings = frappe.get_single("iiQ-Check Settings")
+        return write_shard(settings, shard_by, shard, start_of_day, end_of_day, directory)
+    finally:
+        frappe.destroy()
+
+
+def write_shards(settings, shard_by, shards, start_of_day, end_of_day, directory):
+    """Write all shards, in a process pool if more than one worker is configured."""
+    workers = get_shard_workers(settings, len(shards))
+    if workers == 1:
+        return [write_shard(settings, shard_by, shard, start_of_day, end_of_day, directory) for shard in shards]
+
+    # spawn: forked workers would share the database connection of this process
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [
+            executor.submit(
+                write_shard_in_worker,
+                frappe.local.site,
+                frappe.local.sites_path,
+                shard_by,
+                shard,
+                start_of_day,
+                end_of_day,
+                directory,
+            )
+            for shard in shards
+        ]
+        return [future.result() for future in futures]
+
+
+def create_sharded_export_document(departure_date, results, created_on, shard_by, export_format=None, metrics=None):
+    """Create an iiQ-Check Export document with one shard row (and file) per result of write_shard."""
+    ensure_export_folder()
+
+    number_of_records = sum(result["number_of_records"] for result in results)
+    statistics = get_export_statistics(number_of_records, created_on, export_format)
+    statistics += f"Sharded By: {shard_by}\n"
+    for result in results:
+        statistics += f"Shard {result['shard']}: {result['number_of_records']} records in {result['seconds']:.3f} s\n"
+        statistics += result["statistics"]
+
+    export_doc = frappe.get_doc({
+        "doctype": "iiQ-Check Export",
+        "created_on": created_on,
+        "departure_date": departure_date,
+        "number_of_recipients": number_of_records,
+        "status": "exported",
+        "statistics": statistics,
+        "shard_by": shard_by,
+    })
+    export_doc.set_new_name()
+
+    file_names = []
+    try:
+        for number, result in enumerate(results, 1):
+            row = {"shard": result["shard"], "number_of_recipients": result["number_of_records"], "seconds": result["seconds"]}
+            if result["path"]:
+                with open(result["path"], "rb") as f:
+                    file_doc = insert_export_file(
+                        export_doc.name, f, get_shard_filename(departure_date, export_format, number, result["shard"])
+                    )
+                file_names.append(file_doc.name)
+                row.update(shard_file=file_doc.file_url, file_size=file_doc.file_size, content_hash=file_doc.sha256)
+            export_doc.append("shards", row)
+
+        if metrics:
+            metrics.add_to(export_doc)
+        export_doc.insert()
+    except Exception:
+        # Like create_export_document, no File is left behind without its export
+        delete_export_files(file_names)
+        raise
+    print(f"New iiQ-Check Export document created: {export_doc.name}")
+    return export_doc.name
+
+
+def prepare_sharded_export(settings, start_of_day, end_of_day, created_on, interactive=False, metrics=None):
+    """Write the export of one departure day as shards, see the module docstring.
+    Returns the name of the new iiQ-Check Export, or None if there are no recipients."""
+    shard_by = settings.shard_export_by
+    shards = get_shards(settings, shard_by)
+    if not shards:
+        message = _("There is nothing to shard the export by, please check the iiQ-Check Settings.")
+        print(message)
+        if interactive: frappe.throw(message)
+        return
+
+    metrics = metrics or ExportMetrics()
+    export_format = settings.export_format or "xlsx"
+    directory = tempfile.mkdtemp(prefix="iiq-check-shards-")
+    try:
+        with metrics.stage("shard_export") as stage:
+            results = write_shards(settings, shard_by, shards, start_of_day, end_of_day, directory)
+            stage["row_count"] = sum(result["number_of_records"] for result in results)
+
+        if not stage["row_count"]:
+            message = _("No data returned from the query. Seems like there are no departures for the configured filter, or the import from Compusoft is not working correctly.")
+            print(message)
+            if interactive: frappe.throw(message)
+            return
+
+        export_name = create_sharded_export_document(
+            start_of_day.date(), results, created_on, shard_by, export_format, metrics
+        )
+        hashes = set().union(*(result["hashes"] for result in results))
+        record_exported_rows(export_name, start_of_day.date(), hashes)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    message = f"Export {export_name} written as {len(results)} shards by {shard_by}."
+    print(message)
+    if interactive: frappe.msgprint(message)
+    return export_name
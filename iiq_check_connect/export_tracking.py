@@ -0,0 +1,34 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import hashlib
+import frappe
+
+
+def row_hash(kundennummer, abreise):
+    """Identify an exported reservation by customer number and departure time."""
+    return hashlib.blake2b(f"{kundennummer}|{abreise}".encode(), digest_size=8).hexdigest()
+
+
+def get_exported_hashes(departure_date):
+    """Return the hashes of all reservations already exported for departure_date."""
+    return set(frappe.get_all(
+        "iiQ-Check Exported Reservation",
+        filters={"departure_date": departure_date},
+        pluck="row_hash",
+    ))
+
+
+def record_exported_rows(export_name, departure_date, hashes, chunk_size=10000):
+    """Remember the exported reservations of an export, so later incremental runs skip them."""
+    now = frappe.utils.now_datetime()
+    frappe.db.bulk_insert(
+        "iiQ-Check Exported Reservation",
+        ["name", "creation", "modified", "owner", "modified_by", "departure_date", "row_hash", "export"],
+        [
+            (f"{export_name}-{h}", now, now, frappe.session.user, frappe.session.user, departure_date, h, export_name)
+            for h in hashes
+        ],
+        ignore_duplicates=True,
+        chunk_size=chunk_size,
+    )
@@ -0,0 +1,187 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import csv
+import gzip
+import io
+import tempfile
+
+# Column order of the iiQ-Check sheet
+EXPORT_COLUMNS = ["name", "salutation", "email", "language", "departure_at"]
+
+# Files up to this size are kept in memory, bigger ones are spilled to a temp file
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+
+class ExportWriter:
+    """Base class of the export file writers, which take the rows one by one.
+
+    Usage:
+        with get_export_writer("csv")() as writer:
+            writer.append(["Muster", "Herr", "max@example.com", "de", "2024-07-15"])
+            f = writer.close()
+
+    Subclasses implement _append and _finish.
+    """
+
+    file_extension = None
+
+    def __init__(self, columns=None):
+        self.columns = columns or EXPORT_COLUMNS
+        self.row_count = 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self._closed = False
+
+    def append(self, row):
+        """Append one row, given as a sequence in the order of self.columns."""
+        self._append(row)
+        self.row_count += 1
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def close(self):
+        """Finish the file and return the file object, positioned at the start."""
+        if not self._closed:
+            self._finish()
+            self._closed = True
+            self._file.seek(0)
+        return self._file
+
+    def discard(self):
+        self._file.close()
+
+    def _append(self, row):
+        raise NotImplementedError
+
+    def _finish(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+        return False
+
+
+class XLSXExportWriter(ExportWriter):
+    """Write the iiQ-Check sheet row by row without pandas.
+
+    Uses the write-only mode of openpyxl, which serializes every appended row
+    immediately instead of keeping a cell object per value. The finished workbook
+    is saved into a SpooledTemporaryFile, so big exports land on disk, not in RAM.
+    """
+
+    file_extension = "xlsx"
+
+    def __init__(self, columns=None, sheet_title="Sheet1"):
+        # Imported on first use, so modules using the writers load without openpyxl
+        import openpyxl
+
+        super().__init__(columns)
+        self._workbook = openpyxl.Workbook(write_only=True)
+        self._sheet = self._workbook.create_sheet(sheet_title)
+        self._sheet.append(self.columns)
+
+    def _append(self, row):
+        self._sheet.append(row)
+
+    def _finish(self):
+        self._workbook.save(self._file)
+
+
+class CSVExportWriter(ExportWriter):
+    """Write the rows as UTF-8 CSV with a header line, directly into the spooled file."""
+
+    file_extension = "csv"
+
+    def __init__(self, columns=None):
+        super().__init__(columns)
+        self._text = io.TextIOWrapper(self._open_stream(), encoding="utf-8", newline="")
+        self._writer = csv.writer(self._text)
+        self._writer.writerow(self.columns)
+
+    def _open_stream(self):
+        return self._file
+
+    def _append(self, row):
+        self._writer.writerow(row)
+
+    def _finish(self):
+        self._text.flush()
+        # Detach, so closing the wrapper does not close the spooled file
+        self._text.detach()
+
+
+class GzipCSVExportWriter(CSVExportWriter):
+    """Like CSVExportWriter, but gzip compressed while writing."""
+
+    file_extension = "csv.gz"
+
+    def _open_stream(self):
+        self._gzip = gzip.GzipFile(fileobj=self._file, mode="wb", compresslevel=6)
+        return self._gzip
+
+    def _finish(self):
+        super()._finish()
+        self._gzip.close()
+
+
+class ParquetExportWriter(ExportWriter):
+    """Write the rows as Parquet, buffering at most ROW_GROUP_SIZE rows at a time.
+
+    Needs pyarrow, which is only imported when a Parquet export is written.
+    """
+
+    file_extension = "parquet"
+    ROW_GROUP_SIZE = 50_000
+
+    def __init__(self, columns=None):
+        super().__init__(columns)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The Parquet export format needs pyarrow, please install it in the bench environment.")
+
+        self._pa = pyarrow
+        self._schema = pyarrow.schema([(column, pyarrow.string()) for column in self.columns])
+        self._writer = pyarrow.parquet.ParquetWriter(self._file, self._schema, compression="zstd")
+        self._buffer = []
+
+    def _append(self, row):
+        self._buffer.append(row)
+        if len(self._buffer) >= self.ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        columns = list(zip(*self._buffer))
+        table = self._pa.Table.from_arrays(
+            [self._pa.array([None if v is None else str(v) for v in values], type=self._pa.string()) for values in columns],
+            schema=self._schema,
+        )
+        self._writer.write_table(table)
+        self._buffer = []
+
+    def _finish(self):
+        self._flush()
+        self._writer.close()
+
+
+EXPORT_WRITERS = {
+    writer.file_extension: writer
+    for writer in (XLSXExportWriter, CSVExportWriter, GzipCSVExportWriter, ParquetExportWriter)
+}
+
+
+def get_export_writer(export_format=None):
+    """Return the writer class for an export format (the file extension), XLSX by default."""
+    export_format = export_format or XLSXExportWriter.file_extension
+    if export_format not in EXPORT_WRITERS:
+        raise ValueError(f"Unknown export format {export_format}, choose one of {', '.join(EXPORT_WRITERS)}.")
+    return EXPORT_WRITERS[export_format]
@@ -0,0 +1,72 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+from collections import deque
+
+# Entries kept per upload attempt, older ones are dropped (e.g. a long upload_many run)
+MAX_LOG_ENTRIES = 200
+
+# Upload attempts kept per export, older iiQ-Check FTP Log documents are deleted
+MAX_LOGS_PER_EXPORT = 20
+
+# Commands whose argument must not end up in the log
+SECRET_COMMANDS = ("PASS", "ACCT")
+
+
+class FTPLog:
+    """Structured log of one upload attempt, with at most max_entries entries.
+
+    Every entry is a dict, either a command with its response code, response and
+    latency, or a free text message. When the log is full, the oldest entries are
+    dropped and counted in dropped.
+    """
+
+    def __init__(self, max_entries=MAX_LOG_ENTRIES):
+        self.entries = deque(maxlen=max_entries)
+        self.dropped = 0
+
+    def _add(self, entry):
+        if len(self.entries) == self.entries.maxlen:
+            self.dropped += 1
+        self.entries.append(entry)
+
+    def append(self, message):
+        """Add a free text message."""
+        self._add({"message": message})
+
+    def command(self, command, response, seconds):
+        """Add a command sent to the server with the response and the time it took."""
+        verb = command.split(" ", 1)[0]
+        if verb.upper() in SECRET_COMMANDS:
+            command = f"{verb} ****"
+        response = str(response)
+        self._add({
+            "command": command,
+            "response_code": response[:3],
+            "response": response,
+            "seconds": round(seconds, 4),
+        })
+
+    @property
+    def messages(self):
+        return [entry["message"] for entry in self.entries if "message" in entry]
+
+    @property
+    def command_count(self):
+        return len(self.entries) - len(self.messages)
+
+    def lines(self):
+        """Return the log as text lines, one per message or command."""
+        lines = []
+        for entry in self.entries:
+            if "message" in entry:
+                lines.append(entry["message"])
+            else:
+                lines.append(f"{entry['command']} -> {entry['response']} ({entry['seconds'] * 1000:.0f} ms)")
+        return lines
+
+    def __iter__(self):
+        return iter(self.lines())
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,338 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import datetime
+import io
+import os
+import threading
+import time
+from ftplib import FTP, FTP_TLS, all_errors, error_perm, error_reply
+
+from iiq_check_connect.content_hash import format_checksum, get_checksum_filename, parse_checksum
+from iiq_check_connect.ftp_log import FTPLog
+from iiq_check_connect.metrics import ExportMetrics
+
+# Idle sessions older than this are not reused, most servers drop them after a few minutes
+SESSION_IDLE_TIMEOUT = 120
+
+# Block size for storbinary, large blocks mean fewer send calls for big export files
+UPLOAD_BLOCKSIZE = 64 * 1024
+
+
+def send_logged(ftp, cmd, send=FTP.sendcmd):
+    """Send cmd with FTP.sendcmd (or FTP.voidcmd) and record it with response and latency in ftp.ftp_log."""
+    start = time.perf_counter()
+    try:
+        response = send(ftp, cmd)
+    except all_errors as e:
+        ftp.ftp_log.command(cmd, e, time.perf_counter() - start)
+        raise
+    ftp.ftp_log.command(cmd, response, time.perf_counter() - start)
+    return response
+
+
+class CustomFTP(FTP):
+    """FTP client, which records every command and response in ftp_log (an FTPLog)."""
+
+    def __init__(self, ftp_log=None, **kwargs):
+        self.ftp_log = ftp_log if ftp_log is not None else FTPLog()
+        super().__init__(**kwargs)
+
+    def sendcmd(self, cmd):
+        return send_logged(self, cmd)
+
+    def voidcmd(self, cmd):
+        return send_logged(self, cmd, FTP.voidcmd)
+
+
+class CustomFTP_TLS(FTP_TLS):
+    """FTPS client, which records every command and response in ftp_log (an FTPLog).
+
+    The data connections reuse the TLS session of the control connection, so every
+    transfer after the first one skips the full handshake. Several servers (vsftpd
+    with require_ssl_reuse, FileZilla Server) even refuse data connections without it.
+    """
+
+    def __init__(self, ftp_log=None, **kwargs):
+        self.ftp_log = ftp_log if ftp_log is not None else FTPLog()
+        super().__init__(**kwargs)
+
+    def sendcmd(self, cmd):
+        return send_logged(self, cmd)
+
+    def voidcmd(self, cmd):
+        return send_logged(self, cmd, FTP.voidcmd)
+
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = FTP.ntransfercmd(self, cmd, rest)
+        if self._prot_p:
+            conn = self.context.wrap_socket(conn, server_hostname=self.host, session=self.sock.session)
+        return conn, size
+
+
+class FTPSession:
+    """An authenticated FTP/FTPS session in the upload directory, reusable for many uploads.
+
+    Usage:
+        with FTPSession.from_settings(settings) as session:
+            session.upload("file.xlsx", f)
+    """
+
+    def __init__(self, server, user, password, path, port=21, use_secure_ftp=False, ftp_log=None, metrics=None):
+        self.server = server
+        self.user = user
+        self.password = password
+        self.path = path
+        self.port = port or 21
+        self.use_secure_ftp = use_secure_ftp
+        self.ftp_log = ftp_log if ftp_log is not None else FTPLog()
+        self.metrics = metrics or ExportMetrics()
+        self.ftp = None
+        self.last_used = 0
+
+    @classmethod
+    def from_settings(cls, settings, ftp_log=None, metrics=None):
+        return cls(
+            server=settings.ftp_server,
+            user=settings.ftp_user,
+            password=settings.get_password("ftp_password"),
+            path=settings.ftp_path,
+            port=settings.ftp_port,
+            use_secure_ftp=settings.use_secure_ftp,
+            ftp_log=ftp_log,
+            metrics=metrics,
+        )
+
+    @property
+    def key(self):
+        return (self.server, self.port, self.user, self.path, bool(self.use_secure_ftp))
+
+    def set_log(self, ftp_log, metrics=None):
+        """Record the following commands in ftp_log and the stage timings in metrics,
+        e.g. one log per uploaded export."""
+        self.ftp_log = ftp_log
+        self.metrics = metrics or ExportMetrics()
+        if self.ftp:
+            self.ftp.ftp_log = ftp_log
+
+    def connect(self):
+        if self.use_secure_ftp:
+            ftp = CustomFTP_TLS(ftp_log=self.ftp_log)
+        else:
+            ftp = CustomFTP(ftp_log=self.ftp_log)
+
+        with self.metrics.stage("ftp_connect"):
+            ftp.connect(self.server, self.port)
+        self.ftp_log.append(f"Connected to FTP server {self.server} on port {self.port}.")
+
+        with self.metrics.stage("ftp_login"):
+            ftp.login(user=self.user, passwd=self.password)
+            self.ftp_log.append(f"Logged in as {self.user}.")
+
+            if self.use_secure_ftp:
+                ftp.prot_p()  # Switch to secure data connection
+                self.ftp_log.append("Switched to secure data connection.")
+
+            ftp.cwd(self.path)
+            self.ftp_log.append(f"Changed directory to {self.path}.")
+
+        self.ftp = ftp
+        self.last_used = time.monotonic()
+
+    def is_alive(self):
+        if not self.ftp or time.monotonic() - self.last_used > SESSION_IDLE_TIMEOUT:
+            return False
+        try:
+            self.ftp.voidcmd("NOOP")
+            return True
+        except Exception:
+            return False
+
+    def ensure_connected(self):
+        if not self.is_alive():
+            self.close()
+            self.connect()
+
+    def remote_size(self, filename):
+        """Return the size of filename on the server, or None if it does not exist or SIZE is not supported."""
+        try:
+            # SIZE is only reliable in binary mode
+            self.ftp.voidcmd("TYPE I")
+            return self.ftp.size(filename)
+        except (error_perm, error_reply):
+            return None
+
+    def remote_mtime(self, filename):
+        """Return the modification time of filename on the server as aware UTC datetime,
+        or None if it does not exist or MDTM is not supported."""
+        try:
+            response = self.ftp.sendcmd(f"MDTM {filename}")
+        except (error_perm, error_reply):
+            return None
+        # 213 YYYYMMDDHHMMSS[.sss], always in UTC
+        try:
+            mtime = datetime.datetime.strptime(response[4:18], "%Y%m%d%H%M%S")
+        except ValueError:
+            return None
+        return mtime.replace(tzinfo=datetime.timezone.utc)
+
+    def remote_checksum(self, filename):
+        """Return the hash from the checksum file of filename on the server, or None if there is none."""
+        lines = []
+        try:
+            self.ftp.retrlines(f"RETR {get_checksum_filename(filename)}", lines.append)
+        except (error_perm, error_reply):
+            return None
+        return parse_checksum("\n".join(lines))
+
+    def is_unchanged(self, filename, size, content_hash=None, modified_after=None):
+        """Check if the server already has this version of filename.
+
+        The sizes have to match. Then the checksum file decides, if there is one. Without
+        it, the remote file has to be modified after modified_after (an aware datetime),
+        i.e. it was uploaded after the local file had been generated.
+
+        The fallback does not look at the content: a different file of the same size,
+        written to the server after modified_after (e.g. by another export of the same
+        name), counts as unchanged as well. Only the checksum file rules this out, and
+        without content_hash and modified_after nothing is skipped.
+        """
+        self.ensure_connected()
+        if self.remote_size(filename) != size:
+            return False
+
+        if content_hash:
+            remote_hash = self.remote_checksum(filename)
+            if remote_hash:
+                return remote_hash == content_hash
+
+        if modified_after:
+            mtime = self.remote_mtime(filename)
+            return bool(mtime and mtime >= modified_after)
+
+        return False
+
+    def upload_checksum(self, filename, content_hash):
+        """Upload the checksum file of filename, so the next run can compare the content."""
+        checksum_filename = get_checksum_filename(filename)
+        self.ftp.storbinary(f"STOR {checksum_filename}", io.BytesIO(format_checksum(content_hash, filename).encode()))
+        self.ftp_log.append(f"Uploaded checksum file {checksum_filename}.")
+
+    def upload_if_changed(self, filename, f, content_hash=None, modified_after=None, checksum_file=False, **kwargs):
+        """Upload f like upload, unless the server already has the same content (see is_unchanged).
+
+        With checksum_file, a checksum file with content_hash is uploaded next to it.
+        Returns the result of upload, or None if the transfer was skipped.
+        """
+        size = os.fstat(f.fileno()).st_size - f.tell()
+        if self.is_unchanged(filename, size, content_hash, modified_after):
+            self.ftp_log.append(f"File {filename} on the server is unchanged ({size} bytes), upload skipped.")
+            self.last_used = time.monotonic()
+            return None
+
+        result = self.upload(filename, f, **kwargs)
+        if checksum_file and content_hash:
+            self.upload_checksum(filename, content_hash)
+        return result
+
+    def upload(self, filename, f, blocksize=UPLOAD_BLOCKSIZE, callback=None, resume=False):
+        """Upload the file object f as filename, reading it in blocks of blocksize bytes.
+        callback is called with every block sent.
+
+        With resume, a partial file left on the server by an interrupted transfer is
+        continued with REST instead of being sent again from the start.
+
+        Returns a tuple of the number of bytes sent and the duration of the transfer in seconds.
+        """
+        self.ensure_connected()
+        start_position = f.tell()
+        rest = None
+
+        if resume:
+            local_size = os.fstat(f.fileno()).st_size - start_position
+            remote_size = self.remote_size(filename)
+            if remote_size and remote_size < local_size:
+                rest = remote_size
+                f.seek(start_position + rest)
+                self.ftp_log.append(f"Resuming upload of {filename} at byte {rest} of {local_size}.")
+
+        with self.metrics.stage("ftp_transfer") as stage:
+            try:
+                self.ftp.storbinary(f"STOR {filename}", f, blocksize=blocksize, callback=callback, rest=rest)
+            except (error_perm, error_reply) as e:
+                # Server does not support REST for STOR, send the whole file
+                if rest is None or not str(e).startswith(("500", "501", "502", "504")):
+                    raise
+                self.ftp_log.append(f"Resume not supported ({e}), uploading {filename} from the start.")
+                f.seek(start_position)
+                self.ftp.storbinary(f"STOR {filename}", f, blocksize=blocksize, callback=callback)
+                rest = None
+            size = f.tell() - start_position - (rest or 0)
+            stage["byte_count"] = size
+        duration = stage["seconds"]
+
+        rate = size / duration / 1024 if duration else 0
+        self.ftp_log.append(f"Uploaded file {filename}: {size} bytes in {duration:.3f} s ({rate:.1f} KiB/s).")
+        self.last_used = time.monotonic()
+        return size, duration
+
+    def close(self):
+        if not self.ftp:
+            return
+        try:
+            self.ftp.quit()
+            self.ftp_log.append("FTP session closed.")
+        except Exception:
+            self.ftp.close()
+        self.ftp = None
+
+    def __enter__(self):
+        self.ensure_connected()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class FTPSessionPool:
+    """Keeps idle sessions per server/user/path, so consecutive uploads in the same
+    worker process skip connect, login and (for FTPS) the TLS handshake."""
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, settings, ftp_log=None, metrics=None):
+        session = FTPSession.from_settings(settings, ftp_log=ftp_log, metrics=metrics)
+        with self._lock:
+            idle_session = self._idle.pop(session.key, None)
+        if idle_session and idle_session.password == session.password:
+            idle_session.set_log(session.ftp_log, session.metrics)
+            session = idle_session
+            session.ftp_log.append(f"Reusing open FTP session to {session.server}.")
+        session.ensure_connected()
+        return session
+
+    def release(self, session):
+        """Return a healthy session to the pool, the previously idle one for the same key is closed."""
+        if not session.ftp:
+            return
+        with self._lock:
+            previous = self._idle.pop(session.key, None)
+            self._idle[session.key] = session
+        if previous and previous is not session:
+            previous.close()
+
+    def discard(self, session):
+        session.close()
+
+    def close_all(self):
+        with self._lock:
+            sessions = list(self._idle.values())
+            self._idle.clear()
+        for session in sessions:
+            session.close()
+
+
+session_pool = FTPSessionPool()
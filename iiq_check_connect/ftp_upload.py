@@ -0,0 +1,460 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""FTP uploader: sends the attached export files to the configured FTP destinations."""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo
+import frappe
+from frappe import _
+from iiq_check_connect.async_ftp import AsyncFTPSession, run_upload, upload_to_destinations
+from iiq_check_connect.content_hash import hash_file
+from iiq_check_connect.ftp_log import FTPLog, MAX_LOGS_PER_EXPORT
+from iiq_check_connect.ftp_session import FTPSession, session_pool
+from iiq_check_connect.metrics import ExportMetrics
+from iiq_check_connect.progress import upload_progress_callback
+from iiq_check_connect.upload_retry import mark_uploaded, schedule_upload_retry
+
+# Upper limit of concurrent uploads when an export is delivered to several destinations
+MAX_UPLOAD_WORKERS = 4
+
+
+def check_ftp_settings(settings):
+    if not all([settings.ftp_server, settings.ftp_user, settings.ftp_password, settings.ftp_path]):
+        message = _("FTP settings are not fully configured. Please check the iiQ-Check Settings.")
+        print(message)
+        frappe.throw(message)
+
+
+def get_export_file(export_doc):
+    """Return the File document and the path on disk of the XLSX attached to export_doc."""
+    if not export_doc.xlsx_file:
+        message = _("No XLSX file attached to this export.")
+        print(message)
+        frappe.throw(message)
+
+    return get_attached_file(export_doc.xlsx_file)
+
+
+def get_attached_file(file_url):
+    """Return the File document of file_url and its path on disk, throws if it is missing or empty."""
+    file_doc = frappe.get_doc("File", {"file_url": file_url})
+
+    if not file_doc:
+        message = _("Attached file not found.")
+        print(message)
+        frappe.throw(message)
+
+    # The upload reads the file from disk block by block instead of loading it via get_content()
+    file_path = file_doc.get_full_path()
+
+    if not os.path.exists(file_path) or not os.path.getsize(file_path):
+        message = _("No content found in the attached file.")
+        print(message)
+        frappe.throw(message)
+
+    return file_doc, file_path
+
+
+def get_export_files(export_doc):
+    """Return the files to upload of export_doc, as dicts of file_doc, file_path and content_hash.
+
+    That is the export file, or for a sharded export the files of all non-empty shards.
+    """
+    if not export_doc.get("shards"):
+        file_doc, file_path = get_export_file(export_doc)
+        return [frappe._dict(file_doc=file_doc, file_path=file_path, content_hash=get_export_content_hash(export_doc, file_path))]
+
+    export_files = []
+    for shard in export_doc.shards:
+        if not shard.shard_file:
+            continue
+        file_doc, file_path = get_attached_file(shard.shard_file)
+        export_files.append(frappe._dict(
+            file_doc=file_doc,
+            file_path=file_path,
+            content_hash=shard.content_hash or hash_file(file_path),
+        ))
+    return export_files
+
+
+def get_export_content_hash(export_doc, file_path):
+    """Return the content hash of the export file, exports created before it was recorded are hashed now."""
+    if not export_doc.content_hash:
+        export_doc.content_hash = hash_file(file_path)
+    return export_doc.content_hash
+
+
+def get_file_created_utc(file_doc):
+    """Return the creation time of file_doc as aware datetime, to compare it with the MDTM of the server."""
+    system_timezone = ZoneInfo(frappe.utils.get_system_timezone())
+    return frappe.utils.get_datetime(file_doc.creation).replace(tzinfo=system_timezone)
+
+
+def delete_ftp_logs(log_names):
+    """Delete iiQ-Check FTP Log documents with their entries and stage metrics."""
+    for child_doctype in ("iiQ-Check FTP Log Entry", "iiQ-Check Export Metric"):
+        frappe.db.delete(child_doctype, {"parent": ("in", log_names), "parenttype": "iiQ-Check FTP Log"})
+    frappe.db.delete("iiQ-Check FTP Log", {"name": ("in", log_names)})
+
+
+def insert_ftp_log(export_name, ftp_log, status, destination=None, metrics=None):
+    """Store the FTPLog and the stage metrics of one upload attempt as iiQ-Check FTP Log document.
+
+    Only the latest MAX_LOGS_PER_EXPORT logs of an export are kept, older ones are deleted.
+    """
+    log_doc = frappe.get_doc({
+        "doctype": "iiQ-Check FTP Log",
+        "export": export_name,
+        "destination": destination,
+        "status": status,
+        "logged_on": frappe.utils.now_datetime(),
+        "command_count": ftp_log.command_count,
+        "dropped_entries": ftp_log.dropped,
+        "entries": list(ftp_log.entries),
+    })
+    if metrics:
+        metrics.add_to(log_doc)
+    log_doc.insert(ignore_permissions=True)
+
+    old_logs = frappe.get_all(
+        "iiQ-Check FTP Log",
+        filters={"export": export_name},
+        order_by="creation desc",
+        start=MAX_LOGS_PER_EXPORT,
+        pluck="name",
+    )
+    if old_logs:
+        delete_ftp_logs(old_logs)
+    return log_doc.name
+
+
+def save_ftp_log(export_doc, ftp_log, status, destination=None, metrics=None):
+    """Store the FTP log of an upload attempt and save the upload status of the export document.
+
+    The log and the stage metrics go into their own iiQ-Check FTP Log document, so
+    the export document does not grow with every upload.
+    """
+    insert_ftp_log(export_doc.name, ftp_log, status, destination, metrics)
+    export_doc.save()
+
+
+@frappe.whitelist()
+def upload_to_ftp(export_name):
+    settings = frappe.get_single("iiQ-Check Settings")
+    export_doc = frappe.get_doc("iiQ-Check Export", export_name)
+
+    # Validate FTP settings
+    check_ftp_settings(settings)
+    export_files = get_export_files(export_doc)
+
+    ftp_log = FTPLog()
+    metrics = ExportMetrics()
+    session = None
+    status = "failed"
+
+    try:
+        # A previous attempt failed, continue a partial file on the server if there is one
+        resume = bool(export_doc.upload_attempts)
+
+        if settings.ftp_transport != "asyncio":
+            # Reuses an open session of this worker for the same server, if there is one
+            session = session_pool.acquire(settings, ftp_log, metrics)
+
+        uploaded = []
+        for export_file in export_files:
+            # Files the server already has in this version are not sent again
+            upload_kwargs = dict(
+                content_hash=export_file.content_hash,
+                modified_after=get_file_created_utc(export_file.file_doc),
+                checksum_file=settings.upload_checksum_file,
+                callback=upload_progress_callback(os.path.getsize(export_file.file_path)),
+                resume=resume,
+            )
+            if session:
+                with open(export_file.file_path, "rb") as f:
+                    result = session.upload_if_changed(export_file.file_doc.file_name, f, **upload_kwargs)
+            else:
+                result = run_upload(
+                    AsyncFTPSession.from_settings(settings, ftp_log, metrics),
+                    export_file.file_doc.file_name,
+                    export_file.file_path,
+                    **upload_kwargs,
+                )
+            if result:
+                uploaded.append(export_file.file_doc.file_name)
+
+        if session:
+            session_pool.release(session)
+        mark_uploaded(export_doc)
+        status = "uploaded" if uploaded else "unchanged"
+
+        if uploaded:
+            message = f"File {', '.join(uploaded)} uploaded to FTP server {settings.ftp_server}."
+        else:
+            file_names = ", ".join(export_file.file_doc.file_name for export_file in export_files)
+            message = f"File {file_names} is unchanged on FTP server {settings.ftp_server}, upload skipped."
+        print(message)
+        frappe.msgprint(message)
+
+    except Exception as e:
+        if session:
+            session_pool.discard(session)
+        message = f"FTP upload failed: {e}"
+        print(message)
+        ftp_log.append(f"FTP upload failed: {e}")
+        # Retried by the scheduler with exponential backoff
+        schedule_upload_retry(export_doc, e)
+        if export_doc.upload_status == "pending":
+            ftp_log.append(f"Next upload attempt at {export_doc.next_upload_attempt}.")
+        frappe.throw(message)
+        raise e
+    finally:
+        # Ensure the logs are saved even if an error occurs
+        save_ftp_log(export_doc, ftp_log, status, settings.ftp_server, metrics)
+
+
+@frappe.whitelist()
+def upload_many(export_names):
+    """Upload several exports one after another over a single FTP session.
+
+    export_names is a list (or JSON list) of iiQ-Check Export names. Every export
+    gets an iiQ-Check FTP Log with the commands and the transfer duration of its file.
+    Returns one result dict per export.
+    """
+    if isinstance(export_names, str):
+        export_names = frappe.parse_json(export_names)
+
+    settings = frappe.get_single("iiQ-Check Settings")
+    check_ftp_settings(settings)
+
+    session = FTPSession.from_settings(settings)
+    results = []
+    total_start = time.perf_counter()
+
+    try:
+        for export_name in export_names:
+            export_doc = frappe.get_doc("iiQ-Check Export", export_name)
+            ftp_log = FTPLog()
+            metrics = ExportMetrics()
+            session.set_log(ftp_log, metrics)
+
+            try:
+                size = duration = 0
+                for export_file in get_export_files(export_doc):
+                    with open(export_file.file_path, "rb") as f:
+                        uploaded = session.upload_if_changed(
+                            export_file.file_doc.file_name,
+                            f,
+                            content_hash=export_file.content_hash,
+                            modified_after=get_file_created_utc(export_file.file_doc),
+                            checksum_file=settings.upload_checksum_file,
+                            callback=upload_progress_callback(os.path.getsize(export_file.file_path)),
+                        )
+                    if uploaded:
+                        size += uploaded[0]
+                        duration += uploaded[1]
+
+                if size:
+                    results.append({"export": export_name, "status": "uploaded", "bytes": size, "seconds": round(duration, 3)})
+                else:
+                    results.append({"export": export_name, "status": "unchanged"})
+
+            except Exception as e:
+                ftp_log.append(f"FTP upload failed: {e}")
+                results.append({"export": export_name, "status": "failed", "error": str(e)})
+                # Start with a fresh connection for the next file
+                session.close()
+
+            finally:
+                save_ftp_log(export_doc, ftp_log, results[-1]["status"], settings.ftp_server, metrics)
+    finally:
+        session.close()
+
+    uploaded = len([r for r in results if r["status"] != "failed"])
+    message = f"Uploaded {uploaded} of {len(results)} exports to FTP server {settings.ftp_server} in {time.perf_counter() - total_start:.1f} s."
+    print(message)
+    frappe.msgprint(message)
+    return results
+
+
+def get_destinations(settings):
+    """Return the main FTP server of the settings and all enabled additional destinations."""
+    destinations = []
+    if settings.ftp_server:
+        destinations.append(frappe._dict(
+            title=settings.ftp_server,
+            server=settings.ftp_server,
+            port=settings.ftp_port,
+            path=settings.ftp_path,
+            user=settings.ftp_user,
+            password=settings.get_password("ftp_password"),
+            use_secure_ftp=settings.use_secure_ftp,
+            checksum_file=settings.upload_checksum_file,
+        ))
+    for row in settings.ftp_destinations or []:
+        if not row.enabled:
+            continue
+        destinations.append(frappe._dict(
+            title=row.title,
+            server=row.ftp_server,
+            port=row.ftp_port,
+            path=row.ftp_path,
+            user=row.ftp_user,
+            password=row.get_password("ftp_password"),
+            use_secure_ftp=row.use_secure_ftp,
+            checksum_file=settings.upload_checksum_file,
+        ))
+    return destinations
+
+
+def upload_to_destination(destination, filename, file_path, resume=False, content_hash=None, modified_after=None):
+    """Upload one file to one destination, unless it is unchanged there.
+    Runs in a worker thread, so it must not use frappe."""
+    ftp_log = FTPLog()
+    metrics = ExportMetrics()
+    result = {"destination": destination.title, "log": ftp_log, "metrics": metrics}
+    session = FTPSession(
+        destination.server,
+        destination.user,
+        destination.password,
+        destination.path,
+        port=destination.port,
+        use_secure_ftp=destination.use_secure_ftp,
+        ftp_log=ftp_log,
+        metrics=metrics,
+    )
+    start = time.perf_counter()
+    try:
+        with session, open(file_path, "rb") as f:
+            uploaded = session.upload_if_changed(
+                filename,
+                f,
+                content_hash=content_hash,
+                modified_after=modified_after,
+                checksum_file=destination.checksum_file,
+                resume=resume,
+            )
+        if uploaded:
+            result["byte_count"], _ = uploaded
+            result["status"] = "uploaded"
+        else:
+            result["status"] = "unchanged"
+    except Exception as e:
+        ftp_log.append(f"FTP upload failed: {e}")
+        result["status"] = "failed"
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def upload_file_to_destinations(settings, destinations, export_file, resume=False):
+    """Upload one file of an export to all destinations concurrently, returns the results of upload_to_destination."""
+    file_name = export_file.file_doc.file_name
+    modified_after = get_file_created_utc(export_file.file_doc)
+    if settings.ftp_transport == "asyncio":
+        # All transfers on one event loop instead of one thread per destination
+        return upload_to_destinations(
+            destinations,
+            file_name,
+            export_file.file_path,
+            max_concurrency=MAX_UPLOAD_WORKERS,
+            resume=resume,
+            content_hash=export_file.content_hash,
+            modified_after=modified_after,
+        )
+
+    with ThreadPoolExecutor(max_workers=min(len(destinations), MAX_UPLOAD_WORKERS)) as executor:
+        return list(executor.map(
+            lambda d: upload_to_destination(d, file_name, export_file.file_path, resume, export_file.content_hash, modified_after),
+            destinations,
+        ))
+
+
+def merge_delivery_results(results):
+    """Combine the upload results of all files of an export (the shards) for one destination."""
+    statuses = {r["status"] for r in results}
+    return {
+        "destination": results[0]["destination"],
+        "status": "failed" if "failed" in statuses else "uploaded" if "uploaded" in statuses else "unchanged",
+        "seconds": round(sum(r["seconds"] for r in results), 3),
+        "byte_count": sum(r.get("byte_count") or 0 for r in results) or None,
+        "messages": [message for r in results for message in r["log"].messages],
+        "error": "; ".join(r["error"] for r in results if r.get("error")),
+    }
+
+
+@frappe.whitelist()
+def deliver_export(export_name):
+    """Upload an export to the main FTP server and all additional destinations concurrently.
+
+    Every destination gets its own delivery row with status, duration and log on the
+    export document, so the total time is the one of the slowest destination.
+    The files of a sharded export are uploaded one after another, each of them to all
+    destinations concurrently.
+    On a retry, destinations which already received the file are skipped, as are
+    destinations which already have an identical file.
+    """
+    settings = frappe.get_single("iiQ-Check Settings")
+    export_doc = frappe.get_doc("iiQ-Check Export", export_name)
+    export_files = get_export_files(export_doc)
+
+    delivered = {d.destination for d in export_doc.deliveries if d.status in ("uploaded", "unchanged")}
+    destinations = [d for d in get_destinations(settings) if d.title not in delivered]
+    if not destinations:
+        message = _("The export was already delivered to all destinations.")
+        print(message)
+        frappe.msgprint(message)
+        return
+
+    resume = bool(export_doc.upload_attempts)
+    file_results = [
+        upload_file_to_destinations(settings, destinations, export_file, resume) for export_file in export_files
+    ]
+
+    for result in (r for results in file_results for r in results):
+        insert_ftp_log(export_doc.name, result["log"], result["status"], result["destination"], result["metrics"])
+
+    # One delivery per destination over all files, the results of every file are in the order of destinations
+    results = [merge_delivery_results(list(results)) for results in zip(*file_results)]
+    delivered_on = frappe.utils.now_datetime()
+    deliveries = {d.destination: d for d in export_doc.deliveries}
+    for result in results:
+        delivery = {
+            "destination": result["destination"],
+            "status": result["status"],
+            "delivered_on": delivered_on,
+            "seconds": result["seconds"],
+            "byte_count": result["byte_count"],
+            "log": "\n".join(result["messages"]),
+        }
+        # A retry replaces the delivery of the destination, the earlier attempts are in the FTP logs
+        if result["destination"] in deliveries:
+            deliveries[result["destination"]].update(delivery)
+        else:
+            export_doc.append("deliveries", delivery)
+
+    failed = [r for r in results if r["status"] == "failed"]
+    if failed:
+        schedule_upload_retry(export_doc, "; ".join(f"{r['destination']}: {r['error']}" for r in failed))
+    else:
+        mark_uploaded(export_doc)
+    export_doc.save()
+
+    file_names = ", ".join(export_file.file_doc.file_name for export_file in export_files)
+    message = f"File {file_names} delivered to {len(results) - len(failed)} of {len(results)} destinations."
+    print(message)
+    if failed:
+        frappe.throw(message)
+    frappe.msgprint(message)
+    return results
+
+
+def upload_export(export_name):
+    """Upload an export with deliver_export if additional destinations are configured, else with upload_to_ftp."""
+    settings = frappe.get_single("iiQ-Check Settings")
+    if any(d.enabled for d in settings.ftp_destinations or []):
+        return deliver_export(export_name)
+    return upload_to_ftp(export_name)
@@ -126,13 +126,34 @@ app_license = "GPLv3"
 #	}
 # }
 
+doc_events = {
+	"Reservierung": {
+		"on_update": "iiq_check_connect.departure_snapshot.update_reservation",
+		"on_trash": "iiq_check_connect.departure_snapshot.delete_reservation",
+		"after_rename": "iiq_check_connect.departure_snapshot.rename_reservation"
+	},
+	"Camping Kunde": {
+		"on_update": "iiq_check_connect.departure_snapshot.update_customer",
+		"on_trash": "iiq_check_connect.departure_snapshot.delete_customer",
+		"after_rename": "iiq_check_connect.departure_snapshot.rename_customer"
+	}
+}
+
 # Scheduled Tasks
 # ---------------
 
 scheduler_events = {
 	"hourly": [
-		"iiq_check_connect.tools.hourly_job"
-	]
+		"iiq_check_connect.scheduler.hourly_job"
+	],
+	"daily": [
+		"iiq_check_connect.retention.apply_retention"
+	],
+	"cron": {
+		"*/5 * * * *": [
+			"iiq_check_connect.upload_retry.retry_pending_uploads"
+		]
+	}
 }
 
 
@@ -0,0 +1,37 @@
+# Copyright (c) 2024, itsdave GmbH and Contributors
+# See license.txt
+
+import datetime
+import unittest
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from iiq_check_connect.departure_snapshot import SNAPSHOT_COLUMNS, check_snapshot, get_snapshot_row, rebuild_snapshot
+
+
+class TestiiQCheckDepartureSnapshot(FrappeTestCase):
+	def test_snapshot_row_carries_the_latest_change(self):
+		reservation = frappe._dict(
+			name="R1", kundennummer="K1", abreise=datetime.datetime(2024, 7, 15, 10), kategorie="Stellplatz",
+			modified=datetime.datetime(2024, 7, 1, 8),
+		)
+		customer = frappe._dict(
+			nachname="Muster", anrede="Herr", email="max@example.com", land="DE", kundentyp="Privat",
+			modified=datetime.datetime(2024, 7, 2, 9),
+		)
+		row = dict(zip(SNAPSHOT_COLUMNS, get_snapshot_row(reservation, customer)))
+
+		# modified_since of incremental exports must see changes of the customer as well
+		self.assertEqual(row["modified"], customer.modified)
+		self.assertEqual(row["departure_date"], datetime.date(2024, 7, 15))
+		self.assertEqual((row["email"], row["kundentyp"]), ("max@example.com", "Privat"))
+
+	def test_departure_snapshot_matches_live_join(self):
+		if not frappe.db.table_exists("Reservierung") or not frappe.db.table_exists("Camping Kunde"):
+			raise unittest.SkipTest("Reservierung / Camping Kunde are not installed on this site")
+
+		today = frappe.utils.getdate()
+		rebuild_snapshot(from_date=today - datetime.timedelta(days=7))
+		result = check_snapshot(today - datetime.timedelta(days=7), today + datetime.timedelta(days=7))
+		self.assertTrue(result["consistent"], result)
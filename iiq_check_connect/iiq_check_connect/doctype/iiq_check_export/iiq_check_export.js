@@ -2,21 +2,38 @@
 // For license information, please see license.txt
 
 frappe.ui.form.on('iiQ-Check Export', {
+	onload: function(frm) {
+		frappe.realtime.off('iiq_check_progress');
+		frappe.realtime.on('iiq_check_progress', function(data) {
+			if (frm.iiq_check_job_id !== data.job_id) {
+				return;
+			}
+			if (data.stage === 'bytes_uploaded') {
+				frappe.show_progress(__('Uploading to FTP'), data.bytes, data.total, __('{0} of {1} bytes', [data.bytes, data.total]));
+			} else if (data.stage === 'done' || data.stage === 'failed') {
+				frappe.hide_progress();
+				frm.iiq_check_job_id = null;
+				if (data.stage === 'failed') {
+					frappe.msgprint({title: __('FTP upload failed'), message: data.error, indicator: 'red'});
+				}
+				frm.reload_doc();  // Reload the form to show the upload status
+			}
+		});
+	},
+
 	refresh: function(frm) {
-		if (frm.doc.xlsx_file) {
+		if (frm.doc.xlsx_file || (frm.doc.shards || []).some(shard => shard.shard_file)) {
 			frm.add_custom_button(__('Upload to FTP'), function() {
 				frappe.call({
-					method: 'iiq_check_connect.tools.upload_to_ftp',
+					method: 'iiq_check_connect.jobs.enqueue_upload_to_ftp',
 					args: {
 						export_name: frm.doc.name
 					},
-					freeze: true,
-					freeze_message: __('Uploading, please wait...'),
 					callback: function(r) {
-						if (r.message) {
-							frappe.msgprint(r.message);
+						if (r.message && r.message.enqueued) {
+							frm.iiq_check_job_id = r.message.job_id;
+							frappe.show_alert({message: __('Upload queued'), indicator: 'blue'});
 						}
-						frm.reload_doc();  // Reload the form after the script has run
 					}
 				});
 			});
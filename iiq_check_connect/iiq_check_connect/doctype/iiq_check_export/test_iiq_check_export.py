@@ -1,9 +1,565 @@
 # Copyright (c) 2024, itsdave GmbH and Contributors
 # See license.txt
 
-# import frappe
+import contextlib
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import frappe
+import pandas as pd
 from frappe.tests.utils import FrappeTestCase
 
+from iiq_check_connect.async_ftp import upload_to_destinations
+from iiq_check_connect.benchmarks.ftp_server import local_ftp_server
+from iiq_check_connect.benchmarks.ftp_transport import get_destinations
+from iiq_check_connect.benchmarks.import_time import check as check_import_time
+from iiq_check_connect.content_hash import HASH_BLOCKSIZE, copy_and_hash, hash_content
+from iiq_check_connect.data_quality import RecipientCleaner
+from iiq_check_connect.departure_snapshot import get_snapshot_row, write_snapshot_rows
+from iiq_check_connect.export_engine import (
+	append_export_rows,
+	create_export_documents,
+	get_missing_dates,
+	split_export_rows,
+	write_frame_export,
+	write_private_file,
+)
+from iiq_check_connect.export_preview import get_cleaned_summary
+from iiq_check_connect.export_query import (
+	NO_ROWS,
+	UNMAPPED_SHARD,
+	ensure_export_indexes,
+	get_export_query,
+	get_export_query_indexes,
+	get_shard_condition,
+)
+from iiq_check_connect.export_writer import EXPORT_COLUMNS, ParquetExportWriter, get_export_writer
+from iiq_check_connect.export_shards import get_shard_filename, get_shard_workers, get_shards
+from iiq_check_connect.export_tracking import row_hash
+from iiq_check_connect.ftp_log import FTPLog
+from iiq_check_connect.ftp_session import FTPSession
+from iiq_check_connect.ftp_upload import merge_delivery_results, upload_file_to_destinations
+from iiq_check_connect.tools import get_export_metrics
+
+
+EXPORT_ROWS = [
+	("Muster", "Herr", "max@example.com", "de", "2024-07-15"),
+	("Müller, Jr.", "Frau", "erika@example.com", "nl", "2024-07-15"),
+	("Beispiel", "", "test@example.de", "en", "2024-07-15"),
+]
+
 
 class TestiiQCheckExport(FrappeTestCase):
-	pass
+	def test_export_query_uses_indexes(self):
+		if not frappe.db.table_exists("Reservierung") or not frappe.db.table_exists("Camping Kunde"):
+			raise unittest.SkipTest("Reservierung / Camping Kunde are not installed on this site")
+
+		ensure_export_indexes()
+		settings = frappe._dict(
+			einheit_kategorie=[frappe._dict(einheit_kategorie="Stellplatz")],
+			kundentyp=[frappe._dict(kundentyp="Privat")],
+		)
+		start_of_day = datetime.datetime(2024, 7, 15)
+		indexes = get_export_query_indexes(settings, start_of_day, start_of_day + datetime.timedelta(1))
+
+		self.assertIn("iiq_check_abreise_kategorie_kundennummer", indexes["tabReservierung"]["possible_keys"])
+		camping_kunde = indexes["tabCamping Kunde"]
+		self.assertTrue(
+			camping_kunde["key"] == "PRIMARY" or "iiq_check_kundentyp" in camping_kunde["possible_keys"]
+		)
+
+	def start_ftp_server(self, **kwargs):
+		"""Run a local FTP server (see local_ftp_server) until the end of the test."""
+		try:
+			import pyftpdlib  # noqa: F401
+		except ImportError:
+			raise unittest.SkipTest("pyftpdlib is not installed")
+
+		stack = contextlib.ExitStack()
+		self.addCleanup(stack.close)
+		return stack.enter_context(local_ftp_server(**kwargs))
+
+	def write_local_file(self, content):
+		"""Write content to a temporary export file, returns its path."""
+		local_file = tempfile.NamedTemporaryFile(suffix=".xlsx")
+		local_file.write(content)
+		local_file.flush()
+		self.addCleanup(local_file.close)
+		return local_file.name
+
+	def test_upload_resumes_after_dropped_connection(self):
+		try:
+			from pyftpdlib.handlers import DTPHandler
+		except ImportError:
+			raise unittest.SkipTest("pyftpdlib is not installed")
+
+		class DroppingDTPHandler(DTPHandler):
+			# Drop the connection once, after this many bytes were received
+			drop_after = 300_000
+
+			def handle_read(self):
+				super().handle_read()
+				if DroppingDTPHandler.drop_after and self.tot_bytes_received >= DroppingDTPHandler.drop_after:
+					DroppingDTPHandler.drop_after = 0
+					self.cmd_channel.close()
+					self.close()
+
+			handle_read_event = handle_read
+
+		ftp_server = self.start_ftp_server(dtp_handler=DroppingDTPHandler)
+		content = os.urandom(1_000_000)
+		local_path = self.write_local_file(content)
+
+		def new_session(ftp_log):
+			return FTPSession(
+				"127.0.0.1", ftp_server.user, ftp_server.password, "/", port=ftp_server.port, ftp_log=ftp_log
+			)
+
+		with open(local_path, "rb") as f, self.assertRaises(Exception):
+			new_session(FTPLog()).upload("export.xlsx", f)
+
+		remote_path = os.path.join(ftp_server.directory, "export.xlsx")
+		partial_size = os.path.getsize(remote_path)
+		self.assertLess(partial_size, len(content))
+
+		ftp_log = FTPLog()
+		session = new_session(ftp_log)
+		with open(local_path, "rb") as f:
+			sent, _ = session.upload("export.xlsx", f, resume=True)
+		session.close()
+
+		self.assertEqual(sent, len(content) - partial_size)
+		self.assertIn(f"REST {partial_size}", [entry.get("command") for entry in ftp_log.entries])
+		with open(remote_path, "rb") as f:
+			self.assertEqual(f.read(), content)
+
+	def test_unchanged_upload_is_skipped(self):
+		ftp_server = self.start_ftp_server()
+		content = os.urandom(100_000)
+		local_path = self.write_local_file(content)
+
+		session = FTPSession("127.0.0.1", ftp_server.user, ftp_server.password, "/", port=ftp_server.port)
+		self.addCleanup(session.close)
+
+		def upload(content_hash):
+			with open(local_path, "rb") as f:
+				return session.upload_if_changed("export.xlsx", f, content_hash=content_hash, checksum_file=True)
+
+		self.assertIsNotNone(upload(hash_content(content)))
+		self.assertTrue(os.path.exists(os.path.join(ftp_server.directory, "export.xlsx.sha256")))
+
+		# Same content again: skipped, a different hash with the same size is sent again
+		self.assertIsNone(upload(hash_content(content)))
+		self.assertIsNotNone(upload(hash_content(content[::-1])))
+
+	def test_async_transport_uploads_to_destinations_concurrently(self):
+		# Every response is delayed, so the sessions overlap if the uploads run concurrently
+		ftp_server = self.start_ftp_server(latency=0.05)
+		content = os.urandom(500_000)
+		local_path = self.write_local_file(content)
+
+		destinations = get_destinations(ftp_server, 3)
+		results = upload_to_destinations(destinations, "export.xlsx", local_path)
+
+		for destination, result in zip(destinations, results):
+			self.assertEqual(result["status"], "uploaded", result.get("error"))
+			with open(os.path.join(ftp_server.directory, destination.title, "export.xlsx"), "rb") as f:
+				self.assertEqual(f.read(), content)
+			commands = [entry["command"] for entry in result["log"].entries if "command" in entry]
+			self.assertIn("PASS ****", commands)
+			self.assertIn("STOR export.xlsx (completion)", commands)
+
+		self.assertEqual(ftp_server.peak_connections, len(destinations))
+
+	def test_export_file_is_uploaded_to_every_destination(self):
+		ftp_server = self.start_ftp_server()
+		content = os.urandom(200_000)
+		export_file = frappe._dict(
+			file_doc=frappe._dict(file_name="export.xlsx", creation=frappe.utils.now_datetime()),
+			file_path=self.write_local_file(content),
+			content_hash=hash_content(content),
+		)
+		destinations = get_destinations(ftp_server, 3)
+		destinations[2].password = "wrong"
+
+		results = upload_file_to_destinations(frappe._dict(ftp_transport="ftplib"), destinations, export_file)
+
+		# A failing destination does not stop the uploads to the others
+		self.assertEqual([result["destination"] for result in results], [d.title for d in destinations])
+		self.assertEqual([result["status"] for result in results], ["uploaded", "uploaded", "failed"])
+		for destination in destinations[:2]:
+			with open(os.path.join(ftp_server.directory, destination.title, "export.xlsx"), "rb") as f:
+				self.assertEqual(f.read(), content)
+
+		# The results of all shard files of an export are combined per destination
+		delivery = merge_delivery_results([results[0], dict(results[0], status="unchanged")])
+		self.assertEqual((delivery["status"], delivery["byte_count"]), ("uploaded", 2 * len(content)))
+		self.assertEqual(merge_delivery_results([results[0], results[2]])["status"], "failed")
+
+	def test_recipient_cleaner_drops_invalid_and_merges_duplicates(self):
+		df = pd.DataFrame([
+			{"name": "Muster", "salutation": "", "email": " Max@Example.com ", "language": "DE"},
+			{"name": "Muster", "salutation": "Herr", "email": "max@example.com", "language": "DE"},
+			{"name": "Beispiel", "salutation": "Frau", "email": "erika@@example", "language": "NL"},
+			{"name": "Test", "salutation": "Frau", "email": "test@example.de", "language": "AT"},
+		])
+		cleaner = RecipientCleaner()
+		cleaned, valid_rows = cleaner.clean_frame(df)
+
+		self.assertEqual(list(cleaned["email"]), ["max@example.com", "test@example.de"])
+		# The first row of the guest is kept
+		self.assertEqual(cleaned.iloc[0]["salutation"], "")
+		self.assertEqual(len(valid_rows), 3)
+		self.assertEqual((cleaner.invalid_emails, cleaner.merged_duplicates), (1, 1))
+
+		# Streamed rows are cleaned by the same rule
+		streaming_cleaner = RecipientCleaner()
+		kept = []
+		for row in df.to_dict("records"):
+			email = streaming_cleaner.clean_email(row["email"])
+			if email and not streaming_cleaner.is_duplicate(email):
+				kept.append(dict(row, email=email))
+		self.assertEqual(kept, cleaned.to_dict("records"))
+		self.assertEqual((streaming_cleaner.invalid_emails, streaming_cleaner.merged_duplicates), (1, 1))
+
+	def test_shards_follow_the_settings(self):
+		settings = frappe._dict(
+			einheit_kategorie=[frappe._dict(einheit_kategorie=k) for k in ("Stellplatz", "Mietunterkunft", "Stellplatz")],
+			language_mapping=[
+				frappe._dict(country_code="DE", language_string="de"),
+				frappe._dict(country_code="AT", language_string="de"),
+				frappe._dict(country_code="NL", language_string="nl"),
+			],
+			default_language="en",
+			shard_workers=0,
+		)
+		self.assertEqual(get_shards(settings, "category"), ["Stellplatz", "Mietunterkunft"])
+		self.assertEqual(get_shards(settings, "language"), ["de", "nl", "en"])
+		# Never more workers than shards
+		self.assertLessEqual(get_shard_workers(settings, 2), 2)
+		self.assertEqual(get_shard_workers(frappe._dict(shard_workers=8), 3), 3)
+
+		# Shards which scrub to the same string still get their own files
+		departure_date = datetime.date(2024, 7, 15)
+		self.assertNotEqual(
+			get_shard_filename(departure_date, "csv", 1, "A-B"),
+			get_shard_filename(departure_date, "csv", 2, "A B"),
+		)
+
+	def test_language_shards_cover_every_row_once(self):
+		fields = {"language": frappe.qb.DocType("iiQ-Check Departure Snapshot").land}
+
+		def shard_conditions(mapping, default_language):
+			settings = frappe._dict(
+				language_mapping=[frappe._dict(country_code=c, language_string=l) for c, l in mapping],
+				default_language=default_language,
+			)
+			return {
+				shard: get_shard_condition(settings, fields, "language", shard).get_sql()
+				for shard in get_shards(settings, "language")
+			}
+
+		# The last row of a duplicated country wins, a row without country code maps the customers without land
+		conditions = shard_conditions([("DE", "de"), ("AT", "de"), ("DE", "at"), (None, "nl")], None)
+		self.assertEqual(
+			conditions,
+			{
+				"de": "land IN ('AT')",
+				"at": "land IN ('DE')",
+				"nl": "land IS NULL",
+				UNMAPPED_SHARD: "land NOT IN ('DE','AT')",
+			},
+		)
+
+		# A shard left without countries selects nothing, the default shard gets the unmapped countries
+		conditions = shard_conditions([("DE", "de"), ("DE", "at")], "en")
+		self.assertEqual(conditions["de"], NO_ROWS.get_sql())
+		self.assertEqual(conditions["at"], "land IN ('DE')")
+		self.assertIn("land NOT IN ('DE')", conditions["en"])
+		self.assertIn("land IS NULL", conditions["en"])
+
+	def test_csv_writers_write_header_and_rows(self):
+		for export_format, decode in (("csv", lambda data: data), ("csv.gz", gzip.decompress)):
+			with self.subTest(export_format=export_format):
+				with get_export_writer(export_format)() as writer:
+					writer.write_rows(EXPORT_ROWS)
+					with writer.close() as f:
+						text = decode(f.read()).decode("utf-8")
+
+				self.assertEqual(writer.row_count, len(EXPORT_ROWS))
+				self.assertEqual(list(csv.reader(io.StringIO(text))), [EXPORT_COLUMNS] + [list(row) for row in EXPORT_ROWS])
+
+	def test_parquet_writer_writes_all_rows(self):
+		try:
+			import pyarrow.parquet
+		except ImportError:
+			raise unittest.SkipTest("pyarrow is not installed")
+
+		# Smaller row groups, so the rows are flushed more than once
+		with patch.object(ParquetExportWriter, "ROW_GROUP_SIZE", 2), get_export_writer("parquet")() as writer:
+			writer.write_rows(EXPORT_ROWS)
+			with writer.close() as f:
+				table = pyarrow.parquet.read_table(io.BytesIO(f.read()))
+
+		self.assertEqual(table.column_names, EXPORT_COLUMNS)
+		self.assertEqual([tuple(row.values()) for row in table.to_pylist()], EXPORT_ROWS)
+
+	def test_xlsx_writer_writes_header_and_rows(self):
+		import openpyxl
+
+		with get_export_writer()() as writer:
+			writer.write_rows(EXPORT_ROWS)
+			with writer.close() as f:
+				sheet = openpyxl.load_workbook(io.BytesIO(f.read()), read_only=True).active
+				rows = list(sheet.iter_rows(values_only=True))
+
+		# Empty cells are read back as None
+		expected = [tuple(value or None for value in row) for row in EXPORT_ROWS]
+		self.assertEqual(writer.row_count, len(EXPORT_ROWS))
+		self.assertEqual(rows, [tuple(EXPORT_COLUMNS)] + expected)
+
+	def test_default_export_writes_xlsx_without_pandas(self):
+		import openpyxl
+
+		df = pd.DataFrame(EXPORT_ROWS, columns=EXPORT_COLUMNS)
+		df.loc[2, "salutation"] = None
+		with patch.object(pd.DataFrame, "to_excel", side_effect=AssertionError("to_excel must not be used")):
+			with write_frame_export(df) as f:
+				rows = list(openpyxl.load_workbook(io.BytesIO(f.read()), read_only=True).active.iter_rows(values_only=True))
+
+		expected = [tuple(value or None for value in row) for row in EXPORT_ROWS]
+		self.assertEqual(rows, [tuple(EXPORT_COLUMNS)] + expected)
+
+	def test_export_file_is_copied_and_hashed_block_by_block(self):
+		content = os.urandom(3 * HASH_BLOCKSIZE + 17)
+
+		class BlockReader(io.BytesIO):
+			# Fails the test if the whole file is read at once
+			def read(self, size=-1):
+				if size is None or size < 0 or size > HASH_BLOCKSIZE:
+					raise AssertionError(f"read({size}) of the whole export file")
+				return super().read(size)
+
+		target = io.BytesIO()
+		self.assertEqual(
+			copy_and_hash(BlockReader(content), target),
+			(len(content), hash_content(content), hashlib.md5(content).hexdigest()),
+		)
+		self.assertEqual(target.getvalue(), content)
+
+		# Private files of the same name are not overwritten
+		written = [write_private_file(BlockReader(content), "iiq-check-test-export.csv.gz") for _ in range(2)]
+		for file in written:
+			self.addCleanup(os.remove, frappe.get_site_path("private", "files", file.file_name))
+			with open(frappe.get_site_path("private", "files", file.file_name), "rb") as f:
+				self.assertEqual(f.read(), content)
+			self.assertEqual((file.file_size, file.sha256), (len(content), hash_content(content)))
+		self.assertNotEqual(written[0].file_url, written[1].file_url)
+		self.assertTrue(written[1].file_name.endswith(".csv.gz"))
+
+	def test_bulk_created_exports_are_attached_to_their_files(self):
+		created_on = frappe.utils.now_datetime()
+		exports = [
+			{"departure_date": datetime.date(2000, 7, day), "export_file": io.BytesIO(f"export {day}".encode()), "number_of_records": day}
+			for day in (1, 2)
+		]
+
+		export_names = create_export_documents(exports, created_on, "csv")
+
+		self.assertEqual(len(set(export_names)), 2)
+		for export_name, export in zip(export_names, exports):
+			export_doc = frappe.get_doc("iiQ-Check Export", export_name)
+			self.assertEqual(export_doc.number_of_recipients, export["number_of_records"])
+			self.assertEqual(export_doc.departure_date, export["departure_date"])
+			file_doc = frappe.get_doc("File", {"file_url": export_doc.xlsx_file})
+			self.assertEqual(
+				(file_doc.attached_to_doctype, file_doc.attached_to_name, file_doc.attached_to_field),
+				("iiQ-Check Export", export_name, "xlsx_file"),
+			)
+			self.assertTrue(file_doc.file_url.startswith("/private/files/iiq-check-export-2000-07-0"))
+			self.assertEqual(file_doc.get_content(), export["export_file"].getvalue())
+			self.assertEqual(export_doc.content_hash, hash_content(export["export_file"].getvalue()))
+
+	def test_failed_bulk_insert_removes_the_written_files(self):
+		bulk_insert = frappe.db.bulk_insert
+		file_rows = []
+
+		def failing_bulk_insert(doctype, fields, values, *args, **kwargs):
+			if doctype == "File":
+				file_rows.extend(values)
+				return bulk_insert(doctype, fields, values, *args, **kwargs)
+			raise frappe.DuplicateEntryError
+
+		exports = [{"departure_date": datetime.date(2000, 7, 3), "export_file": io.BytesIO(b"export"), "number_of_records": 1}]
+		with patch.object(frappe.db, "bulk_insert", failing_bulk_insert):
+			with self.assertRaises(frappe.DuplicateEntryError):
+				create_export_documents(exports, frappe.utils.now_datetime(), "csv")
+
+		self.assertEqual(len(file_rows), 1)
+		# File rows start with name, creation, modified, owner, modified_by, file_name
+		self.assertFalse(frappe.db.exists("File", file_rows[0][0]))
+		self.assertFalse(os.path.exists(frappe.get_site_path("private", "files", file_rows[0][5])))
+		self.assertFalse(frappe.db.exists("iiQ-Check Export", {"departure_date": datetime.date(2000, 7, 3)}))
+
+	def test_unknown_export_format_is_rejected(self):
+		with self.assertRaises(ValueError):
+			get_export_writer("ods")
+
+	def test_backfill_splits_rows_by_departure_date(self):
+		first_date, second_date = datetime.date(2024, 7, 15), datetime.date(2024, 7, 17)
+		self.assertEqual(
+			get_missing_dates(first_date, second_date, {datetime.date(2024, 7, 16)}), [first_date, second_date]
+		)
+
+		def export_row(kundennummer, email, departure_date):
+			return {
+				"name": "Muster", "salutation": "Herr", "email": email, "language": "NL",
+				"kundennummer": kundennummer, "abreise": departure_date, "departure_date": departure_date,
+			}
+
+		chunks = [
+			[export_row("K1", "max@example.com", first_date), export_row("K2", "erika@@example", first_date)],
+			[
+				export_row("K3", "MAX@example.com", first_date),
+				export_row("K4", "max@example.com", second_date),
+				export_row("K5", "test@example.de", datetime.date(2024, 7, 16)),
+			],
+		]
+		writers, cleaners, hashes = split_export_rows(
+			chunks, {first_date, second_date}, get_export_writer("csv"), lambda code: code.lower(), RecipientCleaner
+		)
+		for writer in writers.values():
+			self.addCleanup(writer.discard)
+
+		self.assertEqual(set(writers), {first_date, second_date})
+		# The duplicate of the first date is merged, the same guest on another date is kept
+		self.assertEqual((writers[first_date].row_count, writers[second_date].row_count), (1, 1))
+		self.assertEqual((cleaners[first_date].invalid_emails, cleaners[first_date].merged_duplicates), (1, 1))
+		self.assertEqual(hashes[first_date], {row_hash("K1", first_date), row_hash("K3", first_date)})
+		self.assertEqual(hashes[second_date], {row_hash("K4", second_date)})
+
+	def test_incremental_export_skips_exported_reservations(self):
+		departure_at = datetime.datetime(2024, 7, 15, 10)
+		rows = [
+			{"name": "Muster", "salutation": "Herr", "email": "max@example.com", "language": "DE", "kundennummer": "K1", "abreise": departure_at},
+			{"name": "Müller", "salutation": "Frau", "email": "erika@example.com", "language": "NL", "kundennummer": "K2", "abreise": departure_at},
+			{"name": "Test", "salutation": "", "email": "", "language": "AT", "kundennummer": "K3", "abreise": departure_at},
+		]
+		hashes = set()
+		with get_export_writer("csv")() as writer:
+			append_export_rows(writer, rows, str.lower, "2024-07-15", {row_hash("K1", departure_at)}, hashes, RecipientCleaner())
+			writer.discard()
+
+		# K1 was exported before, K3 has no valid email
+		self.assertEqual(writer.row_count, 1)
+		self.assertEqual(hashes, {row_hash("K2", departure_at)})
+
+	def test_incremental_export_skips_recipients_exported_under_another_reservation(self):
+		departure_at = datetime.datetime(2024, 7, 15, 10)
+		rows = [
+			{"name": "Muster", "salutation": "Herr", "email": "max@example.com", "language": "DE", "kundennummer": "K1", "abreise": departure_at},
+			{"name": "Muster", "salutation": "Herr", "email": " Max@Example.com", "language": "DE", "kundennummer": "K4", "abreise": departure_at},
+			{"name": "Müller", "salutation": "Frau", "email": "erika@example.com", "language": "NL", "kundennummer": "K2", "abreise": departure_at},
+		]
+		cleaner = RecipientCleaner()
+		# max@example.com was sent with K1 by the first export of the day
+		cleaner.add_exported({"max@example.com"})
+		hashes = set()
+		with get_export_writer("csv")() as writer:
+			append_export_rows(writer, rows, str.lower, "2024-07-15", {row_hash("K1", departure_at)}, hashes, cleaner)
+			writer.discard()
+
+		# K4 is a new reservation, but its guest is no new recipient
+		self.assertEqual(writer.row_count, 1)
+		self.assertEqual(cleaner.merged_duplicates, 1)
+		self.assertEqual(hashes, {row_hash("K4", departure_at), row_hash("K2", departure_at)})
+
+	def test_incremental_export_queries_changes_since_the_watermark(self):
+		settings = frappe._dict(
+			einheit_kategorie=[frappe._dict(einheit_kategorie="Stellplatz")],
+			kundentyp=[frappe._dict(kundentyp="Privat")],
+		)
+		start_of_day = datetime.datetime(2024, 7, 15)
+		end_of_day = start_of_day + datetime.timedelta(1)
+		watermark = datetime.datetime(2024, 7, 14, 7)
+
+		self.assertNotIn("modified", str(get_export_query(settings, start_of_day, end_of_day)))
+		for use_departure_snapshot, tables in ((0, ["Reservierung", "Camping Kunde"]), (1, ["iiQ-Check Departure Snapshot"])):
+			with self.subTest(use_departure_snapshot=use_departure_snapshot):
+				settings.use_departure_snapshot = use_departure_snapshot
+				sql = str(get_export_query(settings, start_of_day, end_of_day, modified_since=watermark))
+				self.assertIn("2024-07-14", sql)
+				for table in tables:
+					self.assertIn(f"`tab{table}`.`modified`>", sql)
+
+	def test_export_metrics_include_the_upload_stages(self):
+		departure_date = datetime.date(2000, 1, 3)
+		export_doc = frappe.get_doc({
+			"doctype": "iiQ-Check Export",
+			"departure_date": departure_date,
+			"metrics": [{"stage": "sql", "seconds": 0.5, "row_count": 10}],
+		}).insert(ignore_permissions=True)
+		ftp_log = frappe.get_doc({
+			"doctype": "iiQ-Check FTP Log",
+			"export": export_doc.name,
+			"destination": "ftp.example.com",
+			"status": "uploaded",
+			"logged_on": frappe.utils.now_datetime(),
+			"metrics": [
+				{"stage": "ftp_login", "seconds": 0.2},
+				{"stage": "ftp_transfer", "seconds": 1.5, "byte_count": 4096},
+			],
+		}).insert(ignore_permissions=True)
+
+		rows = get_export_metrics(departure_date, departure_date)
+		self.assertEqual(
+			[(row.export, row.stage, row.ftp_log) for row in rows],
+			[(export_doc.name, "sql", None), (export_doc.name, "ftp_login", ftp_log.name), (export_doc.name, "ftp_transfer", ftp_log.name)],
+		)
+		transfer = get_export_metrics(departure_date, departure_date, stage="ftp_transfer")
+		self.assertEqual([(row.destination, row.byte_count) for row in transfer], [("ftp.example.com", 4096)])
+
+	def test_preview_counts_the_cleaned_recipients_in_sql(self):
+		departure_at = datetime.datetime(2000, 2, 1, 10)
+		rows = [
+			("K1", departure_at, "Stellplatz", "max@example.com"),
+			("K2", departure_at, "Stellplatz", " MAX@Example.com "),
+			("K3", departure_at, "Mietobjekt", "max@example.com"),
+			("K4", departure_at, "Stellplatz", "not-an-email"),
+			("K5", departure_at + datetime.timedelta(1), "Stellplatz", "max@example.com"),
+		]
+		write_snapshot_rows([
+			get_snapshot_row(
+				frappe._dict(name=f"_Test Preview {kundennummer}", kundennummer=kundennummer, abreise=abreise, kategorie=kategorie, modified=abreise),
+				frappe._dict(nachname="Muster", anrede="Herr", email=email, land="DE", kundentyp="Privat", modified=abreise),
+			)
+			for kundennummer, abreise, kategorie, email in rows
+		])
+		settings = frappe._dict(
+			use_departure_snapshot=1,
+			einheit_kategorie=[frappe._dict(einheit_kategorie="Stellplatz"), frappe._dict(einheit_kategorie="Mietobjekt")],
+			kundentyp=[frappe._dict(kundentyp="Privat")],
+		)
+		start_of_range = datetime.datetime(2000, 2, 1)
+
+		summary, totals, sample = get_cleaned_summary(
+			settings, start_of_range, start_of_range + datetime.timedelta(2), str.lower, 10
+		)
+
+		# One recipient per departure date, counted in both Einheit-Kategorien of the first day
+		self.assertEqual(
+			totals,
+			{"total_rows": 2, "distinct_emails": 1, "invalid_emails_dropped": 1, "duplicate_recipients_merged": 2},
+		)
+		self.assertEqual(sorted(summary), [("Mietobjekt", "Privat", "DE", 1), ("Stellplatz", "Privat", "DE", 2)])
+		self.assertEqual([row["email"] for row in sample], ["max@example.com", "max@example.com"])
+
+	def test_scheduler_and_tools_do_not_import_pandas(self):
+		check_import_time(["iiq_check_connect.scheduler", "iiq_check_connect.tools"])
@@ -0,0 +1,130 @@
+# Copyright (c) 2024, itsdave GmbH and Contributors
+# See license.txt
+
+import csv
+import datetime
+import io
+import zipfile
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from iiq_check_connect.export_engine import create_export_document, get_missing_dates
+from iiq_check_connect.export_tracking import record_exported_rows, row_hash
+from iiq_check_connect.ftp_log import FTPLog
+from iiq_check_connect.ftp_upload import insert_ftp_log
+from iiq_check_connect.metrics import ExportMetrics
+from iiq_check_connect.retention import (
+	ACTIVITY_LOG_SUBJECT,
+	archive_month,
+	delete_exports,
+	ensure_archive_folder,
+	get_archived_dates,
+	get_expired_exports,
+	parse_archived_dates,
+	prune_logs,
+)
+
+
+class TestiiQCheckExportArchive(FrappeTestCase):
+	def make_export(self, departure_date):
+		content = f"name,email\nMuster,max-{departure_date}@example.com\n".encode()
+		export_name = create_export_document(departure_date, io.BytesIO(content), 1, frappe.utils.now_datetime(), "csv")
+		return next(e for e in get_expired_exports(datetime.date(2001, 1, 1)) if e.name == export_name)
+
+	def read_archive(self, archive_doc):
+		file_doc = frappe.get_doc("File", {"file_url": archive_doc.archive_file})
+		with zipfile.ZipFile(io.BytesIO(file_doc.get_content())) as archive_zip:
+			return {name: archive_zip.read(name) for name in archive_zip.namelist()}
+
+	def test_archive_month_appends_exports_and_manifests(self):
+		ensure_archive_folder()
+		first_exports = [self.make_export(datetime.date(2000, 1, 3)), self.make_export(datetime.date(2000, 1, 5))]
+		archive_doc = archive_month("2000-01", first_exports)
+
+		files = self.read_archive(archive_doc)
+		manifest = list(csv.DictReader(io.StringIO(files["manifest.csv"].decode())))
+		self.assertEqual([row["export"] for row in manifest], [e.name for e in first_exports])
+		self.assertEqual(len(files), 3)
+		self.assertEqual(archive_doc.export_count, 2)
+		first_archive_file = archive_doc.archive_file
+
+		# A later run adds its exports and its own manifest, the previous file is replaced
+		late_export = self.make_export(datetime.date(2000, 1, 4))
+		archive_doc = archive_month("2000-01", [late_export])
+
+		files = self.read_archive(archive_doc)
+		self.assertIn("manifest.csv", files)
+		manifest = list(csv.DictReader(io.StringIO(files["manifest-2.csv"].decode())))
+		self.assertEqual([row["export"] for row in manifest], [late_export.name])
+		self.assertEqual(archive_doc.export_count, 3)
+		self.assertEqual(
+			(archive_doc.first_departure_date, archive_doc.last_departure_date),
+			(datetime.date(2000, 1, 3), datetime.date(2000, 1, 5)),
+		)
+		self.assertEqual(archive_doc.archived_dates, "2000-01-03\n2000-01-04\n2000-01-05")
+		self.assertFalse(frappe.db.exists("File", {"file_url": first_archive_file}))
+
+	def test_archived_dates_count_as_exported(self):
+		ensure_archive_folder()
+		exports = [self.make_export(datetime.date(2000, 3, 10)), self.make_export(datetime.date(2000, 3, 12))]
+		archive_month("2000-03", exports)
+		delete_exports([e.name for e in exports])
+
+		from_date, to_date = datetime.date(2000, 3, 9), datetime.date(2000, 3, 13)
+		archived_dates = get_archived_dates(from_date, to_date)
+		self.assertEqual(archived_dates, {datetime.date(2000, 3, 10), datetime.date(2000, 3, 12)})
+		self.assertEqual(
+			get_missing_dates(from_date, to_date, archived_dates),
+			[datetime.date(2000, 3, 9), datetime.date(2000, 3, 11), datetime.date(2000, 3, 13)],
+		)
+
+		# Archives written before the dates were recorded cover their whole range
+		legacy_archive = frappe._dict(
+			archived_dates=None,
+			first_departure_date=datetime.date(2000, 3, 10),
+			last_departure_date=datetime.date(2000, 3, 12),
+		)
+		self.assertEqual(len(parse_archived_dates(legacy_archive)), 3)
+
+	def test_delete_exports_removes_linked_documents(self):
+		export = self.make_export(datetime.date(2000, 5, 20))
+		export_doc = frappe.get_doc("iiQ-Check Export", export.name)
+		record_exported_rows(export.name, export.departure_date, {row_hash("K1", export.departure_date)})
+		ftp_log = FTPLog()
+		ftp_log.append("Upload started")
+		metrics = ExportMetrics()
+		with metrics.stage("ftp_transfer"):
+			pass
+		log_name = insert_ftp_log(export.name, ftp_log, "uploaded", "ftp.example.com", metrics)
+
+		delete_exports([export.name])
+
+		self.assertFalse(frappe.db.exists("iiQ-Check Export", export.name))
+		self.assertFalse(frappe.db.exists("File", {"file_url": export_doc.xlsx_file}))
+		self.assertFalse(frappe.db.exists("iiQ-Check Exported Reservation", {"export": export.name}))
+		self.assertFalse(frappe.db.exists("iiQ-Check FTP Log", log_name))
+		for child_doctype in ("iiQ-Check FTP Log Entry", "iiQ-Check Export Metric"):
+			self.assertFalse(frappe.db.exists(child_doctype, {"parent": log_name}))
+
+	def test_prune_logs_keeps_recent_entries(self):
+		cutoff = frappe.utils.now_datetime() - datetime.timedelta(days=30)
+
+		def activity_log(creation):
+			doc = frappe.get_doc({"doctype": "Activity Log", "subject": ACTIVITY_LOG_SUBJECT, "status": "Success"})
+			doc.insert(ignore_permissions=True)
+			frappe.db.set_value("Activity Log", doc.name, "creation", creation, update_modified=False)
+			return doc.name
+
+		old_log = activity_log(cutoff - datetime.timedelta(days=1))
+		recent_log = activity_log(cutoff + datetime.timedelta(days=1))
+		old_version = frappe.get_doc({
+			"doctype": "Version", "ref_doctype": "iiQ-Check Settings", "docname": "iiQ-Check Settings", "data": "{}"
+		}).insert(ignore_permissions=True)
+		frappe.db.set_value("Version", old_version.name, "creation", cutoff - datetime.timedelta(days=1), update_modified=False)
+
+		prune_logs(cutoff)
+
+		self.assertFalse(frappe.db.exists("Activity Log", old_log))
+		self.assertTrue(frappe.db.exists("Activity Log", recent_log))
+		self.assertFalse(frappe.db.exists("Version", old_version.name))
@@ -0,0 +1,59 @@
+# Copyright (c) 2024, itsdave GmbH and Contributors
+# See license.txt
+
+import datetime
+import io
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from iiq_check_connect.export_engine import create_export_document
+from iiq_check_connect.ftp_log import FTPLog
+from iiq_check_connect.ftp_upload import insert_ftp_log
+
+
+class TestiiQCheckFTPLog(FrappeTestCase):
+	def test_log_keeps_the_latest_entries(self):
+		ftp_log = FTPLog(max_entries=3)
+		for number in range(5):
+			ftp_log.append(f"Message {number}")
+		ftp_log.command("NOOP", "200 NOOP ok", 0.001)
+
+		self.assertEqual(ftp_log.messages, ["Message 3", "Message 4"])
+		self.assertEqual((len(ftp_log), ftp_log.command_count, ftp_log.dropped), (3, 1, 3))
+
+	def test_secret_arguments_are_masked(self):
+		ftp_log = FTPLog()
+		ftp_log.command("PASS geheim", "230 Login successful.", 0.012)
+		ftp_log.command("acct geheim", "202 Command not implemented.", 0.001)
+		ftp_log.command("STOR export.xlsx", "226 Transfer complete.", 1.5)
+
+		self.assertEqual([entry["command"] for entry in ftp_log.entries], ["PASS ****", "acct ****", "STOR export.xlsx"])
+		self.assertEqual(ftp_log.entries[0]["response_code"], "230")
+		self.assertNotIn("geheim", "\n".join(ftp_log.lines()))
+
+	def test_only_the_latest_logs_of_an_export_are_kept(self):
+		export_name = create_export_document(
+			datetime.date(2000, 9, 1), io.BytesIO(b"export"), 1, frappe.utils.now_datetime(), "csv"
+		)
+		log_names = []
+		with patch("iiq_check_connect.ftp_upload.MAX_LOGS_PER_EXPORT", 2):
+			for attempt in range(3):
+				ftp_log = FTPLog(max_entries=1)
+				ftp_log.append(f"Attempt {attempt}")
+				ftp_log.append("Upload failed")
+				log_names.append(insert_ftp_log(export_name, ftp_log, "failed", "ftp.example.com"))
+				# One attempt per minute, so the order by creation is unambiguous
+				frappe.db.set_value(
+					"iiQ-Check FTP Log", log_names[-1], "creation",
+					frappe.utils.now_datetime() - datetime.timedelta(minutes=3 - attempt), update_modified=False,
+				)
+
+		self.assertEqual(
+			sorted(frappe.get_all("iiQ-Check FTP Log", filters={"export": export_name}, pluck="name")),
+			sorted(log_names[1:]),
+		)
+		log_doc = frappe.get_doc("iiQ-Check FTP Log", log_names[-1])
+		self.assertEqual((log_doc.dropped_entries, len(log_doc.entries)), (1, 1))
+		self.assertFalse(frappe.db.exists("iiQ-Check FTP Log Entry", {"parent": log_names[0]}))
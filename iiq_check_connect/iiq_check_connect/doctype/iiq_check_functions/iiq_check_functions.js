@@ -2,7 +2,60 @@
 // For license information, please see license.txt
 
 frappe.ui.form.on('iiQ-Check Functions', {
-	// refresh: function(frm) {
+	onload: function(frm) {
+		frappe.realtime.off('iiq_check_progress');
+		frappe.realtime.on('iiq_check_progress', function(data) {
+			if (frm.iiq_check_job_id !== data.job_id) {
+				return;
+			}
+			if (data.stage === 'rows_fetched') {
+				frm.dashboard.set_headline(__('Rows fetched: {0}', [data.rows]));
+			} else if (data.stage === 'rows_written') {
+				frm.dashboard.set_headline(__('Rows written: {0}', [data.rows]));
+			} else if (data.stage === 'done') {
+				frm.dashboard.clear_headline();
+				frm.iiq_check_job_id = null;
+				if (data.export_name) {
+					frappe.msgprint(__('Export {0} prepared.', [
+						`<a href="/app/iiq-check-export/${data.export_name}">${data.export_name}</a>`
+					]));
+				} else if (data.message) {
+					frappe.msgprint(data.message);
+				}
+			} else if (data.stage === 'failed') {
+				frm.dashboard.clear_headline();
+				frm.iiq_check_job_id = null;
+				frappe.msgprint({title: __('Job failed'), message: data.error, indicator: 'red'});
+			}
+		});
+	},
 
-	// }
+	prepare_export: function(frm) {
+		enqueue_job(frm, 'iiq_check_connect.jobs.enqueue_prepare_export', {}, __('Export queued...'));
+	},
+
+	backfill_export: function(frm) {
+		enqueue_job(frm, 'iiq_check_connect.jobs.enqueue_backfill_export', {
+			from_date: frm.doc.backfill_from_date,
+			to_date: frm.doc.backfill_to_date
+		}, __('Backfill queued...'));
+	},
+
+	rebuild_departure_snapshot: function(frm) {
+		enqueue_job(frm, 'iiq_check_connect.jobs.enqueue_rebuild_departure_snapshot', {}, __('Snapshot rebuild queued...'));
+	}
 });
+
+// Start a background job and follow its progress events
+function enqueue_job(frm, method, args, headline) {
+	frappe.call({
+		method: method,
+		args: args,
+		callback: function(r) {
+			if (r.message && r.message.enqueued) {
+				frm.iiq_check_job_id = r.message.job_id;
+				frm.dashboard.set_headline(headline);
+			}
+		}
+	});
+}
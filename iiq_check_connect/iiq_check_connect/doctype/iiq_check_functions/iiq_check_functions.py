@@ -3,9 +3,58 @@
 
 import frappe
 from frappe.model.document import Document
-from iiq_check_connect.tools import prepare_export as tools_prepare_export
+from iiq_check_connect.departure_snapshot import check_snapshot
+from iiq_check_connect.export_preview import preview_export as tools_preview_export
+from iiq_check_connect.export_engine import prepare_export as tools_prepare_export
+from iiq_check_connect.export_engine import prepare_incremental_export as tools_prepare_incremental_export
+from iiq_check_connect.jobs import enqueue_backfill_export, enqueue_rebuild_departure_snapshot
 
 class iiQCheckFunctions(Document):
 	@frappe.whitelist()
 	def prepare_export(self):
 		tools_prepare_export(interactive=True)
+
+	@frappe.whitelist()
+	def prepare_incremental_export(self):
+		tools_prepare_incremental_export(interactive=True)
+
+	@frappe.whitelist()
+	def backfill_export(self):
+		# A backfill over several weeks takes longer than a web request
+		return enqueue_backfill_export(self.backfill_from_date, self.backfill_to_date)
+
+	@frappe.whitelist()
+	def preview_export(self):
+		preview = tools_preview_export(self.backfill_from_date, self.backfill_to_date or self.backfill_from_date)
+		message = frappe._("{0} rows ({1} email addresses) departing from {2} to {3}, counted in {4} ms.").format(
+			preview["total_rows"], preview["distinct_emails"], preview["from_date"], preview["to_date"], preview["milliseconds"])
+		for key, label in (("per_category", frappe._("Einheit-Kategorie")), ("per_kundentyp", frappe._("Kundentyp")), ("per_language", frappe._("Language"))):
+			counts = ", ".join(f"{value}: {count}" for value, count in preview[key].items())
+			message += f"<br>{label}: {counts or '-'}"
+		if preview["invalid_emails_dropped"] or preview["duplicate_recipients_merged"]:
+			message += "<br>" + frappe._("Invalid emails dropped: {0}, duplicate recipients merged: {1}").format(
+				preview["invalid_emails_dropped"], preview["duplicate_recipients_merged"])
+		if preview["default_language_fallback"]:
+			countries = ", ".join(f"{country or '?'}: {count}" for country, count in preview["fallback_countries"].items())
+			message += "<br>" + frappe._("Default language {0} used for: {1}").format(preview["default_language"], countries)
+		if preview["existing_exports"]:
+			message += "<br>" + frappe._("Exports exist for: {0}").format(", ".join(preview["existing_exports"]))
+		frappe.msgprint(message, title=frappe._("Export Preview"))
+
+	@frappe.whitelist()
+	def rebuild_departure_snapshot(self):
+		return enqueue_rebuild_departure_snapshot()
+
+	@frappe.whitelist()
+	def check_departure_snapshot(self):
+		result = check_snapshot()
+		if result["consistent"]:
+			frappe.msgprint(frappe._("The departure snapshot matches all {0} reservations from {1} to {2}.").format(
+				result["checked"], result["from_date"], result["to_date"]))
+			return
+		message = frappe._("The departure snapshot differs from the reservations from {0} to {1}.").format(
+			result["from_date"], result["to_date"])
+		for key, label in (("missing", frappe._("Missing")), ("unexpected", frappe._("Unexpected")), ("differing", frappe._("Differing"))):
+			if result[key]:
+				message += f"<br>{label}: {', '.join(result[key])}"
+		frappe.msgprint(message, indicator="orange")
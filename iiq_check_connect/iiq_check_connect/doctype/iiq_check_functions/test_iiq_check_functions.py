@@ -1,9 +1,43 @@
 # Copyright (c) 2024, itsdave GmbH and Contributors
 # See license.txt
 
-# import frappe
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from iiq_check_connect.jobs import run_rebuild_departure_snapshot
+from iiq_check_connect.progress import PROGRESS_EVENT
+
 
 class TestiiQCheckFunctions(FrappeTestCase):
-	pass
+	def test_long_running_buttons_are_enqueued(self):
+		functions = frappe.get_single("iiQ-Check Functions")
+		functions.backfill_from_date, functions.backfill_to_date = "2000-01-01", "2000-01-31"
+
+		with patch("iiq_check_connect.jobs.is_job_enqueued", return_value=False), patch("frappe.enqueue") as enqueue:
+			self.assertEqual(functions.backfill_export(), {"job_id": "iiq_check_backfill_export", "enqueued": True})
+			self.assertTrue(functions.rebuild_departure_snapshot()["enqueued"])
+
+		methods = [call.args[0] for call in enqueue.call_args_list]
+		self.assertEqual(
+			methods, ["iiq_check_connect.jobs.run_backfill_export", "iiq_check_connect.jobs.run_rebuild_departure_snapshot"]
+		)
+		backfill_kwargs = enqueue.call_args_list[0].kwargs
+		self.assertEqual((backfill_kwargs["from_date"], backfill_kwargs["to_date"]), ("2000-01-01", "2000-01-31"))
+
+	def test_backfill_needs_a_date_range(self):
+		functions = frappe.get_single("iiQ-Check Functions")
+		functions.backfill_from_date = functions.backfill_to_date = None
+		with patch("frappe.enqueue") as enqueue, self.assertRaises(frappe.ValidationError):
+			functions.backfill_export()
+		enqueue.assert_not_called()
+
+	def test_snapshot_rebuild_job_publishes_its_result(self):
+		with patch("iiq_check_connect.jobs.rebuild_snapshot", return_value=42), patch.object(frappe.db, "commit"):
+			with patch("frappe.publish_realtime") as publish_realtime:
+				run_rebuild_departure_snapshot("iiq_check_rebuild_departure_snapshot", "Administrator")
+
+		event, data = publish_realtime.call_args.args
+		self.assertEqual((event, data["job_id"], data["stage"]), (PROGRESS_EVENT, "iiq_check_rebuild_departure_snapshot", "done"))
+		self.assertIn("42", data["message"])
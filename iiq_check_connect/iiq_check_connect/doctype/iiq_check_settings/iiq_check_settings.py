@@ -1,8 +1,22 @@
 # Copyright (c) 2024, itsdave GmbH and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
+from iiq_check_connect.async_ftp import FTPS_SUPPORTED
+from iiq_check_connect.language_mapping import clear_language_mapping_cache
+from iiq_check_connect.scheduler import clear_schedule_cache
 
 class iiQCheckSettings(Document):
-	pass
+	def validate(self):
+		self.validate_ftp_transport()
+
+	def validate_ftp_transport(self):
+		if self.ftp_transport != "asyncio" or FTPS_SUPPORTED:
+			return
+		if self.use_secure_ftp or any(d.enabled and d.use_secure_ftp for d in self.ftp_destinations or []):
+			frappe.throw(frappe._("FTPS with the asyncio FTP transport needs Python 3.11 or later, please select the ftplib transport."))
+
+	def on_update(self):
+		clear_language_mapping_cache()
+		clear_schedule_cache()
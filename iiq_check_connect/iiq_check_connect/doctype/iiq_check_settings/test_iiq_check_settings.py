@@ -1,9 +1,32 @@
 # Copyright (c) 2024, itsdave GmbH and Contributors
 # See license.txt
 
-# import frappe
+import frappe
+import pandas as pd
 from frappe.tests.utils import FrappeTestCase
 
+from iiq_check_connect.language_mapping import LanguageMapper
+from iiq_check_connect.scheduler import cast_schedule, get_idle_reason
+
 
 class TestiiQCheckSettings(FrappeTestCase):
-	pass
+	def test_schedule_of_string_valued_settings(self):
+		# Single doctypes store their values as strings in tabSingles
+		def idle_reason(enable_job, export_hour, incremental_export, current_hour):
+			schedule = cast_schedule({"enable_job": enable_job, "export_hour": export_hour, "incremental_export": incremental_export})
+			return get_idle_reason(frappe._dict(schedule), current_hour)
+
+		self.assertEqual(idle_reason("0", "7", "0", 7), "disabled")
+		self.assertIsNone(idle_reason("1", "7", "0", 7))
+		self.assertEqual(idle_reason("1", "7", "0", 9), "other_hour")
+		self.assertIsNone(idle_reason("1", "7", "1", 9))
+		self.assertEqual(idle_reason("1", "7", "1", 6), "other_hour")
+		self.assertEqual(idle_reason("1", None, None, 9), "other_hour")
+
+	def test_language_mapping_falls_back_to_the_default_language(self):
+		map_language = LanguageMapper({"DE": "de", "AT": "de", "NL": "nl"}, "en")
+		country_codes = ["DE", "AT", "NL", "CH", None]
+
+		self.assertEqual([map_language(code) for code in country_codes], ["de", "de", "nl", "en", "en"])
+		# The vectorized mapping of a column gives the same languages
+		self.assertEqual(list(map_language.map_series(pd.Series(country_codes))), ["de", "de", "nl", "en", "en"])
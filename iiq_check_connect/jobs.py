@@ -0,0 +1,130 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.utils.background_jobs import is_job_enqueued
+
+from iiq_check_connect.progress import publish_progress, start_progress, stop_progress
+from iiq_check_connect.departure_snapshot import rebuild_snapshot
+from iiq_check_connect.export_engine import backfill_export, get_export_start_of_day, prepare_export
+from iiq_check_connect.ftp_upload import upload_export
+
+# Background jobs may take much longer than a web request
+JOB_TIMEOUT = 60 * 60
+
+
+def enqueue_job(method, job_id, **kwargs):
+    """Enqueue method once per job_id. Returns a dict telling the client which job to follow."""
+    if is_job_enqueued(job_id):
+        frappe.msgprint(_("This job is already queued or running."))
+        return {"job_id": job_id, "enqueued": False}
+
+    settings = frappe.get_single("iiQ-Check Settings")
+    frappe.enqueue(
+        method,
+        queue=settings.job_queue or "long",
+        timeout=JOB_TIMEOUT,
+        job_id=job_id,
+        job_key=job_id,
+        progress_user=frappe.session.user,
+        **kwargs,
+    )
+    return {"job_id": job_id, "enqueued": True}
+
+
+@frappe.whitelist()
+def enqueue_prepare_export():
+    """Prepare the export of the current departure date in a background job."""
+    settings = frappe.get_single("iiQ-Check Settings")
+    departure_date = get_export_start_of_day(settings).date()
+    return enqueue_job(
+        "iiq_check_connect.jobs.run_prepare_export",
+        f"iiq_check_prepare_export::{departure_date}",
+    )
+
+
+@frappe.whitelist()
+def enqueue_upload_to_ftp(export_name):
+    """Upload an export in a background job, at most one upload per departure date at a time."""
+    departure_date = frappe.db.get_value("iiQ-Check Export", export_name, "departure_date")
+    return enqueue_job(
+        "iiq_check_connect.jobs.run_upload_to_ftp",
+        f"iiq_check_upload_to_ftp::{departure_date}",
+        export_name=export_name,
+    )
+
+
+@frappe.whitelist()
+def enqueue_backfill_export(from_date, to_date):
+    """Run a backfill in a background job, one backfill at a time, so the ranges can not overlap."""
+    frappe.has_permission("iiQ-Check Functions", "write", throw=True)
+    if not from_date or not to_date:
+        frappe.throw(_("Please set the from and to departure date for the backfill."))
+    return enqueue_job(
+        "iiq_check_connect.jobs.run_backfill_export",
+        "iiq_check_backfill_export",
+        from_date=from_date,
+        to_date=to_date,
+    )
+
+
+@frappe.whitelist()
+def enqueue_rebuild_departure_snapshot():
+    """Rebuild the departure snapshot in a background job."""
+    frappe.has_permission("iiQ-Check Functions", "write", throw=True)
+    return enqueue_job(
+        "iiq_check_connect.jobs.run_rebuild_departure_snapshot",
+        "iiq_check_rebuild_departure_snapshot",
+    )
+
+
+def run_prepare_export(job_key, progress_user):
+    run_with_progress(job_key, progress_user, lambda: prepare_export(interactive=True))
+
+
+def run_upload_to_ftp(job_key, progress_user, export_name):
+    def upload():
+        upload_export(export_name)
+        return export_name
+
+    run_with_progress(job_key, progress_user, upload)
+
+
+def run_backfill_export(job_key, progress_user, from_date, to_date):
+    run_with_progress(
+        job_key,
+        progress_user,
+        lambda: backfill_export(from_date, to_date, interactive=True),
+        lambda export_names: {"message": _("Backfill created {0} exports.").format(len(export_names))},
+    )
+
+
+def run_rebuild_departure_snapshot(job_key, progress_user):
+    run_with_progress(
+        job_key,
+        progress_user,
+        rebuild_snapshot,
+        lambda number_of_rows: {"message": _("Departure snapshot rebuilt with {0} reservations.").format(number_of_rows)},
+    )
+
+
+def run_with_progress(job_key, progress_user, func, describe_result=None):
+    """Run func and publish its progress as well as its result or error to progress_user.
+
+    The "done" event carries the result as export_name, or the dict returned by
+    describe_result(result) for jobs which do not create a single export.
+    """
+    start_progress(job_key, progress_user)
+    publish_progress("started", force=True)
+    try:
+        result = func()
+        frappe.db.commit()
+        publish_progress("done", force=True, **(describe_result(result) if describe_result else {"export_name": result}))
+    except Exception as e:
+        # Keep the failed status and the logs written so far, like hourly_job does
+        frappe.db.commit()
+        publish_progress("failed", force=True, error=str(e))
+        raise
+    finally:
+        stop_progress()
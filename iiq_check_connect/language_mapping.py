@@ -0,0 +1,46 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import frappe
+
+CACHE_KEY = "iiq_check_language_mapping"
+
+
+class LanguageMapper:
+    """Map country codes (kd.land) to iiQ-Check language strings, falling back to the default language.
+
+    Call it for single values (streaming exports) or use map_series for a whole pandas column.
+    """
+
+    def __init__(self, mapping, default_language):
+        self.mapping = mapping
+        self.default_language = default_language
+
+    def __call__(self, country_code):
+        return self.mapping.get(country_code, self.default_language)
+
+    def map_series(self, series):
+        """Map a pandas Series in one vectorized operation."""
+        return series.map(self.mapping).fillna(self.default_language)
+
+
+def get_language_mapper(settings=None):
+    """Return a LanguageMapper for the current iiQ-Check Settings.
+
+    The compiled mapping table is cached, it gets invalidated when the settings are saved.
+    """
+    cached = frappe.cache().get_value(CACHE_KEY)
+    if cached is None:
+        if settings is None:
+            settings = frappe.get_single("iiQ-Check Settings")
+        cached = {
+            "mapping": {el.country_code: el.language_string for el in settings.language_mapping},
+            "default_language": settings.default_language,
+        }
+        frappe.cache().set_value(CACHE_KEY, cached)
+
+    return LanguageMapper(cached["mapping"], cached["default_language"])
+
+
+def clear_language_mapping_cache():
+    frappe.cache().delete_value(CACHE_KEY)
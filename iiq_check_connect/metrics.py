@@ -0,0 +1,53 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+def get_peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    if sys.platform == "darwin":
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+class ExportMetrics:
+    """Collects the duration, row/byte counts and peak RSS of the stages of an export or upload.
+
+    Usage:
+        metrics = ExportMetrics()
+        with metrics.stage("sql") as stage:
+            data = query.run(as_dict=1)
+            stage["row_count"] = len(data)
+        metrics.add_to(export_doc)
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, **counts):
+        record = {"stage": name, "row_count": 0, "byte_count": 0}
+        record.update(counts)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 4)
+            record["peak_rss_mb"] = round(get_peak_rss_mb(), 1)
+            self.stages.append(record)
+
+    @property
+    def total_seconds(self):
+        return sum(s["seconds"] for s in self.stages)
+
+    def add_to(self, export_doc):
+        """Append the recorded stages to the metrics table of an iiQ-Check Export or FTP Log document."""
+        for record in self.stages:
+            export_doc.append("metrics", record)
+        self.stages = []
@@ -0,0 +1,5 @@
+from iiq_check_connect.export_query import ensure_export_indexes
+
+
+def execute():
+    ensure_export_indexes()
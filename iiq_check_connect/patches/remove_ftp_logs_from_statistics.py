@@ -0,0 +1,19 @@
+import re
+
+import frappe
+
+# Start of the HTML block, which upload_to_ftp used to append to the statistics
+FTP_LOG_BLOCK = re.compile(r"\s*<div>\s*<h4>FTP Upload Log", re.IGNORECASE)
+
+
+def execute():
+    """Cut the appended FTP upload logs from the statistics of existing exports,
+    the logs are now stored as iiQ-Check FTP Log documents."""
+    exports = frappe.get_all(
+        "iiQ-Check Export",
+        filters={"statistics": ["like", "%FTP Upload Log%"]},
+        fields=["name", "statistics"],
+    )
+    for export in exports:
+        statistics = FTP_LOG_BLOCK.split(export.statistics, 1)[0]
+        frappe.db.set_value("iiQ-Check Export", export.name, "statistics", statistics, update_modified=False)
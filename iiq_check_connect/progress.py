@@ -0,0 +1,51 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import time
+import frappe
+
+PROGRESS_EVENT = "iiq_check_progress"
+
+# Minimum seconds between two realtime events of the same stage
+PUBLISH_INTERVAL = 0.5
+
+
+def start_progress(job_id, user):
+    """Publish the progress of the export pipeline to user until stop_progress is called."""
+    frappe.flags.iiq_check_progress = frappe._dict(job_id=job_id, user=user, last_published={})
+
+
+def stop_progress():
+    frappe.flags.iiq_check_progress = None
+
+
+def publish_progress(stage, force=False, **data):
+    """Send a realtime progress event, if the current job is tracked. Events of the same
+    stage are throttled to one per PUBLISH_INTERVAL, unless force is set."""
+    context = frappe.flags.iiq_check_progress
+    if not context:
+        return
+
+    now = time.monotonic()
+    if not force and now - context.last_published.get(stage, 0) < PUBLISH_INTERVAL:
+        return
+    context.last_published[stage] = now
+
+    frappe.publish_realtime(
+        PROGRESS_EVENT,
+        dict(job_id=context.job_id, stage=stage, **data),
+        user=context.user,
+        after_commit=False,
+    )
+
+
+def upload_progress_callback(total_bytes):
+    """Return a storbinary callback, which publishes the number of bytes uploaded so far."""
+    sent = 0
+
+    def callback(block):
+        nonlocal sent
+        sent += len(block)
+        publish_progress("bytes_uploaded", force=sent >= total_bytes, bytes=sent, total=total_bytes)
+
+    return callback
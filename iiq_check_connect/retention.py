@@ -0,0 +1,268 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+"""Retention of old exports: monthly archives and pruning of the log noise.
+
+Exports whose departure date is older than keep_export_days (iiQ-Check Settings)
+are packed into one ZIP archive per month (iiQ-Check Export Archive), then the
+export documents, their files, FTP logs and tracked reservations are deleted.
+The archive records the departure dates it holds, these count as exported.
+Version and Activity Log entries of the app older than that are deleted too.
+"""
+
+import csv
+import datetime
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+
+import frappe
+from frappe.core.api.file import create_new_folder
+from frappe.utils.file_manager import save_file
+
+from iiq_check_connect.export_engine import EXPORT_FOLDER
+from iiq_check_connect.ftp_upload import delete_ftp_logs
+
+ARCHIVE_FOLDER = f"{EXPORT_FOLDER}/archive"
+
+MANIFEST_FILENAME = "manifest.csv"
+MANIFEST_FIELDS = [
+    "export", "departure_date", "created_on", "number_of_recipients", "status",
+    "upload_status", "is_delta", "file_name", "content_hash",
+]
+
+# Doctypes whose Version entries are pruned
+VERSIONED_DOCTYPES = ["iiQ-Check Export", "iiQ-Check Settings", "iiQ-Check Functions"]
+
+# Subject of the Activity Log entries written by the hourly job
+ACTIVITY_LOG_SUBJECT = "iiQ-Check hourly job"
+
+
+def get_retention_cutoff(settings, today=None):
+    """Return the first departure date which is kept, or None if everything is kept."""
+    keep_days = frappe.utils.cint(settings.keep_export_days)
+    if keep_days <= 0:
+        return None
+    return (today or frappe.utils.getdate()) - datetime.timedelta(days=keep_days)
+
+
+def get_expired_exports(cutoff):
+    """Return the exports with a departure date before cutoff, which may be archived.
+
+    Exports with an upload still pending are left alone until it is done.
+    """
+    return frappe.get_all(
+        "iiQ-Check Export",
+        filters={"departure_date": ["<", cutoff], "upload_status": ["!=", "pending"]},
+        fields=["name", "departure_date", "created_on", "number_of_recipients", "status",
+                "upload_status", "is_delta", "xlsx_file", "content_hash"],
+        order_by="departure_date asc, name asc",
+    )
+
+
+def get_export_file_urls(export):
+    """Return the URLs of the export file, or of the shard files of a sharded export."""
+    if export.xlsx_file:
+        return [export.xlsx_file]
+    return frappe.get_all(
+        "iiQ-Check Export Shard",
+        filters={"parenttype": "iiQ-Check Export", "parent": export.name, "shard_file": ["is", "set"]},
+        pluck="shard_file",
+        order_by="idx asc",
+    )
+
+
+def ensure_archive_folder():
+    if not frappe.db.exists("File", ARCHIVE_FOLDER):
+        create_new_folder("archive", EXPORT_FOLDER)
+
+
+def get_manifest_arcname(arcnames):
+    """Return the name of the manifest of the exports added now.
+
+    Entries of a ZIP file can not be replaced, so every run which adds exports to an
+    existing archive writes its own manifest: manifest.csv, manifest-2.csv, ...
+    """
+    if MANIFEST_FILENAME not in arcnames:
+        return MANIFEST_FILENAME
+    stem, extension = os.path.splitext(MANIFEST_FILENAME)
+    number = 2
+    while f"{stem}-{number}{extension}" in arcnames:
+        number += 1
+    return f"{stem}-{number}{extension}"
+
+
+def parse_archived_dates(archive):
+    """Return the departure dates of an iiQ-Check Export Archive as a set.
+
+    Archives written before archived_dates was recorded cover every date from
+    their first to their last departure date.
+    """
+    if archive.archived_dates:
+        return {frappe.utils.getdate(line) for line in archive.archived_dates.split() if line}
+    if not archive.first_departure_date or not archive.last_departure_date:
+        return set()
+    first_date = frappe.utils.getdate(archive.first_departure_date)
+    last_date = frappe.utils.getdate(archive.last_departure_date)
+    return {first_date + datetime.timedelta(days=i) for i in range((last_date - first_date).days + 1)}
+
+
+def get_archived_dates(from_date, to_date):
+    """Return the departure dates from from_date to to_date whose exports were archived (and deleted).
+
+    They count as exported, so a backfill or a re-run does not create and upload them again.
+    """
+    from_date = frappe.utils.getdate(from_date)
+    to_date = frappe.utils.getdate(to_date)
+    archives = frappe.get_all(
+        "iiQ-Check Export Archive",
+        filters={"first_departure_date": ["<=", to_date], "last_departure_date": [">=", from_date]},
+        fields=["archived_dates", "first_departure_date", "last_departure_date"],
+    )
+    return {d for archive in archives for d in parse_archived_dates(archive) if from_date <= d <= to_date}
+
+
+def archive_month(month, exports):
+    """Add the files of exports (all departing in month, "YYYY-MM") to the archive of that month.
+
+    The new files and their manifest are appended to a copy of an existing archive,
+    the archived files are neither read nor compressed again. The previous archive
+    file is only deleted once the new one is saved.
+    Returns the iiQ-Check Export Archive document.
+    """
+    archive_name = frappe.db.get_value("iiQ-Check Export Archive", {"month": month})
+    if archive_name:
+        archive_doc = frappe.get_doc("iiQ-Check Export Archive", archive_name)
+    else:
+        archive_doc = frappe.get_doc({"doctype": "iiQ-Check Export Archive", "month": month})
+        archive_doc.insert(ignore_permissions=True)
+
+    old_file = archive_doc.archive_file and frappe.db.get_value("File", {"file_url": archive_doc.archive_file})
+    original_bytes = frappe.utils.cint(archive_doc.original_bytes)
+    manifest = []
+
+    with tempfile.NamedTemporaryFile(suffix=".zip") as archive_file:
+        if old_file:
+            with open(frappe.get_doc("File", old_file).get_full_path(), "rb") as f:
+                shutil.copyfileobj(f, archive_file)
+            archive_file.flush()
+
+        with zipfile.ZipFile(archive_file.name, "a", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as archive_zip:
+            arcnames = set(archive_zip.namelist())
+            for export in exports:
+                file_names = []
+                for file_url in get_export_file_urls(export):
+                    file_doc = frappe.get_doc("File", {"file_url": file_url})
+                    file_name = file_doc.file_name
+                    file_path = file_doc.get_full_path()
+                    if not os.path.exists(file_path):
+                        print(f"File {file_name} of {export.name} not found, it is not archived.")
+                        continue
+
+                    # File names contain the departure date, prefix the export name on a clash
+                    arcname = file_name if file_name not in arcnames else f"{export.name}-{file_name}"
+                    archive_zip.write(file_path, arcname=arcname)
+                    arcnames.add(arcname)
+                    original_bytes += os.path.getsize(file_path)
+                    file_names.append(file_name)
+
+                if not file_names:
+                    print(f"No file of {export.name} found, only its manifest entry is archived.")
+
+                manifest.append({
+                    "export": export.name,
+                    "departure_date": export.departure_date,
+                    "created_on": export.created_on,
+                    "number_of_recipients": export.number_of_recipients,
+                    "status": export.status,
+                    "upload_status": export.upload_status,
+                    "is_delta": export.is_delta,
+                    "file_name": ";".join(file_names),
+                    "content_hash": export.content_hash,
+                })
+
+            manifest_file = io.StringIO()
+            writer = csv.DictWriter(manifest_file, fieldnames=MANIFEST_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(manifest)
+            archive_zip.writestr(get_manifest_arcname(arcnames), manifest_file.getvalue())
+
+        archive_file.seek(0)
+        content = archive_file.read()
+
+    file_doc = save_file(
+        fname=f"iiq-check-archive-{month}.zip",
+        content=content,
+        dt="iiQ-Check Export Archive",
+        dn=archive_doc.name,
+        folder=ARCHIVE_FOLDER,
+        is_private=1,
+    )
+    # Only now the previous archive file of the month is replaced
+    if old_file:
+        frappe.delete_doc("File", old_file, ignore_permissions=True)
+
+    departure_dates = parse_archived_dates(archive_doc)
+    departure_dates.update(frappe.utils.getdate(export.departure_date) for export in exports)
+    archive_doc.archive_file = file_doc.file_url
+    archive_doc.export_count = frappe.utils.cint(archive_doc.export_count) + len(manifest)
+    archive_doc.first_departure_date = min(departure_dates)
+    archive_doc.last_departure_date = max(departure_dates)
+    archive_doc.archived_dates = "\n".join(str(d) for d in sorted(departure_dates))
+    archive_doc.original_bytes = original_bytes
+    archive_doc.archive_bytes = len(content)
+    archive_doc.save(ignore_permissions=True)
+    return archive_doc
+
+
+def delete_exports(export_names):
+    """Delete the export documents with their files and everything linked to them."""
+    logs = frappe.get_all("iiQ-Check FTP Log", filters={"export": ["in", export_names]}, pluck="name")
+    if logs:
+        delete_ftp_logs(logs)
+    frappe.db.delete("iiQ-Check Exported Reservation", {"export": ["in", export_names]})
+
+    for export_name in export_names:
+        # delete_permanently: no Deleted Document copy, the archive holds the file and the manifest
+        frappe.delete_doc(
+            "iiQ-Check Export", export_name, ignore_permissions=True, force=True, delete_permanently=True
+        )
+
+
+def prune_logs(cutoff):
+    """Delete the Version and Activity Log entries of the app created before cutoff."""
+    frappe.db.delete("Version", {"ref_doctype": ["in", VERSIONED_DOCTYPES], "creation": ["<", cutoff]})
+    frappe.db.delete("Activity Log", {"subject": ACTIVITY_LOG_SUBJECT, "creation": ["<", cutoff]})
+
+
+def apply_retention(today=None):
+    """Daily scheduler job: archive and delete expired exports, prune old log entries.
+
+    Every month is committed on its own, so an interrupted run keeps its progress.
+    Returns the names of the written iiQ-Check Export Archive documents.
+    """
+    settings = frappe.get_single("iiQ-Check Settings")
+    cutoff = get_retention_cutoff(settings, today)
+    if not cutoff:
+        return []
+
+    months = {}
+    for export in get_expired_exports(cutoff):
+        months.setdefault(export.departure_date.strftime("%Y-%m"), []).append(export)
+
+    if months:
+        ensure_archive_folder()
+
+    archives = []
+    for month, exports in months.items():
+        archive_doc = archive_month(month, exports)
+        delete_exports([export.name for export in exports])
+        frappe.db.commit()
+        archives.append(archive_doc.name)
+        print(f"Archived {len(exports)} exports of {month} in {archive_doc.archive_file}.")
+
+    prune_logs(cutoff)
+    frappe.db.commit()
+    return archives
@@ -0,0 +1,88 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import datetime
+import frappe
+
+SCHEDULE_CACHE_KEY = "iiq_check_schedule"
+IDLE_TICKS_CACHE_KEY = "iiq_check_idle_ticks"
+
+# The only settings the hourly gate needs
+SCHEDULE_FIELDS = ["enable_job", "export_hour", "incremental_export"]
+
+
+def get_schedule():
+    """Return the scheduling fields of iiQ-Check Settings from the cache.
+
+    Only these fields are read (not the whole settings document with its child
+    tables), and the cached value is cleared when the settings are saved.
+    """
+    schedule = frappe.cache().get_value(SCHEDULE_CACHE_KEY)
+    if schedule is None:
+        schedule = cast_schedule(frappe.db.get_value("iiQ-Check Settings", None, SCHEDULE_FIELDS, as_dict=True))
+        frappe.cache().set_value(SCHEDULE_CACHE_KEY, schedule)
+    return frappe._dict(schedule)
+
+
+def cast_schedule(values):
+    """Return the scheduling fields as int.
+
+    get_value of a Single doctype returns the raw strings of tabSingles, e.g. "0"
+    for a disabled job, which would be truthy.
+    """
+    values = values or {}
+    return {field: frappe.utils.cint(values.get(field)) for field in SCHEDULE_FIELDS}
+
+
+def clear_schedule_cache():
+    frappe.cache().delete_value(SCHEDULE_CACHE_KEY)
+
+
+def get_idle_reason(schedule, current_hour):
+    """Return why the job has nothing to do in current_hour, or None if it has to run."""
+    if not schedule.enable_job:
+        return "disabled"
+    if schedule.export_hour == current_hour:
+        return None
+    if schedule.incremental_export and current_hour > schedule.export_hour:
+        return None
+    return "other_hour"
+
+
+def count_idle_tick(reason):
+    cache = frappe.cache()
+    cache.hincrby(cache.make_key(IDLE_TICKS_CACHE_KEY), reason, 1)
+
+
+def pop_idle_ticks():
+    """Return and reset the idle tick counters of this site."""
+    cache = frappe.cache()
+    key = cache.make_key(IDLE_TICKS_CACHE_KEY)
+    pipeline = cache.pipeline()
+    pipeline.hgetall(key)
+    pipeline.delete(key)
+    counters, _ = pipeline.execute()
+    return {k.decode() if isinstance(k, bytes) else k: int(v) for k, v in (counters or {}).items()}
+
+
+def hourly_job():
+    """Scheduler entry point: returns without touching the database on idle hours.
+
+    Idle ticks are only counted in the cache. They are summarized in one Activity Log
+    entry the next time the job actually runs, instead of one entry per hour.
+    """
+    current_hour = datetime.datetime.now().hour
+    reason = get_idle_reason(get_schedule(), current_hour)
+    if reason:
+        count_idle_tick(reason)
+        return
+
+    # Only imported when the job actually runs, idle ticks stay cheap
+    from iiq_check_connect import tools
+
+    idle_ticks = pop_idle_ticks()
+    if idle_ticks:
+        summary = ", ".join(f"{reason}: {count}" for reason, count in sorted(idle_ticks.items()))
+        tools.log_activity("", f"Skipped {sum(idle_ticks.values())} idle hourly ticks since the last run ({summary}).", None, None)
+
+    tools.hourly_job()
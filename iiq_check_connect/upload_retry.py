@@ -0,0 +1,65 @@
+# Copyright (c) 2024, itsdave GmbH and contributors
+# For license information, please see license.txt
+
+import datetime
+import random
+import frappe
+
+# Delay before the first retry, doubled with every further attempt
+RETRY_BASE_DELAY = datetime.timedelta(minutes=5)
+RETRY_MAX_DELAY = datetime.timedelta(hours=6)
+
+# After this many failed attempts the export is marked as failed and not retried anymore
+MAX_UPLOAD_ATTEMPTS = 8
+
+
+def get_retry_delay(attempt):
+    """Exponential backoff with jitter: a random delay between half and the full
+    base delay * 2^(attempt - 1), capped at RETRY_MAX_DELAY."""
+    delay = min(RETRY_BASE_DELAY * 2 ** max(attempt - 1, 0), RETRY_MAX_DELAY)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def schedule_upload_retry(export_doc, error):
+    """Mark export_doc as pending upload and schedule its next attempt. The caller saves the document."""
+    export_doc.upload_attempts = (export_doc.upload_attempts or 0) + 1
+    export_doc.last_upload_error = str(error)
+
+    if export_doc.upload_attempts >= MAX_UPLOAD_ATTEMPTS:
+        export_doc.upload_status = "failed"
+        export_doc.next_upload_attempt = None
+        return
+
+    export_doc.upload_status = "pending"
+    export_doc.next_upload_attempt = frappe.utils.now_datetime() + get_retry_delay(export_doc.upload_attempts)
+
+
+def mark_uploaded(export_doc):
+    export_doc.upload_status = "uploaded"
+    export_doc.upload_attempts = 0
+    export_doc.next_upload_attempt = None
+    export_doc.last_upload_error = None
+
+
+def retry_pending_uploads():
+    """Scheduler job: retry all pending uploads, whose next attempt is due.
+
+    Interrupted transfers are resumed, see FTPSession.upload.
+    """
+    from iiq_check_connect.ftp_upload import upload_export
+
+    due_exports = frappe.get_all(
+        "iiQ-Check Export",
+        filters={"upload_status": "pending", "next_upload_attempt": ["<=", frappe.utils.now_datetime()]},
+        pluck="name",
+        order_by="next_upload_attempt asc",
+    )
+
+    for export_name in due_exports:
+        try:
+            upload_export(export_name)
+        except Exception as e:
+            # upload_export has already scheduled the next attempt
+            print(f"Retry of the upload of {export_name} failed: {e}")
+        finally:
+            frappe.db.commit()